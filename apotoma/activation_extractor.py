@@ -0,0 +1,98 @@
+import threading
+import weakref
+from typing import Tuple, List, Dict, Sequence, Union
+
+import numpy as np
+import tensorflow as tf
+from tensorflow.keras.models import Model
+
+from apotoma.activation_traces import ATLayout
+
+
+class ActivationExtractor:
+    """Extracts the outputs of a set of layers, together with the dnn output, from a keras model.
+
+    Building the extraction model and tracing its forward pass is expensive compared to a forward pass
+    on a small target set. Extractors are thus built once per (model, layer set) and shared amongst
+    all surprise adequacy instances: Use `ActivationExtractor.get` instead of the constructor.
+
+    Args:
+        model (tf.keras.Model): The model under test (with a single input).
+        layer_names (Sequence(str)): Names of the layers whose outputs are to be extracted.
+        fuse_dim_reduction (bool): If true, outputs of layers with more than two dimensions
+        (primarily convolutional layers) are averaged over all but their last axis within the graph.
+    """
+
+    _cache: 'weakref.WeakKeyDictionary[tf.keras.Model, Dict[Tuple, ActivationExtractor]]' = \
+        weakref.WeakKeyDictionary()
+    _cache_lock = threading.Lock()
+
+    def __init__(self, model: tf.keras.Model, layer_names: Sequence[str], fuse_dim_reduction: bool = False) -> None:
+        self.layer_names = tuple(layer_names)
+        self.fuse_dim_reduction = fuse_dim_reduction
+
+        output_layers = [model.get_layer(layer_name).output for layer_name in self.layer_names]
+        if fuse_dim_reduction:
+            # Same criterion as in `SurpriseAdequacy._reduce_layer_output`, but including the batch dimension
+            output_layers = [self._fused_dim_reduction(o) if len(o.shape) >= 4 else o for o in output_layers]
+        output_layers.append(model.output)
+        self.temp_model = Model(
+            inputs=model.input,
+            outputs=output_layers
+        )
+
+        # Layers with more than two dimensions are reduced to their last dimension
+        self.layout = ATLayout(layer_names=self.layer_names,
+                               widths=tuple(int(o.shape[-1]) for o in self.temp_model.outputs[:-1]))
+
+        self.input_dtype = tf.as_dtype(model.input.dtype)
+        input_spec = tf.TensorSpec(shape=(None,) + tuple(model.input.shape[1:]), dtype=self.input_dtype)
+        self._forward = tf.function(self._call_temp_model, input_signature=[input_spec])
+
+    @classmethod
+    def get(cls,
+            model: tf.keras.Model,
+            layer_names: Sequence[str],
+            fuse_dim_reduction: bool = False) -> 'ActivationExtractor':
+        """Returns the (cached) extractor for the passed model and layers, building it if not yet available"""
+        key = (tuple(layer_names), fuse_dim_reduction)
+        with cls._cache_lock:
+            model_extractors = cls._cache.setdefault(model, dict())
+            if key not in model_extractors:
+                model_extractors[key] = cls(model, layer_names, fuse_dim_reduction)
+            return model_extractors[key]
+
+    @staticmethod
+    def _fused_dim_reduction(layer_output: tf.Tensor) -> tf.Tensor:
+        """Graph equivalent of `SurpriseAdequacy._output_dim_reduction` (global average pooling)"""
+        axis = list(range(1, len(layer_output.shape) - 1))
+        return tf.keras.layers.Lambda(lambda t: tf.reduce_mean(t, axis=axis))(layer_output)
+
+    def _call_temp_model(self, batch: tf.Tensor) -> List[tf.Tensor]:
+        return self.temp_model(batch, training=False)
+
+    def predict_on_batch(self, batch: Union[np.ndarray, tf.Tensor]) -> Tuple[List[np.ndarray], np.ndarray]:
+        """Runs the compiled forward pass on a single batch.
+
+        Args:
+            batch (ndarray or Tensor): Inputs to the model (Shape of batch_size * input_shape)
+
+        Returns:
+            layer_outputs (List(ndarray)): The outputs of the extracted layers, in order of `layer_names`.
+            dnn_output (ndarray): The output of the model.
+        """
+        if isinstance(batch, tf.Tensor):
+            batch = tf.cast(batch, self.input_dtype)
+        else:
+            batch = tf.convert_to_tensor(np.asarray(batch, dtype=self.input_dtype.as_numpy_dtype))
+        outputs = self._forward(batch)
+        outputs = [o.numpy() for o in outputs]
+        dnn_output = outputs.pop()
+        return outputs, dnn_output
+
+    def predict(self, dataset: np.ndarray, batch_size: int, verbose: int = 1) -> Tuple[List[np.ndarray], np.ndarray]:
+        """Keras `predict` on the whole dataset, returning the same structure as `predict_on_batch`"""
+        outputs = self.temp_model.predict(dataset, batch_size=batch_size, verbose=verbose)
+        outputs = list(outputs)
+        dnn_output = outputs.pop()
+        return outputs, dnn_output
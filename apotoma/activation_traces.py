@@ -0,0 +1,98 @@
+from typing import Tuple, Sequence, Union, Dict
+
+import numpy as np
+from dataclasses import dataclass
+
+
+@dataclass(frozen=True)
+class ATLayout:
+    """Column layout of an activation trace matrix (Shape of num_examples * num_nodes):
+    The ATs of every layer are stored in a contiguous block of columns, in order of `layer_names`.
+
+    Args:
+        layer_names (Tuple(str)): The layers, in the order of their column blocks.
+        widths (Tuple(int)): The number of nodes (i.e., columns) of every layer.
+    """
+
+    layer_names: Tuple[str, ...]
+    widths: Tuple[int, ...]
+
+    def __post_init__(self):
+        if len(self.layer_names) != len(self.widths):
+            raise ValueError(f"Got {len(self.layer_names)} layer names, but {len(self.widths)} widths")
+
+    @property
+    def num_nodes(self) -> int:
+        return int(sum(self.widths))
+
+    @property
+    def slices(self) -> Dict[str, slice]:
+        """The column range of every layer"""
+        offsets = np.cumsum((0,) + tuple(self.widths))
+        return {name: slice(int(offsets[i]), int(offsets[i + 1])) for i, name in enumerate(self.layer_names)}
+
+    def subset(self, layer_names: Sequence[str]) -> 'ATLayout':
+        """Layout of the AT matrix consisting only of the passed layers (in the passed order)"""
+        widths = dict(zip(self.layer_names, self.widths))
+        return ATLayout(layer_names=tuple(layer_names), widths=tuple(widths[name] for name in layer_names))
+
+    def contains(self, layer_names: Sequence[str]) -> bool:
+        return set(layer_names).issubset(self.layer_names)
+
+    def columns(self, layer_names: Sequence[str]) -> Union[slice, np.ndarray]:
+        """Columns of the passed layers: A slice if they form a contiguous block in the passed order,
+        an index array otherwise."""
+        slices = self.slices
+        selected = [slices[name] for name in layer_names]
+        if all(a.stop == b.start for a, b in zip(selected[:-1], selected[1:])):
+            return slice(selected[0].start, selected[-1].stop)
+        return np.concatenate([np.arange(s.start, s.stop) for s in selected])
+
+    def view(self, ats: np.ndarray, layer_names: Sequence[str]) -> np.ndarray:
+        """The ATs of the passed layers. This is a view (no copy) if the layers form a contiguous block,
+        e.g. for any single layer or for the full layer list."""
+        assert ats.shape[-1] == self.num_nodes, f"ATs have {ats.shape[-1]} columns, layout has {self.num_nodes}"
+        return ats[..., self.columns(layer_names)]
+
+
+AT_PRECISIONS = ('float32', 'float16', 'int8')
+
+
+@dataclass(frozen=True)
+class ATQuantization:
+    """Reduced precision storage of activation traces.
+
+    ATs are stored either as float16, or as int8 with a per-column scale and offset
+    (such that `ats ~= quantized * scale + offset`). Dequantized ATs are always float32.
+
+    Use `ATQuantization.fit` to create an instance for given ATs.
+    """
+
+    precision: str
+    scale: Union[np.ndarray, None] = None
+    offset: Union[np.ndarray, None] = None
+
+    @classmethod
+    def fit(cls, ats: np.ndarray, precision: str) -> 'ATQuantization':
+        if precision not in AT_PRECISIONS:
+            raise ValueError(f"Unsupported AT precision {precision}. Supported: {AT_PRECISIONS}")
+        if precision != 'int8':
+            return cls(precision=precision)
+        col_min = np.min(ats, axis=0).astype(np.float32)
+        col_max = np.max(ats, axis=0).astype(np.float32)
+        scale = (col_max - col_min) / 255
+        # Constant columns are mapped to the offset only
+        scale[scale == 0] = 1
+        offset = col_min + 128 * scale
+        return cls(precision=precision, scale=scale, offset=offset)
+
+    def quantize(self, ats: np.ndarray) -> np.ndarray:
+        if self.precision != 'int8':
+            return ats.astype(self.precision)
+        quantized = np.rint((ats - self.offset) / self.scale)
+        return np.clip(quantized, -128, 127).astype(np.int8)
+
+    def dequantize(self, quantized: np.ndarray) -> np.ndarray:
+        if self.precision != 'int8':
+            return quantized.astype(np.float32)
+        return quantized.astype(np.float32) * self.scale + self.offset
@@ -0,0 +1,118 @@
+import threading
+import weakref
+from typing import Tuple, Optional, Sequence, List, Dict
+
+import numpy as np
+import tensorflow as tf
+
+from apotoma.activation_traces import ATLayout
+from apotoma.fingerprint import owning_array, memory_address
+
+
+class _Entry:
+
+    def __init__(self, model: tf.keras.Model, layout: ATLayout, dataset: np.ndarray,
+                 ats: np.ndarray, pred: np.ndarray) -> None:
+        self.model_ref = weakref.ref(model)
+        self.layout = layout
+        self.root_ref = weakref.ref(owning_array(dataset))
+        self.address = memory_address(dataset)
+        self.num_samples = dataset.shape[0]
+        self.row_stride = dataset.strides[0]
+        self.sample_shape = dataset.shape[1:]
+        self.sample_strides = dataset.strides[1:]
+        self.dtype = dataset.dtype
+        self.ats = ats
+        self.pred = pred
+
+    def rows_of(self, model: tf.keras.Model, layer_names: Tuple[str, ...],
+                dataset: np.ndarray) -> Optional[slice]:
+        """The rows of the stored ats corresponding to dataset,
+        or None if dataset is not a row-range of the entry or if some layers are not stored."""
+        root = self.root_ref()
+        if self.model_ref() is not model or root is None or root is not owning_array(dataset):
+            return None
+        if not self.layout.contains(layer_names):
+            return None
+        if dataset.dtype != self.dtype or dataset.shape[1:] != self.sample_shape:
+            return None
+        if dataset.strides[1:] != self.sample_strides:
+            return None
+        if dataset.shape[0] > 1 and dataset.strides[0] != self.row_stride:
+            return None
+        offset = memory_address(dataset) - self.address
+        if offset % self.row_stride != 0:
+            return None
+        start = offset // self.row_stride
+        if start < 0 or start + dataset.shape[0] > self.num_samples:
+            return None
+        return slice(start, start + dataset.shape[0])
+
+
+class ActivationTraceStore:
+    """In-memory store of activation traces and predictions, to be shared amongst surprise adequacy instances.
+
+    Entries are keyed by model, layers and the identity of the dataset memory (not its content!):
+    Any dataset which is a range of rows of a stored dataset (e.g. `train_x[:num_samples]`)
+    is served as a view on the stored ats, without another forward pass.
+    Likewise, any subset of the stored layers is served from the stored ats
+    (as a view if the layers form a contiguous block of columns, see `ATLayout.view`).
+    Layers stored in different entries are available individually through `get_layers`.
+    Datasets must thus not be modified in place while they are used with the store.
+
+    A store is typically shared by all instances of one experiment, by passing it as `at_store`
+    in the `SurpriseAdequacyConfig`.
+    """
+
+    def __init__(self) -> None:
+        self._entries: List[_Entry] = []
+        self._lock = threading.Lock()
+
+    def get(self, model: tf.keras.Model, layer_names: Sequence[str],
+            dataset: np.ndarray) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        """Returns (read-only) stored ats and predictions for the dataset and layers, or None if not available"""
+        if model is None or not isinstance(dataset, np.ndarray):
+            return None
+        layer_names = tuple(layer_names)
+        with self._lock:
+            for entry in self._entries:
+                rows = entry.rows_of(model, layer_names, dataset)
+                if rows is not None:
+                    return entry.layout.view(entry.ats[rows], layer_names), entry.pred[rows]
+        return None
+
+    def get_layers(self, model: tf.keras.Model, layer_names: Sequence[str],
+                   dataset: np.ndarray) -> Tuple[Dict[str, np.ndarray], Optional[np.ndarray]]:
+        """Returns the (read-only) stored ats of all passed layers stored in any entry for the dataset,
+        keyed by layer name, and the stored predictions (or None if no layer is stored for the dataset)"""
+        layer_ats, pred = dict(), None
+        if model is None or not isinstance(dataset, np.ndarray):
+            return layer_ats, pred
+        with self._lock:
+            for entry in self._entries:
+                found = tuple(name for name in layer_names if name not in layer_ats and entry.layout.contains([name]))
+                rows = entry.rows_of(model, found, dataset) if found else None
+                if rows is None:
+                    continue
+                for name in found:
+                    layer_ats[name] = entry.layout.view(entry.ats[rows], [name])
+                pred = entry.pred[rows]
+        return layer_ats, pred
+
+    def put(self, model: tf.keras.Model, layout: ATLayout, dataset: np.ndarray,
+            ats: np.ndarray, pred: np.ndarray) -> None:
+        """Stores the ats and predictions of the passed dataset (ignored for datasets which are no numpy arrays)"""
+        if model is None or not isinstance(dataset, np.ndarray):
+            return
+        ats, pred = ats.view(), pred.view()
+        ats.flags.writeable = False
+        pred.flags.writeable = False
+        entry = _Entry(model, layout, dataset, ats, pred)
+        with self._lock:
+            # Drop entries whose model or dataset does not exist anymore
+            self._entries = [e for e in self._entries if e.model_ref() is not None and e.root_ref() is not None]
+            self._entries.append(entry)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries = []
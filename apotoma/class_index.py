@@ -0,0 +1,118 @@
+from typing import List, Union, Optional, Sequence, Tuple
+
+import numpy as np
+from dataclasses import dataclass
+
+RowSelector = Union[slice, np.ndarray]
+
+
+@dataclass(frozen=True)
+class ClassIndex:
+    """Index of the (train) at rows per predicted class.
+
+    The indexed rows are stored grouped by class in a single array (`order`), with the rows of class `c`
+    at `order[offsets[c]:offsets[c + 1]]`. If all rows are indexed and already sorted by class
+    (see `is_contiguous`), the rows of a class are returned as a slice, such that indexing ats with them
+    returns a view instead of a copy.
+
+    Use `ClassIndex.from_labels` to create an instance.
+
+    Args:
+        order (ndarray): The indexed rows, grouped by class (and in ascending order within every class).
+        offsets (ndarray): Start of every class in `order` (Shape of num_classes + 1).
+        num_rows (int): The total number of rows (including rows which are not indexed).
+        is_contiguous (bool): True if all rows are indexed and sorted by class,
+        i.e., every class is a contiguous block of rows.
+    """
+
+    order: np.ndarray
+    offsets: np.ndarray
+    num_rows: int
+    is_contiguous: bool
+
+    @classmethod
+    def from_labels(cls, labels: np.ndarray, num_classes: int, rows: Optional[np.ndarray] = None) -> 'ClassIndex':
+        """Creates the index of the passed labels
+
+        Args:
+            labels (ndarray): The (predicted) label of every row.
+            num_classes (int): The number of classes.
+            rows (ndarray): The rows to index. Default: All rows.
+
+        Returns:
+            The class index.
+        """
+        labels = np.asarray(labels)
+        rows = np.arange(labels.shape[0]) if rows is None else np.asarray(rows, dtype=int)
+        indexed_labels = labels[rows].astype(int)
+        # Stable sort: Rows are kept in their original order within every class
+        order = rows[np.argsort(indexed_labels, kind='stable')]
+        counts = np.bincount(indexed_labels, minlength=num_classes)
+        offsets = np.concatenate([[0], np.cumsum(counts)])
+        is_contiguous = order.shape[0] == labels.shape[0] and bool(np.all(order == np.arange(labels.shape[0])))
+        return cls(order=order, offsets=offsets, num_rows=labels.shape[0], is_contiguous=is_contiguous)
+
+    def __len__(self) -> int:
+        """The number of indexed rows"""
+        return self.order.shape[0]
+
+    @property
+    def num_classes(self) -> int:
+        return self.offsets.shape[0] - 1
+
+    @property
+    def labels(self) -> np.ndarray:
+        """The classes with at least one indexed row"""
+        return np.flatnonzero(np.diff(self.offsets))
+
+    def count(self, label: int) -> int:
+        if label >= self.num_classes:
+            return 0
+        return int(self.offsets[label + 1] - self.offsets[label])
+
+    def grouped(self, ats: np.ndarray, labels: Optional[Sequence[int]] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """The ats of the passed classes, grouped by class (in the order of the labels), and the start of every class
+        in the grouped ats (Shape of num_labels + 1): The ats of the i-th label are `grouped[starts[i]:starts[i + 1]]`.
+
+        The rows are gathered once. If the index is contiguous and all classes are requested,
+        the grouped ats are a view of the ats instead.
+
+        Args:
+            ats (ndarray): The ats of all rows.
+            labels: The classes. Default: All classes (such that the starts are `offsets`).
+
+        Returns:
+            The grouped ats and the starts of the classes.
+        """
+        if labels is None:
+            if self.is_contiguous:
+                return ats[:self.num_rows], self.offsets
+            return ats[self.order], self.offsets
+        counts = np.array([self.count(label) for label in labels], dtype=int)
+        starts = np.concatenate([[0], np.cumsum(counts)])
+        rows = [self.order[self.offsets[label]:self.offsets[label + 1]] for label in labels if label < self.num_classes]
+        return ats[np.concatenate(rows) if rows else np.empty(shape=0, dtype=int)], starts
+
+    def rows(self, label: int) -> RowSelector:
+        """The rows of the passed class: A slice if the index is contiguous, an index array otherwise"""
+        if label >= self.num_classes:
+            return np.empty(shape=0, dtype=int)
+        start, stop = int(self.offsets[label]), int(self.offsets[label + 1])
+        if self.is_contiguous:
+            return slice(start, stop)
+        return self.order[start:stop]
+
+    def other_rows(self, label: int) -> List[RowSelector]:
+        """All rows except the ones of the passed class (including rows which are not indexed).
+        For a contiguous index, these are the two slices before and after the class."""
+        rows = self.rows(label)
+        if isinstance(rows, slice):
+            return [slice(0, rows.start), slice(rows.stop, self.num_rows)]
+        mask = np.ones(shape=self.num_rows, dtype=bool)
+        mask[rows] = False
+        return [mask]
+
+    def extended(self, labels: np.ndarray) -> 'ClassIndex':
+        """The index after appending rows: All rows in `labels` beyond `num_rows` are added to the index"""
+        new_rows = np.arange(self.num_rows, np.asarray(labels).shape[0])
+        return ClassIndex.from_labels(labels, self.num_classes, rows=np.concatenate([self.order, new_rows]))
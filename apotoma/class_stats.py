@@ -0,0 +1,124 @@
+from typing import List, Optional, Sequence
+
+import numpy as np
+from dataclasses import dataclass
+
+from apotoma.class_index import ClassIndex
+
+
+# Upper bound on the number of elements of a float64 chunk of ats, i.e., 32 MB
+_MAX_CHUNK_ELEMENTS = 2 ** 22
+
+
+@dataclass(frozen=True)
+class ClassStatistics:
+    """Per-class moments of the nodes of activation traces, computed on the ats grouped by class.
+
+    Only the O(num_classes * num_nodes) moments needed to filter the nodes are computed here.
+    Covariances are calculated later (see `kde_data_covariance`), only for the remaining nodes
+    and only by the kde backends which use them.
+
+    Use `ClassStatistics.from_ats` or `ClassStatistics.from_grouped_ats` to create an instance.
+
+    Args:
+        counts (ndarray): The number of ats of every class (Shape of num_classes).
+        means (ndarray): The mean of every node per class (Shape of num_classes * num_nodes).
+        variances (ndarray): The (population) variance of every node per class, as `np.var`
+        (Shape of num_classes * num_nodes).
+    """
+
+    counts: np.ndarray
+    means: np.ndarray
+    variances: np.ndarray
+
+    @classmethod
+    def from_ats(cls, ats: np.ndarray, class_index: Optional[ClassIndex] = None) -> 'ClassStatistics':
+        """Calculates the statistics of the passed ats, gathering the rows of all classes once
+        (see `ClassIndex.grouped`).
+
+        Args:
+            ats (ndarray): The ats (Shape of num_examples * num_nodes).
+            class_index (ClassIndex): The rows of every class. Default: None, i.e., all ats form a single class.
+
+        Returns:
+            The statistics.
+        """
+        if class_index is None:
+            return cls.from_grouped_ats(ats, np.array([0, ats.shape[0]]))
+        return cls.from_grouped_ats(*class_index.grouped(ats))
+
+    @classmethod
+    def from_grouped_ats(cls, grouped_ats: np.ndarray, starts: np.ndarray) -> 'ClassStatistics':
+        """Calculates the statistics of ats which are grouped by class, e.g. by `ClassIndex.grouped`.
+
+        Args:
+            grouped_ats (ndarray): The ats, with the ats of class c at rows `starts[c]:starts[c + 1]`.
+            starts (ndarray): The start of every class (Shape of num_classes + 1).
+
+        Returns:
+            The statistics.
+        """
+        num_classes, num_nodes = starts.shape[0] - 1, grouped_ats.shape[1]
+        statistics = cls(counts=np.zeros(shape=num_classes, dtype=int),
+                         means=np.zeros(shape=(num_classes, num_nodes)),
+                         variances=np.zeros(shape=(num_classes, num_nodes)))
+        statistics._update(grouped_ats, starts, list(range(num_classes)))
+        return statistics
+
+    def updated(self, grouped_ats: np.ndarray, starts: np.ndarray, labels: Sequence[int]) -> 'ClassStatistics':
+        """The statistics after the ats of the passed classes changed (e.g. were extended),
+        re-calculating only the statistics of these classes from their grouped ats
+        (as returned by `ClassIndex.grouped` for the labels)."""
+        statistics = ClassStatistics(counts=np.copy(self.counts),
+                                     means=np.copy(self.means),
+                                     variances=np.copy(self.variances))
+        statistics._update(grouped_ats, starts, labels)
+        return statistics
+
+    def _update(self, grouped_ats: np.ndarray, starts: np.ndarray, labels: Sequence[int]) -> None:
+        """(Re-)calculates the statistics of the labels, whose ats are `grouped_ats[starts[i]:starts[i + 1]]`"""
+        counts = np.diff(starts)
+        self.counts[labels] = counts
+        divisors = np.maximum(counts, 1)[:, None]
+        means = _segment_sums(grouped_ats, starts) / divisors
+        # Two-pass variance (as np.var): The squared deviations from the class means
+        variances = _segment_sums(grouped_ats, starts, means=means) / divisors
+        # Classes without ats keep zero moments
+        non_empty = counts > 0
+        labels = np.asarray(labels, dtype=int)[non_empty]
+        self.means[labels] = means[non_empty]
+        self.variances[labels] = variances[non_empty]
+
+    def low_variance_nodes(self, min_var_threshold: float) -> List[int]:
+        """The nodes whose variance is below the threshold in at least one class (ignoring classes without ats)"""
+        low_variance = self.variances[self.counts > 0] < min_var_threshold
+        return np.flatnonzero(np.any(low_variance, axis=0)).tolist()
+
+
+def _segment_sums(grouped_ats: np.ndarray, starts: np.ndarray, means: Optional[np.ndarray] = None) -> np.ndarray:
+    """The float64 sums of the rows of every segment `starts[i]:starts[i + 1]` of the grouped ats
+    (or, if the means of the segments are passed, of their squared deviations from the means),
+    calculated in chunks of rows, such that the ats are never converted to float64 as a whole"""
+    num_segments = starts.shape[0] - 1
+    sums = np.zeros(shape=(num_segments, grouped_ats.shape[1]))
+    segments = np.repeat(np.arange(num_segments), np.diff(starts))
+    chunk_rows = max(1, _MAX_CHUNK_ELEMENTS // max(1, grouped_ats.shape[1]))
+    for chunk_start in range(0, grouped_ats.shape[0], chunk_rows):
+        chunk = np.array(grouped_ats[chunk_start:chunk_start + chunk_rows], dtype=np.float64)
+        chunk_segments = segments[chunk_start:chunk_start + chunk_rows]
+        if means is not None:
+            chunk -= means[chunk_segments]
+            chunk **= 2
+        # The rows of every segment are contiguous within the chunk as well
+        segment_starts = np.flatnonzero(np.diff(chunk_segments, prepend=-1))
+        sums[chunk_segments[segment_starts]] += np.add.reduceat(chunk, segment_starts, axis=0)
+    return sums
+
+
+def kde_data_covariance(dataset: np.ndarray) -> np.ndarray:
+    """The data covariance of a dataset (Shape of num_dims * num_points), calculated exactly as by
+    `scipy.stats.gaussian_kde` (i.e., with uniform analytic weights, on the same memory layout),
+    such that kdes set up with it are identical to scipy's"""
+    dataset = np.atleast_2d(np.asarray(dataset))
+    num_points = dataset.shape[1]
+    return np.atleast_2d(np.cov(dataset, rowvar=True, bias=False, aweights=np.full(num_points, 1 / num_points)))
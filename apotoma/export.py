@@ -0,0 +1,194 @@
+from typing import Dict, List
+
+import numpy as np
+import tensorflow as tf
+from scipy.stats import gaussian_kde
+
+from apotoma.activation_extractor import ActivationExtractor
+from apotoma.kde import GaussianKDE, DEFAULT_MAX_TILE_ELEMENTS
+from apotoma.surprise_adequacy import SurpriseAdequacy, LSA, DSA
+
+
+class SurpriseScorer(tf.Module):
+    """A prepared LSA or DSA as a single tensorflow graph: inputs -> ATs -> surprise and prediction.
+
+    The ATs are extracted by the model with the dimension reduction built into the graph
+    (see `ActivationExtractor`), and scored by the state of the prepared surprise adequacy,
+    which is held in (non-trainable) variables, such that the scorer can be saved as a SavedModel
+    (see `export_scorer`) and served and batched by tensorflow alone.
+    Use `SurpriseScorer.from_sa` to create an instance.
+
+    Every target is scored by its predicted class only (the targets are partitioned by class in the graph):
+    - LSA: The log density of the kde of the class, evaluated exactly as by `apotoma.kde.GaussianKDE`,
+      with the state of the kde (whitened data, cholesky factor, weights, ...) and the projection of the class (if any).
+    - DSA: The distance to the nearest train at of the class, divided by the distance from this train at
+      to the nearest train at of any other class. The latter only depends on the train at and is pre-computed.
+    Targets predicted as a class without kde (or train ats) get a surprise of nan.
+
+    Args:
+        model (tf.keras.Model): The model under test, with the extracted layers as additional outputs
+        (see `ActivationExtractor.temp_model`).
+        input_spec (tf.TensorSpec): The (batched) input of the model.
+        is_classification (bool): Whether the model solves a classification problem.
+        kept_columns (ndarray): The columns of the ATs which are scored (e.g. all but the low variance nodes of LSA).
+        class_states (Dict[int, Dict[str, ndarray]]): The scoring state by class (0 for regression).
+        num_classes (int): The number of classes (1 for regression).
+        method (str): 'lsa' or 'dsa'.
+    """
+
+    def __init__(self,
+                 model: tf.keras.Model,
+                 input_spec: tf.TensorSpec,
+                 is_classification: bool,
+                 kept_columns: np.ndarray,
+                 class_states: Dict[int, Dict[str, np.ndarray]],
+                 num_classes: int,
+                 method: str) -> None:
+        super().__init__(name=f"{method}_scorer")
+        self.model = model
+        self.is_classification = is_classification
+        self.num_classes = num_classes
+        self.method = method
+        self.kept_columns = tf.Variable(np.asarray(kept_columns, dtype=np.int64), trainable=False, name="kept_columns")
+        # Variables instead of constants: They are saved with the weights, not in the graph (which is limited to 2 GB)
+        self.class_states = {str(label): {name: tf.Variable(array, trainable=False, name=f"{name}_{label}")
+                                          for name, array in state.items()}
+                             for label, state in class_states.items()}
+        self.serve = tf.function(self._serve, input_signature=[input_spec])
+
+    @classmethod
+    def from_sa(cls, sa: SurpriseAdequacy) -> 'SurpriseScorer':
+        """Creates the scorer of a prepared LSA (or subclass, e.g. `GaussianLSA`) or DSA (or subclass).
+
+        Raises:
+            ValueError: If the surprise adequacy is of another kind or not prepared, or for DSA on regression problems.
+        """
+        extractor = ActivationExtractor.get(sa.model, sa.config.layer_names, fuse_dim_reduction=True)
+        input_spec = tf.TensorSpec(shape=(None,) + tuple(sa.model.input.shape[1:]), dtype=extractor.input_dtype)
+        num_nodes = extractor.layout.num_nodes
+        num_classes = sa.config.num_classes if sa.config.is_classification else 1
+
+        if isinstance(sa, LSA):
+            if sa.kdes is None:
+                raise ValueError("LSA has not yet been prepared. Run lsa.prep()")
+            kept_columns = np.setdiff1d(np.arange(num_nodes), sa.removed_rows)
+            labels = sa.kdes.keys() if isinstance(sa.kdes, dict) else range(len(sa.kdes))
+            class_states = {label: _lsa_state(sa, label) for label in labels}
+            method = "lsa"
+        elif isinstance(sa, DSA):
+            if sa.train_ats is None or not sa.config.is_classification:
+                raise ValueError("DSA must be prepared (using prep()) and solve a classification problem")
+            kept_columns = np.arange(num_nodes)
+            class_states = _dsa_states(sa)
+            method = "dsa"
+        else:
+            raise ValueError(f"Unsupported surprise adequacy {sa.__class__.__name__}")
+
+        return cls(extractor.temp_model, input_spec, sa.config.is_classification, kept_columns, class_states,
+                   num_classes, method)
+
+    def _serve(self, inputs: tf.Tensor) -> Dict[str, tf.Tensor]:
+        outputs = self.model(inputs, training=False)
+        dnn_output = outputs[-1]
+        ats = tf.concat(outputs[:-1], axis=1)
+        ats = tf.gather(tf.cast(ats, tf.float64), self.kept_columns, axis=1)
+
+        if not self.is_classification:
+            return {"surprise": self._score_class(ats, 0), "prediction": dnn_output}
+
+        pred = tf.argmax(dnn_output, axis=1)
+        num_targets = tf.shape(ats)[0]
+        partitions = tf.clip_by_value(tf.cast(pred, tf.int32), 0, self.num_classes - 1)
+        class_rows = tf.dynamic_partition(tf.range(num_targets), partitions, self.num_classes)
+        class_surprises = [self._score_class(tf.gather(ats, rows), label) for label, rows in enumerate(class_rows)]
+        return {"surprise": tf.dynamic_stitch(class_rows, class_surprises), "prediction": pred}
+
+    def _score_class(self, ats: tf.Tensor, label: int) -> tf.Tensor:
+        state = self.class_states.get(str(label))
+        if state is None:
+            return tf.fill([tf.shape(ats)[0]], tf.constant(np.nan, dtype=tf.float64))
+        if self.method == "lsa":
+            return _lsa_graph(ats, state)
+        return _dsa_graph(ats, state)
+
+
+def export_scorer(sa: SurpriseAdequacy, path: str) -> SurpriseScorer:
+    """Saves the scorer of a prepared LSA or DSA (see `SurpriseScorer`) as a SavedModel.
+
+    The serving signature ('serving_default') takes a batch of model inputs ('inputs')
+    and returns the surprise ('surprise', float64) and the prediction ('prediction': The predicted class,
+    or the output of the model for regression problems) of every input.
+
+    Args:
+        sa (SurpriseAdequacy): The prepared LSA or DSA.
+        path (str): The directory of the SavedModel.
+
+    Returns:
+        The exported scorer.
+    """
+    scorer = SurpriseScorer.from_sa(sa)
+    tf.saved_model.save(scorer, path, signatures={"serving_default": scorer.serve.get_concrete_function()})
+    return scorer
+
+
+def _lsa_state(lsa: LSA, label: int) -> Dict[str, np.ndarray]:
+    """The arrays of the kde (and projection) of the label"""
+    kde = lsa.kdes[label]
+    if isinstance(kde, gaussian_kde):
+        kde = GaussianKDE.from_scipy(kde)
+    state = {name: np.asarray(array, dtype=np.float64) for name, array in kde.state().items()}
+    state["log_norm"] = np.asarray(kde.log_norm, dtype=np.float64)
+    projection = lsa.projections.get(label, lsa.projections.get(None))
+    if projection is not None:
+        state.update(projection_mean=projection.mean, projection_components=projection.components)
+    return state
+
+
+def _lsa_graph(ats: tf.Tensor, state: Dict[str, tf.Variable]) -> tf.Tensor:
+    """-logpdf of the ats (Shape of num_targets * num_nodes), as `GaussianKDE.logpdf` with the projection of `LSA`"""
+    if "projection_mean" in state:
+        ats = tf.matmul(ats - state["projection_mean"], state["projection_components"], transpose_b=True)
+    centered = tf.transpose(ats - state["center"])
+    whitened = tf.transpose(tf.linalg.triangular_solve(state["cho_cov"], centered, lower=True))
+    sq_dists = (tf.reduce_sum(tf.square(whitened), axis=1)[:, None] + state["data_sq_norms"][None, :]
+                - 2 * tf.matmul(whitened, state["whitened_data"], transpose_b=True))
+    args = state["log_weights"][None, :] - 0.5 * tf.maximum(sq_dists, 0)
+    return state["log_norm"] - tf.reduce_logsumexp(args, axis=1)
+
+
+def _dsa_states(dsa: DSA) -> Dict[int, Dict[str, np.ndarray]]:
+    """The train ats of every class, with the distance of each to the nearest train at of the other classes"""
+    states = dict()
+    for label in dsa.class_index.labels:
+        class_ats = dsa._train_ats_rows(dsa.class_index.rows(label)).astype(np.float64)
+        other_ats = np.concatenate([dsa._train_ats_rows(rows) for rows in dsa.class_index.other_rows(label)])
+        if other_ats.shape[0] == 0:
+            other_class_dists = np.full(shape=class_ats.shape[0], fill_value=np.inf)
+        else:
+            other_class_dists = _nearest_distances(class_ats, other_ats.astype(np.float64))
+        states[int(label)] = {"ats": class_ats,
+                              "sq_norms": np.sum(class_ats ** 2, axis=1),
+                              "other_class_dists": other_class_dists}
+    return states
+
+
+def _nearest_distances(points: np.ndarray, candidates: np.ndarray,
+                       max_tile_elements: int = DEFAULT_MAX_TILE_ELEMENTS) -> np.ndarray:
+    """The euclidean distance of every point to its nearest candidate, in tiles of bounded size"""
+    candidate_sq_norms = np.sum(candidates ** 2, axis=1)
+    tile = int(max(1, max_tile_elements // candidates.shape[0]))
+    result: List[np.ndarray] = []
+    for start in range(0, points.shape[0], tile):
+        block = points[start:start + tile]
+        sq_dists = np.sum(block ** 2, axis=1)[:, None] + candidate_sq_norms[None, :] - 2 * block @ candidates.T
+        result.append(np.sqrt(np.maximum(np.min(sq_dists, axis=1), 0)))
+    return np.concatenate(result)
+
+
+def _dsa_graph(ats: tf.Tensor, state: Dict[str, tf.Variable]) -> tf.Tensor:
+    """DSA of the ats (Shape of num_targets * num_nodes), as `DSA._dsa_distances`"""
+    sq_dists = (tf.reduce_sum(tf.square(ats), axis=1)[:, None] + state["sq_norms"][None, :]
+                - 2 * tf.matmul(ats, state["ats"], transpose_b=True))
+    closest = tf.argmin(sq_dists, axis=1)
+    a_dists = tf.sqrt(tf.maximum(tf.reduce_min(sq_dists, axis=1), 0))
+    return a_dists / tf.gather(state["other_class_dists"], closest)
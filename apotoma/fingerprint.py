@@ -0,0 +1,90 @@
+import hashlib
+import threading
+import weakref
+from typing import Dict, Tuple, Any
+
+import numpy as np
+import tensorflow as tf
+
+# Number of bytes hashed at once, such that large (e.g. memory mapped) arrays are never copied as a whole
+_HASH_CHUNK_BYTES = 64 * 1024 * 1024
+
+_array_fingerprints: Dict[Tuple, Tuple[weakref.ref, str]] = dict()
+_array_fingerprints_lock = threading.Lock()
+
+
+def owning_array(array: np.ndarray) -> np.ndarray:
+    """Follows the chain of views to the array which owns the memory of the passed array"""
+    root = array
+    while isinstance(root.base, np.ndarray):
+        root = root.base
+    return root
+
+
+def memory_address(array: np.ndarray) -> int:
+    return array.__array_interface__['data'][0]
+
+
+def combine_fingerprints(*parts: Any) -> str:
+    """Combines fingerprints (or any other values with a stable string representation) into a new fingerprint"""
+    h = hashlib.blake2b(digest_size=10)
+    for part in parts:
+        h.update(repr(part).encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+def _hash_array(array: np.ndarray, h: 'hashlib._Hash') -> None:
+    h.update(repr((array.shape, array.dtype.str)).encode("utf-8"))
+    if array.ndim == 0 or array.shape[0] == 0:
+        h.update(np.ascontiguousarray(array).tobytes())
+        return
+    row_bytes = max(1, array[0].nbytes)
+    rows_per_chunk = max(1, _HASH_CHUNK_BYTES // row_bytes)
+    for start in range(0, array.shape[0], rows_per_chunk):
+        h.update(np.ascontiguousarray(array[start:start + rows_per_chunk]).tobytes())
+
+
+def array_fingerprint(array: np.ndarray) -> str:
+    """Content fingerprint of a numpy array (including its shape and dtype).
+
+    Hashing a large dataset is not free. Fingerprints are thus memoized for as long as the memory of the array
+    is alive, which implies that arrays must not be modified in place after they were fingerprinted.
+    """
+    root = owning_array(array)
+    identity = (id(root), memory_address(array), array.shape, array.strides, array.dtype.str)
+    with _array_fingerprints_lock:
+        memoized = _array_fingerprints.get(identity)
+        if memoized is not None and memoized[0]() is root:
+            return memoized[1]
+
+    h = hashlib.blake2b(digest_size=10)
+    _hash_array(array, h)
+    fingerprint = h.hexdigest()
+
+    with _array_fingerprints_lock:
+        for key in [k for k, v in _array_fingerprints.items() if v[0]() is None]:
+            del _array_fingerprints[key]
+        _array_fingerprints[identity] = (weakref.ref(root), fingerprint)
+    return fingerprint
+
+
+def _model_architecture(model: tf.keras.Model) -> str:
+    try:
+        return model.to_json()
+    except NotImplementedError:
+        # Subclassed models without a config (in older tensorflow versions): Their layers only
+        return repr([layer.name for layer in model.layers])
+
+
+def model_fingerprint(model: tf.keras.Model) -> str:
+    """Content fingerprint of the architecture (see `tf.keras.Model.to_json`), layers and weights of a keras model.
+
+    Not memoized, as weights may change: Surprise adequacies fingerprint their model once (see `ATExtraction`).
+    """
+    h = hashlib.blake2b(digest_size=10)
+    h.update(_model_architecture(model).encode("utf-8"))
+    h.update(repr([layer.name for layer in model.layers]).encode("utf-8"))
+    for weights in model.get_weights():
+        _hash_array(np.asarray(weights), h)
+    return h.hexdigest()
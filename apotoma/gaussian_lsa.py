@@ -0,0 +1,29 @@
+import numpy as np
+
+from apotoma.class_stats import kde_data_covariance
+from apotoma.kde import GaussianKDE
+from apotoma.surprise_adequacy import LSA
+
+
+class GaussianLSA(LSA):
+    """Parametric variant of LSA: The ats of every class are modelled by a single (multivariate) gaussian
+    instead of a kernel density estimate.
+
+    The class grouping, variance filtering, projection, caching and scoring API are the ones of `LSA`,
+    only the density of a class is replaced: The gaussian with the mean and covariance of the (refined) class ats.
+    Its log density is the (negated, halved) squared mahalanobis distance to the class mean plus the normalization
+    by the log-determinant of the covariance, evaluated using the precomputed cholesky factor of the covariance.
+    The cost per target is thus O(num_nodes^2), independent of the number of train ats.
+
+    The gaussians are represented as `GaussianKDE`s with a single point (the mean) whose kernel is the class
+    covariance, such that they are saved and loaded like the kdes of LSA.
+    The kde related config (`kde_backend`, `kde_coreset_size`, ...) is ignored.
+    """
+
+    def _fit_density(self, refined_ats: np.ndarray, label: int):
+        # A single point, which is not a train at (see `_kde_train_lsa`)
+        self.kdes_on_train_ats[label] = False
+        data_covariance = kde_data_covariance(refined_ats)
+        mean = np.mean(refined_ats, axis=1, dtype=np.float64)
+        # The cholesky factor of the covariance is computed once, here
+        return GaussianKDE(mean[:, np.newaxis], covariance=data_covariance)
@@ -0,0 +1,121 @@
+import queue
+import threading
+from typing import Union, Iterable, Iterator, Optional, Callable
+
+import numpy as np
+import tensorflow as tf
+
+# Inputs accepted as train or target data by surprise adequacy:
+#   - numpy arrays (including memory mapped arrays, which are read batch by batch),
+#   - batched tf.data.Datasets (of inputs, or of tuples whose first element are the inputs),
+#   - any other iterable of input batches (e.g. python generators, which can be consumed only once).
+InputData = Union[np.ndarray, tf.data.Dataset, Iterable[np.ndarray]]
+
+
+def is_in_memory_array(data: InputData) -> bool:
+    return isinstance(data, np.ndarray) and not isinstance(data, np.memmap)
+
+
+def _inputs_of(batch):
+    """Strips labels (or sample weights) from a batch, as typically present in tf.data datasets"""
+    if isinstance(batch, (tuple, list)):
+        return batch[0]
+    return batch
+
+
+def prefetch(iterable: Iterable, depth: int) -> Iterator:
+    """Iterates over the passed iterable in a background thread, keeping up to `depth` items ready.
+    Exceptions raised by the iterable are re-raised to the consumer."""
+    items = queue.Queue(maxsize=depth)
+    stopped = threading.Event()
+    done = object()
+
+    def produce():
+        try:
+            for item in iterable:
+                while not stopped.is_set():
+                    try:
+                        items.put((item, None), timeout=0.1)
+                        break
+                    except queue.Full:
+                        pass
+                if stopped.is_set():
+                    return
+            items.put((done, None))
+        except BaseException as e:
+            items.put((None, e))
+
+    threading.Thread(target=produce, daemon=True).start()
+    try:
+        while True:
+            item, error = items.get()
+            if error is not None:
+                raise error
+            if item is done:
+                return
+            yield item
+    finally:
+        # Also reached if the consumer stops early, releasing a potentially blocked producer
+        stopped.set()
+
+
+def iterate_batches(data: InputData, batch_size: int, prefetch_batches: int = 2) -> Iterator:
+    """Iterates over the input batches of any supported input data.
+
+    Args:
+        data: The input data (see `InputData`). tf.data datasets and iterables must already be batched.
+        batch_size: Batch size used to split numpy arrays.
+        prefetch_batches: Number of batches prepared in the background while the model processes the current one.
+
+    Returns:
+        An iterator of batches of inputs (numpy arrays or tensors).
+    """
+    if isinstance(data, tf.data.Dataset):
+        # Parallel preprocessing is configured on the dataset itself, e.g. with `map(..., num_parallel_calls)`
+        return (_inputs_of(batch) for batch in data.prefetch(prefetch_batches))
+    if isinstance(data, np.ndarray):
+        batches = (data[start:start + batch_size] for start in range(0, data.shape[0], batch_size))
+        if is_in_memory_array(data):
+            return batches
+        # Read the next batch from disk while the current one is processed
+        return prefetch((np.asarray(b) for b in batches), depth=prefetch_batches)
+    return prefetch((_inputs_of(batch) for batch in data), depth=prefetch_batches)
+
+
+def num_samples_of(data: InputData) -> Optional[int]:
+    """The number of samples in the input data, or None if not known without iterating over it"""
+    if isinstance(data, np.ndarray):
+        return data.shape[0]
+    return None
+
+
+def array_dataset(array: np.ndarray,
+                  batch_size: int,
+                  preprocess: Optional[Callable[[tf.Tensor], tf.Tensor]] = None,
+                  num_parallel_calls: int = tf.data.experimental.AUTOTUNE) -> tf.data.Dataset:
+    """Creates a batched tf.data.Dataset reading and preprocessing batches of a (e.g. memory mapped) array
+    in parallel, without ever materializing the whole array in memory.
+
+    Args:
+        array: The raw inputs, typically a `np.memmap` or an array loaded with `np.load(..., mmap_mode='r')`.
+        batch_size: The batch size.
+        preprocess: Optional tensorflow function applied to every batch (e.g. normalization).
+        num_parallel_calls: Number of batches read and preprocessed in parallel.
+
+    Returns:
+        A dataset which can be passed as train_data or target_data to any surprise adequacy.
+    """
+    num_batches = int(np.ceil(array.shape[0] / batch_size))
+
+    def read_batch(i):
+        return np.asarray(array[i * batch_size:(i + 1) * batch_size])
+
+    def load(i):
+        batch = tf.numpy_function(read_batch, [i], tf.as_dtype(array.dtype))
+        batch.set_shape((None,) + array.shape[1:])
+        return batch
+
+    dataset = tf.data.Dataset.range(num_batches).map(load, num_parallel_calls=num_parallel_calls)
+    if preprocess is not None:
+        dataset = dataset.map(preprocess, num_parallel_calls=num_parallel_calls)
+    return dataset
@@ -0,0 +1,346 @@
+from typing import Optional, Tuple, List, Dict
+
+import numpy as np
+from dataclasses import dataclass
+from scipy import linalg
+from scipy.stats import gaussian_kde
+
+# 'scipy': scipy.stats.gaussian_kde, 'native': `GaussianKDE` (same estimate, faster evaluation)
+KDE_BACKENDS = ('scipy', 'native')
+
+# Methods to select the points of a coreset kde, see `fit_coreset_kde`
+CORESET_METHODS = ('random', 'kmeans', 'herding')
+
+# Upper bound on the number of elements of a (target x train) distance tile, i.e., 32 MB in float64
+DEFAULT_MAX_TILE_ELEMENTS = 2 ** 22
+
+
+class GaussianKDE:
+    """Gaussian kernel density estimate, with a log density evaluation optimized for many (train and target) points.
+
+    The estimate is the same as the one of `scipy.stats.gaussian_kde` (use `from_scipy` to convert one),
+    but the evaluation of `logpdf` is different:
+    The data is whitened once (using the cholesky factor of the kernel covariance),
+    the squared mahalanobis distances between targets and train points are calculated using matrix products
+    (i.e., BLAS GEMM) in tiles of bounded size, and reduced with a streaming log-sum-exp,
+    such that the full (train x target) kernel matrix is never materialized.
+
+    Args:
+        dataset (ndarray): The data points (Shape of num_dims * num_points, as in scipy).
+        covariance (ndarray): The kernel covariance (Shape of num_dims * num_dims).
+        weights (ndarray): Optional weights of the data points. Default: Uniform weights.
+        cho_cov (ndarray): Optional (lower) cholesky factor of the covariance, if already known.
+        dtype: Precision of the distance calculation. float64 (default) matches scipy.
+        max_tile_elements (int): Upper bound on the number of elements of a distance tile.
+    """
+
+    def __init__(self,
+                 dataset: np.ndarray,
+                 covariance: np.ndarray,
+                 weights: Optional[np.ndarray] = None,
+                 cho_cov: Optional[np.ndarray] = None,
+                 dtype=np.float64,
+                 max_tile_elements: int = DEFAULT_MAX_TILE_ELEMENTS) -> None:
+        dataset = np.atleast_2d(dataset)
+        self.d, self.n = dataset.shape
+        self.dtype = np.dtype(dtype)
+
+        if weights is None:
+            weights = np.full(shape=self.n, fill_value=1 / self.n)
+        weights = np.asarray(weights, dtype=np.float64)
+        self.log_weights = np.log(weights / np.sum(weights))
+
+        self.covariance = np.atleast_2d(covariance).astype(np.float64)
+        if cho_cov is None:
+            cho_cov = linalg.cholesky(self.covariance, lower=True)
+        # Euclidean distances of points whitened with the cholesky factor are mahalanobis distances
+        self.cho_cov = np.asarray(cho_cov, dtype=np.float64)
+        # Normalization of the gaussian kernel: log(sqrt(det(2 * pi * covariance)))
+        self.log_norm = 0.5 * self.d * np.log(2 * np.pi) + np.sum(np.log(np.diag(self.cho_cov)))
+        # Centering the data reduces the cancellation in the expansion of the squared distances
+        self.center = np.mean(dataset, axis=1, dtype=np.float64)
+
+        self.whitened_data = self._whiten(dataset)
+        self.data_sq_norms = np.sum(self.whitened_data.astype(np.float64) ** 2, axis=1)
+        self._init_evaluation(max_tile_elements)
+
+    # Arrays which (together with log_norm) fully define the fitted estimate, see `state` and `from_state`
+    STATE_ARRAYS = ('whitened_data', 'data_sq_norms', 'log_weights', 'covariance', 'cho_cov', 'center')
+
+    def state(self) -> Dict[str, np.ndarray]:
+        """The arrays defining the estimate, e.g. to be saved (see `apotoma.kde_artifacts`)"""
+        return {name: getattr(self, name) for name in self.STATE_ARRAYS}
+
+    @classmethod
+    def from_state(cls, arrays: Dict[str, np.ndarray], log_norm: float, **kwargs) -> 'GaussianKDE':
+        """Re-creates an estimate from its `state` arrays (which may be memory mapped) without any re-computation.
+
+        Args:
+            arrays (Dict[str, ndarray]): The arrays returned by `state`.
+            log_norm (float): The normalization of the kernel (`log_norm` attribute of the saved estimate).
+            **kwargs: max_tile_elements (and the other evaluation parameters of subclasses).
+        """
+        kde = cls.__new__(cls)
+        for name in cls.STATE_ARRAYS:
+            setattr(kde, name, arrays[name])
+        kde.n, kde.d = kde.whitened_data.shape
+        kde.dtype = kde.whitened_data.dtype
+        kde.log_norm = log_norm
+        kde._init_evaluation(**kwargs)
+        return kde
+
+    def _init_evaluation(self, max_tile_elements: int = DEFAULT_MAX_TILE_ELEMENTS) -> None:
+        self.max_tile_elements = max_tile_elements
+
+    @classmethod
+    def from_scipy(cls, kde: gaussian_kde, **kwargs) -> 'GaussianKDE':
+        """Creates the estimate with the data, covariance (bandwidth) and weights of a scipy kde"""
+        # Re-using scipy's cholesky factor (if available) keeps the results close to scipy's for ill-conditioned data
+        return cls(kde.dataset, kde.covariance, getattr(kde, 'weights', None), getattr(kde, 'cho_cov', None), **kwargs)
+
+    @classmethod
+    def from_data_covariance(cls, dataset: np.ndarray, data_covariance: np.ndarray, **kwargs) -> 'GaussianKDE':
+        """Creates the estimate with scott's bandwidth (scipy's default) for a dataset whose covariance is known
+        (e.g. from `class_stats.kde_data_covariance`), without re-calculating it.
+        The bandwidth is calculated exactly as by scipy, i.e., the estimate is the one of `gaussian_kde(dataset)`.
+
+        Args:
+            dataset (ndarray): The data points (Shape of num_dims * num_points, as in scipy).
+            data_covariance (ndarray): The covariance of the data points (see `class_stats.kde_data_covariance`).
+            **kwargs: The evaluation parameters (e.g. max_tile_elements).
+        """
+        dataset = np.atleast_2d(dataset)
+        num_dims, num_points = dataset.shape
+        neff = 1 / np.sum((np.ones(num_points) / num_points) ** 2)
+        factor = np.power(neff, -1. / (num_dims + 4))
+        data_cho_cov = linalg.cholesky(np.atleast_2d(data_covariance), lower=True)
+        return cls(dataset, data_covariance * factor ** 2, cho_cov=(data_cho_cov * factor).astype(np.float64), **kwargs)
+
+    def _whiten(self, points: np.ndarray) -> np.ndarray:
+        """Whitened points (Shape of num_points * num_dims, i.e., transposed)"""
+        centered = np.asarray(points, dtype=np.float64) - self.center[:, None]
+        return np.ascontiguousarray(linalg.solve_triangular(self.cho_cov, centered, lower=True).T, dtype=self.dtype)
+
+    def unwhiten(self, whitened_points: np.ndarray) -> np.ndarray:
+        """Inverse of the whitening: Points in the original space (Shape of num_dims * num_points, as in scipy)"""
+        return self.cho_cov @ np.asarray(whitened_points, dtype=np.float64).T + self.center[:, None]
+
+    def logpdf(self, points: np.ndarray) -> np.ndarray:
+        """Evaluates the log of the estimated pdf (same interface as `scipy.stats.gaussian_kde.logpdf`).
+
+        Args:
+            points (ndarray): The points to evaluate (Shape of num_dims * num_points).
+
+        Returns:
+            The log density of every point (Shape of num_points).
+        """
+        points = np.atleast_2d(points)
+        if points.shape[0] != self.d:
+            if points.shape[0] == 1 and points.shape[1] == self.d:
+                # points was passed in as a row vector
+                points = points.T
+            else:
+                raise ValueError(f"points have dimension {points.shape[0]}, dataset has dimension {self.d}")
+
+        return self.log_kernel_sums(self._whiten(points)) - self.log_norm
+
+    def log_kernel_sums(self, whitened_points: np.ndarray) -> np.ndarray:
+        """log(sum_i w_i * exp(-0.5 * |x - x_i|^2)) of already whitened points (Shape of num_points * num_dims),
+        i.e., the log density without the normalization of the kernel"""
+        return self._log_kernel_sums(whitened_points, leave_out=False)
+
+    def self_log_kernel_sums(self, leave_one_out: bool = True) -> np.ndarray:
+        """`log_kernel_sums` of the data points themselves (in the order of the data), re-using their whitened data.
+
+        If leave_one_out is set, the kernel of every data point is excluded from its own sum
+        (exactly, i.e., it is never added, rather than subtracted afterwards), and the weights of the other points
+        are re-normalized: Every point is evaluated by the estimate of the remaining points,
+        with the kernel covariance of the full estimate.
+
+        Args:
+            leave_one_out (bool): Whether to exclude the own kernel of every data point.
+
+        Returns:
+            The log kernel sum of every data point (Shape of num_points).
+        """
+        if not leave_one_out:
+            return self._log_kernel_sums(self.whitened_data, leave_out=False)
+        if self.n < 2:
+            raise ValueError(f"Leave-one-out estimates need at least two data points, but there are {self.n}")
+        # The remaining weights sum up to 1 - w_i
+        return self._log_kernel_sums(self.whitened_data, leave_out=True) - np.log1p(-np.exp(self.log_weights))
+
+    def _log_kernel_sums(self, whitened_points: np.ndarray, leave_out: bool) -> np.ndarray:
+        """`log_kernel_sums` in tiles. If leave_out is set, the points are the data points (in order),
+        and the kernel of every point is excluded from its own sum."""
+        num_points = whitened_points.shape[0]
+        result = np.empty(shape=num_points, dtype=np.float64)
+
+        # Tiles of (target_tile x train_tile) elements, preferring long train tiles
+        train_tile = int(min(self.n, max(1, self.max_tile_elements // 64)))
+        target_tile = int(max(1, self.max_tile_elements // train_tile))
+        for start in range(0, num_points, target_tile):
+            result[start:start + target_tile] = self._logsumexp_kernels(whitened_points[start:start + target_tile],
+                                                                        train_tile,
+                                                                        data_offset=start if leave_out else None)
+        return result
+
+    def _logsumexp_kernels(self,
+                           whitened_points: np.ndarray,
+                           train_tile: int,
+                           data_offset: Optional[int] = None) -> np.ndarray:
+        """log(sum_i w_i * exp(-0.5 * |x - x_i|^2)) of the whitened points, streamed over tiles of train points.
+        If data_offset is passed, the points are the data points from this offset on, whose own kernels are excluded."""
+        num_points = whitened_points.shape[0]
+        points_sq_norms = np.sum(whitened_points.astype(np.float64) ** 2, axis=1)
+        running_max = np.full(shape=num_points, fill_value=-np.inf)
+        running_sum = np.zeros(shape=num_points)
+        # Buffers of a single tile, allocated once per call (i.e., never shared between threads), re-used by all tiles
+        sq_dists_buffer = np.empty(shape=(num_points, train_tile),
+                                   dtype=np.result_type(whitened_points.dtype, self.whitened_data.dtype))
+        args_buffer = np.empty(shape=(num_points, train_tile), dtype=np.float64)
+        for start in range(0, self.n, train_tile):
+            stop = min(start + train_tile, self.n)
+            sq_dists, args = sq_dists_buffer[:, :stop - start], args_buffer[:, :stop - start]
+            # Squared distances |x|^2 + |x_i|^2 - 2 x.x_i, with the cross term as a single GEMM
+            np.matmul(whitened_points, self.whitened_data[start:stop].T, out=sq_dists)
+            sq_dists *= -2
+            sq_dists += points_sq_norms[:, None]
+            sq_dists += self.data_sq_norms[None, start:stop]
+            np.maximum(sq_dists, 0, out=sq_dists)
+
+            # log_weights - 0.5 * sq_dists
+            np.multiply(sq_dists, -0.5, out=args)
+            args += self.log_weights[None, start:stop]
+            if data_offset is not None:
+                # The (partial) diagonal of the tile: Data rows which are both a point and in the tile
+                rows = np.arange(max(start, data_offset), min(stop, data_offset + num_points))
+                args[rows - data_offset, rows - start] = -np.inf
+            tile_max = np.max(args, axis=1)
+            new_max = np.maximum(running_max, tile_max)
+            # Points without any (non-excluded) kernel so far are shifted by 0 instead of -inf
+            shift = np.where(np.isneginf(new_max), 0, new_max)
+            running_sum *= np.exp(running_max - shift)
+            args -= shift[:, None]
+            running_sum += np.sum(np.exp(args, out=args), axis=1)
+            running_max = new_max
+        return running_max + np.log(running_sum)
+
+
+@dataclass(frozen=True)
+class CoresetReport:
+    """Accuracy of a coreset kde, measured on held out points (see `fit_coreset_kde`).
+
+    Args:
+        method (str): The coreset method.
+        num_points (int): The number of points of the full kde.
+        coreset_size (int): The number of (weighted) points of the coreset kde.
+        holdout_size (int): The number of held out points on which the error was measured.
+        mean_abs_error (float): Mean absolute difference between the log densities of full and coreset kde.
+        max_abs_error (float): Maximum absolute difference between the log densities of full and coreset kde.
+    """
+
+    method: str
+    num_points: int
+    coreset_size: int
+    holdout_size: int
+    mean_abs_error: float
+    max_abs_error: float
+
+
+def fit_coreset_kde(dataset: np.ndarray,
+                    coreset_size: int,
+                    method: str = 'kmeans',
+                    holdout_size: int = 200,
+                    seed: int = 0) -> Tuple[GaussianKDE, Optional[CoresetReport]]:
+    """Fits a kde on a weighted coreset of the dataset, approximating the kde of the full dataset.
+
+    The kernel covariance (bandwidth) is the one of the full dataset (as calculated by scipy),
+    only the points (and their weights) are replaced by the coreset:
+        - 'random': A uniform random sample, with uniform weights.
+        - 'kmeans': The k-means centroids (clustered in the whitened space), weighted by their cluster sizes.
+        - 'herding': Points selected by kernel herding (greedily matching the mean kernel embedding
+        of the full dataset), with uniform weights.
+
+    To report the approximation error, `holdout_size` points (at most a tenth of the dataset) are held out.
+    The coreset is selected from the remaining points, and its log densities on the held out points
+    are compared to the ones of the kde of all remaining points.
+
+    Args:
+        dataset (ndarray): The data points (Shape of num_dims * num_points, as in scipy).
+        coreset_size (int): Number of points of the coreset.
+        method (str): One of `CORESET_METHODS`.
+        holdout_size (int): Max. number of held out points used to measure the approximation error.
+        seed (int): Seed for the random selection of holdout and coreset.
+
+    Returns:
+        The coreset kde, and the report of its approximation error
+        (None, if the dataset is not larger than the coreset, in which case the full kde is returned).
+    """
+    if method not in CORESET_METHODS:
+        raise ValueError(f"Unsupported coreset method {method}. Supported: {CORESET_METHODS}")
+    full_kde = gaussian_kde(dataset)
+    num_points = full_kde.n
+    if num_points <= coreset_size:
+        return GaussianKDE.from_scipy(full_kde), None
+
+    rng = np.random.RandomState(seed)
+    permutation = rng.permutation(num_points)
+    holdout_size = min(holdout_size, num_points // 10, num_points - coreset_size)
+    holdout, remaining = permutation[:holdout_size], np.sort(permutation[holdout_size:])
+
+    # The cholesky factor of scipy's kde is only available as of scipy 1.10 (see `GaussianKDE.from_scipy`)
+    cho_cov = getattr(full_kde, 'cho_cov', None)
+    if cho_cov is None:
+        cho_cov = linalg.cholesky(full_kde.covariance, lower=True)
+
+    remaining_points = full_kde.dataset[:, remaining]
+    reference_kde = GaussianKDE(remaining_points, full_kde.covariance, cho_cov=cho_cov)
+    if method == 'random':
+        points, weights = remaining_points[:, rng.choice(remaining.shape[0], size=coreset_size, replace=False)], None
+    elif method == 'kmeans':
+        points, weights = _kmeans_coreset(reference_kde, coreset_size, seed)
+    else:
+        points, weights = remaining_points[:, _herding_coreset(reference_kde, coreset_size)], None
+
+    coreset_kde = GaussianKDE(points, full_kde.covariance, weights, cho_cov=cho_cov)
+
+    report = None
+    if holdout_size > 0:
+        holdout_points = full_kde.dataset[:, holdout]
+        errors = np.abs(coreset_kde.logpdf(holdout_points) - reference_kde.logpdf(holdout_points))
+        report = CoresetReport(method=method, num_points=num_points, coreset_size=coreset_size,
+                               holdout_size=holdout_size, mean_abs_error=float(np.mean(errors)),
+                               max_abs_error=float(np.max(errors)))
+    return coreset_kde, report
+
+
+def _kmeans_coreset(kde: GaussianKDE, coreset_size: int, seed: int) -> Tuple[np.ndarray, np.ndarray]:
+    # Optional dependency, only needed for kmeans coresets
+    from sklearn.cluster import KMeans
+    # Clustering in the whitened space, where the kernel is isotropic
+    kmeans = KMeans(n_clusters=coreset_size, n_init=1, random_state=seed).fit(kde.whitened_data.astype(np.float64))
+    weights = np.bincount(kmeans.labels_, minlength=coreset_size).astype(np.float64)
+    non_empty = weights > 0
+    return kde.unwhiten(kmeans.cluster_centers_[non_empty]), weights[non_empty]
+
+
+def _herding_coreset(kde: GaussianKDE, coreset_size: int) -> List[int]:
+    """Kernel herding: x_t+1 = argmax_x (mu(x) - 1 / (t + 1) * sum_s<=t k(x, x_s)), amongst the kde points,
+    where mu is the kde's density (i.e., the mean kernel embedding of its points).
+    Returns the indexes of the selected points."""
+    whitened = kde.whitened_data.astype(np.float64)
+    log_mu = kde.log_kernel_sums(kde.whitened_data) - kde.log_norm
+    # Both terms are scaled by exp(-max log mu), which avoids underflows in high dimensions
+    scale = np.max(log_mu)
+    mu = np.exp(log_mu - scale)
+    kernel_sums = np.zeros(shape=whitened.shape[0])
+    selected = []
+    for t in range(coreset_size):
+        objective = mu - kernel_sums / (t + 1)
+        objective[selected] = -np.inf
+        chosen = int(np.argmax(objective))
+        selected.append(chosen)
+        sq_dists = np.sum((whitened - whitened[chosen]) ** 2, axis=1)
+        kernel_sums += np.exp(-0.5 * sq_dists - kde.log_norm - scale)
+    return selected
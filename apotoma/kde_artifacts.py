@@ -0,0 +1,176 @@
+import json
+import os
+import shutil
+import tempfile
+from typing import Dict, List, Tuple, Union, Optional
+
+import numpy as np
+from scipy.stats import gaussian_kde
+
+from apotoma.kde import GaussianKDE
+from apotoma.projection import PCAProjection
+
+# Version of the layout of saved kdes. Artifacts of other versions are not loaded (but re-created).
+KDE_FORMAT_VERSION = 2
+
+MANIFEST_FILE = "manifest.json"
+
+Kdes = Union[Dict[int, Union[gaussian_kde, GaussianKDE]], List[Union[gaussian_kde, GaussianKDE]]]
+
+# Projections of the ats before the kdes, by label (None for a projection shared by all kdes)
+Projections = Dict[Optional[int], PCAProjection]
+
+
+def save_kdes(path: str, kdes: Kdes, removed_rows: List[int], projections: Optional[Projections] = None,
+              kdes_on_train_ats: Optional[Dict[int, bool]] = None) -> None:
+    """Saves the kdes of an LSA (and its removed rows) as a directory of .npy files and a json manifest.
+
+    Every kde is stored as the arrays of its (native) state, see `GaussianKDE.state`:
+    The whitened data, the cholesky factor of the kernel covariance, the weights, etc.,
+    and its normalization constant in the manifest. Scipy kdes are converted to native ones before.
+
+    The directory is written under a unique temporary name (per call, such that concurrent writers
+    never write into the same files) and swapped in once complete (see `_replace_directory`),
+    such that concurrent readers never see partially written artifacts.
+
+    Args:
+        path (str): The directory to create (replaced, if it exists).
+        kdes (Dict[int, kde] or List[kde]): The kdes by label (classification) or as a list (regression).
+        removed_rows (List[int]): The rows of the ats ignored by the kdes.
+        projections (Dict[int, PCAProjection]): Optional projections of the ats (see `LSA.projections`).
+        kdes_on_train_ats (Dict[int, bool]): Whether the kdes were fitted on all train ats of their class
+        (see `LSA.kdes_on_train_ats`). Default: False for all kdes.
+    """
+    path = os.path.normpath(path)
+    parent = os.path.dirname(path) or os.curdir
+    os.makedirs(parent, exist_ok=True)
+    tmp_path = tempfile.mkdtemp(prefix=os.path.basename(path) + ".", suffix=".tmp", dir=parent)
+    try:
+        _write_kdes(tmp_path, kdes, removed_rows, projections, kdes_on_train_ats)
+        _replace_directory(tmp_path, path)
+    finally:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+def _write_kdes(tmp_path: str, kdes: Kdes, removed_rows: List[int], projections: Optional[Projections],
+                kdes_on_train_ats: Optional[Dict[int, bool]]) -> None:
+    """Writes the files of `save_kdes` into the (existing, empty) directory tmp_path"""
+
+    keys = list(kdes.keys()) if isinstance(kdes, dict) else list(range(len(kdes)))
+    entries = []
+    for key in keys:
+        kde = kdes[key]
+        if isinstance(kde, gaussian_kde):
+            kde = GaussianKDE.from_scipy(kde)
+        entry = {"key": int(key), "type": "native", "log_norm": float(kde.log_norm),
+                 "max_tile_elements": int(kde.max_tile_elements),
+                 "on_train_ats": bool((kdes_on_train_ats or dict()).get(key, False))}
+        for name, array in kde.state().items():
+            np.save(os.path.join(tmp_path, f"kde_{key}_{name}.npy"), np.asarray(array))
+        entries.append(entry)
+
+    projection_entries = []
+    for key, projection in (projections or dict()).items():
+        file_key = "shared" if key is None else int(key)
+        for name, array in projection.state().items():
+            np.save(os.path.join(tmp_path, f"projection_{file_key}_{name}.npy"), array)
+        projection_entries.append({"key": file_key, "explained_variance_ratio": projection.explained_variance_ratio})
+
+    manifest = {
+        "format_version": KDE_FORMAT_VERSION,
+        "container": "dict" if isinstance(kdes, dict) else "list",
+        "removed_rows": [int(row) for row in removed_rows],
+        "kdes": entries,
+        "projections": projection_entries,
+    }
+    with open(os.path.join(tmp_path, MANIFEST_FILE), "w") as file:
+        json.dump(manifest, file)
+
+
+def _replace_directory(tmp_path: str, path: str) -> None:
+    """Moves the directory tmp_path to path, replacing a directory at path.
+
+    A previous directory at path is renamed aside right before, and deleted only after the new one is renamed in,
+    i.e., it is never deleted while readers may still find it at path.
+    If another writer moves its directory to path in the meantime, that one is kept
+    (the artifacts at a path are equivalent) and tmp_path is left to be deleted by the caller.
+    """
+    old_path = tmp_path + ".old"
+    try:
+        os.rename(path, old_path)
+    except FileNotFoundError:
+        old_path = None
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        if not os.path.isdir(path):
+            raise
+    finally:
+        if old_path is not None:
+            shutil.rmtree(old_path, ignore_errors=True)
+
+
+def has_kdes(path: str) -> bool:
+    """True if path contains saved kdes of the current format version"""
+    manifest_path = os.path.join(path, MANIFEST_FILE)
+    if not os.path.exists(manifest_path):
+        return False
+    with open(manifest_path) as file:
+        return json.load(file).get("format_version") == KDE_FORMAT_VERSION
+
+
+def load_kdes(path: str, mmap: bool = True) -> Tuple[Kdes, List[int]]:
+    """Loads kdes saved by `save_kdes`, as native kdes (`GaussianKDE`).
+
+    Nothing is re-computed, and if mmap is set,
+    the arrays are memory mapped (read-only), such that they are read from disk only once they are used,
+    and processes loading the same artifacts share their page cache.
+
+    Args:
+        path (str): The directory written by `save_kdes`.
+        mmap (bool): Whether to memory map the arrays.
+
+    Returns:
+        The kdes (by label, or as a list) and the removed rows.
+
+    Raises:
+        ValueError: If the artifacts are of an unsupported format version.
+    """
+    with open(os.path.join(path, MANIFEST_FILE)) as file:
+        manifest = json.load(file)
+    if manifest.get("format_version") != KDE_FORMAT_VERSION:
+        raise ValueError(f"Unsupported kde format version {manifest.get('format_version')} "
+                         f"(expected {KDE_FORMAT_VERSION}) in {path}")
+
+    mmap_mode = 'r' if mmap else None
+    kdes = {}
+    for entry in manifest["kdes"]:
+        key = entry["key"]
+        arrays = {name: np.load(os.path.join(path, f"kde_{key}_{name}.npy"), mmap_mode=mmap_mode)
+                  for name in GaussianKDE.STATE_ARRAYS}
+        kdes[key] = GaussianKDE.from_state(arrays, entry["log_norm"], max_tile_elements=entry["max_tile_elements"])
+
+    if manifest["container"] == "list":
+        kdes = [kdes[key] for key in sorted(kdes.keys())]
+    return kdes, manifest["removed_rows"]
+
+
+def load_projections(path: str) -> Projections:
+    """Loads the projections saved by `save_kdes` (an empty dict, if there are none)"""
+    with open(os.path.join(path, MANIFEST_FILE)) as file:
+        manifest = json.load(file)
+    projections = dict()
+    for entry in manifest.get("projections", []):
+        file_key = entry["key"]
+        arrays = {name: np.load(os.path.join(path, f"projection_{file_key}_{name}.npy"))
+                  for name in ("mean", "components")}
+        projections[None if file_key == "shared" else file_key] = PCAProjection(
+            explained_variance_ratio=entry["explained_variance_ratio"], **arrays)
+    return projections
+
+
+def load_kdes_on_train_ats(path: str) -> Dict[int, bool]:
+    """Loads whether the kdes saved by `save_kdes` were fitted on all train ats of their class, by key"""
+    with open(os.path.join(path, MANIFEST_FILE)) as file:
+        manifest = json.load(file)
+    return {entry["key"]: entry["on_train_ats"] for entry in manifest["kdes"]}
@@ -0,0 +1,122 @@
+import multiprocessing
+import os
+import tempfile
+from typing import Callable, Dict, Sequence, Tuple, Union, Optional, List
+
+import numpy as np
+import tensorflow as tf
+
+from apotoma.fingerprint import model_fingerprint
+from apotoma.surprise_adequacy import ATExtraction, SurpriseAdequacyConfig
+
+# Set in every worker process by `_init_worker` (or in this process, if extracting sequentially)
+_worker_state = dict()
+
+
+def _init_worker(model_loader: Callable[[int], tf.keras.Model],
+                 config_factory: Callable[[int], SurpriseAdequacyConfig],
+                 dataset_paths: List[Tuple[str, str]],
+                 threads_per_process: int,
+                 use_gpu: bool) -> None:
+    tf.config.threading.set_intra_op_parallelism_threads(threads_per_process)
+    tf.config.threading.set_inter_op_parallelism_threads(threads_per_process)
+    if not use_gpu:
+        tf.config.set_visible_devices([], 'GPU')
+    _set_worker_state(model_loader, config_factory, dataset_paths)
+
+
+def _set_worker_state(model_loader: Callable[[int], tf.keras.Model],
+                      config_factory: Callable[[int], SurpriseAdequacyConfig],
+                      dataset_paths: List[Tuple[str, str]]) -> None:
+    _worker_state['model_loader'] = model_loader
+    _worker_state['config_factory'] = config_factory
+    _worker_state['dataset_paths'] = dataset_paths
+
+
+def _extract_for_model(model_id: int) -> Tuple[int, List[Tuple[List[str], str]]]:
+    model = _worker_state['model_loader'](model_id)
+    config = _worker_state['config_factory'](model_id)
+    # The model is hashed once, the datasets once per process (see `ATExtraction._fingerprints`)
+    extraction = ATExtraction(model=model, config=config, model_fingerprint=model_fingerprint(model))
+    saved_paths = []
+    for ds_type, path in _worker_state['dataset_paths']:
+        # All workers share the page-cached inputs
+        dataset = np.load(path, mmap_mode='r')
+        extraction._load_or_calculate_ats(dataset=dataset, ds_type=ds_type, use_cache=True)
+        layer_paths = [extraction._get_layer_saved_path(ds_type, dataset, name) for name in config.layer_names]
+        saved_paths.append((layer_paths, extraction._get_saved_path(ds_type, dataset)[1]))
+    return model_id, saved_paths
+
+
+def extract_ats_in_parallel(model_loader: Callable[[int], tf.keras.Model],
+                            model_ids: Sequence[int],
+                            config_factory: Callable[[int], SurpriseAdequacyConfig],
+                            datasets: Sequence[Tuple[str, Union[str, np.ndarray]]],
+                            num_processes: int,
+                            threads_per_process: Optional[int] = None,
+                            use_gpu: bool = False) -> Dict[int, List[Tuple[List[str], str]]]:
+    """Extracts the ATs of many models (e.g. of an ensemble) in parallel worker processes,
+    writing them into the (content-addressed) on-disk AT cache.
+
+    Surprise adequacies created afterwards with the same model, config and data
+    find the ATs in the cache when used with `use_cache=True`.
+    Only the layers whose ATs are not yet cached are extracted (models with all layers cached are not run at all).
+
+    Args:
+        model_loader: Loads the model with the passed id. Must be picklable (e.g. a module-level function),
+        as it is called in the worker processes.
+        model_ids: The ids of the models for which the ATs are extracted.
+        config_factory: Creates the SA config for the passed model id. Must be picklable as well.
+        datasets: Pairs of ds_type (e.g. 'train', 'test', as later passed to `calc`) and dataset.
+        Paths of .npy files are opened memory mapped in the workers.
+        Arrays are first written to a temporary .npy file (once for all workers).
+        num_processes: Number of worker processes. 0 extracts the ats of the models sequentially in this process
+        (as `num_processes=0` in uncertainty wizard), leaving its tensorflow threading and devices untouched.
+        threads_per_process: Tensorflow thread budget (intra- and inter-op) per worker.
+        Default: The number of cpus divided by the number of processes.
+        use_gpu: If false, workers are restricted to the CPU.
+
+    Returns:
+        The paths of the cached ats (one per layer) and predictions, keyed by model id
+        (in the order of the passed datasets).
+
+    Raises:
+        ValueError: If num_processes is negative.
+    """
+    if num_processes < 0:
+        raise ValueError(f"num_processes must not be negative, got {num_processes}")
+    if threads_per_process is None and num_processes > 0:
+        threads_per_process = max(1, multiprocessing.cpu_count() // num_processes)
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        dataset_paths = []
+        for i, (ds_type, dataset) in enumerate(datasets):
+            if isinstance(dataset, str):
+                dataset_paths.append((ds_type, dataset))
+            else:
+                path = os.path.join(temp_dir, f"{i}_{ds_type}.npy")
+                np.save(path, dataset)
+                dataset_paths.append((ds_type, path))
+
+        if num_processes == 0:
+            _set_worker_state(model_loader, config_factory, dataset_paths)
+            results = dict()
+            try:
+                for model_id in model_ids:
+                    _, results[model_id] = _extract_for_model(model_id)
+                    print(f"Extracted ATs of model {model_id}")
+            finally:
+                # The dataset paths are removed along with the temporary directory
+                _worker_state.clear()
+            return results
+
+        # Spawn (instead of fork) as tensorflow is not fork-safe once initialized in the parent process
+        context = multiprocessing.get_context("spawn")
+        with context.Pool(processes=num_processes,
+                          initializer=_init_worker,
+                          initargs=(model_loader, config_factory, dataset_paths, threads_per_process, use_gpu)) as pool:
+            results = dict()
+            for model_id, saved_paths in pool.imap_unordered(_extract_for_model, model_ids):
+                print(f"Extracted ATs of model {model_id}")
+                results[model_id] = saved_paths
+    return results
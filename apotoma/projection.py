@@ -0,0 +1,66 @@
+from typing import Union, Dict
+
+import numpy as np
+from dataclasses import dataclass
+
+
+@dataclass(frozen=True)
+class PCAProjection:
+    """Linear projection of activation traces onto their principal components.
+
+    Use `PCAProjection.fit` to create an instance for given ATs.
+
+    Args:
+        mean (ndarray): The mean of the ATs the projection was fitted on (Shape of num_nodes).
+        components (ndarray): The principal axes, ordered by decreasing variance (Shape of num_components * num_nodes).
+        explained_variance_ratio (float): Share of the total variance of the fitted ATs retained by the components.
+    """
+
+    mean: np.ndarray
+    components: np.ndarray
+    explained_variance_ratio: float
+
+    @classmethod
+    def fit(cls, ats: np.ndarray, num_components: Union[int, float]) -> 'PCAProjection':
+        """Fits the projection on the passed ATs.
+
+        Args:
+            ats (ndarray): The ATs (Shape of num_examples * num_nodes).
+            num_components (int, float): The number of components to keep (at most num_nodes) if an int,
+            or the minimal share of the variance to be retained (in (0, 1]) if a float.
+
+        Returns:
+            The fitted projection.
+        """
+        ats = np.asarray(ats, dtype=np.float64)
+        mean = np.mean(ats, axis=0)
+        centered = ats - mean
+        # Eigen-decomposition of the (num_nodes x num_nodes) covariance: Cheap for many examples of few nodes
+        covariance = centered.T @ centered / max(1, ats.shape[0] - 1)
+        variances, axes = np.linalg.eigh(covariance)
+        order = np.argsort(variances)[::-1]
+        variances, axes = np.maximum(variances[order], 0), axes[:, order]
+
+        total_variance = np.sum(variances)
+        cumulative_ratios = np.cumsum(variances) / total_variance if total_variance > 0 else np.ones_like(variances)
+        if isinstance(num_components, (float, np.floating)):
+            # Smallest number of components retaining the requested share of the variance
+            num_components = int(np.searchsorted(cumulative_ratios, num_components - 1e-12) + 1)
+        num_components = int(min(num_components, variances.shape[0]))
+
+        return cls(mean=mean,
+                   components=np.ascontiguousarray(axes[:, :num_components].T),
+                   explained_variance_ratio=float(cumulative_ratios[num_components - 1]))
+
+    @property
+    def num_components(self) -> int:
+        return self.components.shape[0]
+
+    def transform(self, ats: np.ndarray) -> np.ndarray:
+        """Projects ATs (Shape of num_examples * num_nodes) to (Shape of num_examples * num_components)"""
+        return (np.asarray(ats, dtype=np.float64) - self.mean) @ self.components.T
+
+    def state(self) -> Dict[str, np.ndarray]:
+        """The arrays defining the projection, e.g. to be saved (see `apotoma.kde_artifacts`)"""
+        return {"mean": self.mean, "components": self.components}
+
@@ -1,5 +1,5 @@
 import os
-from typing import Tuple
+from typing import Tuple, Optional
 
 import numpy as np
 import tensorflow as tf
@@ -19,18 +19,19 @@ class SmartDSA(DSA):
         self.number_of_samples = number_of_samples
 
     def _load_or_calc_train_ats(self, use_cache=False) -> None:
-        smart_paths = self._get_saved_path(ds_type=f'smart_train_subset_{self.number_of_samples}')
-        if use_cache and os.path.exists(smart_paths[0]):
+        smart_paths = self._get_saved_path(ds_type=f'smart_train_subset_{self.number_of_samples}',
+                                           dataset=self.train_data)
+        if use_cache and smart_paths is not None and os.path.exists(smart_paths[0]):
             self.train_ats = np.load(smart_paths[0])
             self.train_pred = np.load(smart_paths[1])
         else:
             self._load_or_select_smart_ats(smart_paths=smart_paths, use_cache=use_cache)
 
-    def _load_or_select_smart_ats(self, smart_paths: Tuple[str, str], use_cache: bool):
+    def _load_or_select_smart_ats(self, smart_paths: Optional[Tuple[str, str]], use_cache: bool):
         if self.train_ats.shape[0] > self.number_of_samples:
             super()._load_or_calc_train_ats(use_cache=use_cache)
             self._select_smart_ats()
-            if use_cache:
+            if use_cache and smart_paths is not None:
                 np.save(smart_paths[0], self.train_ats)
                 np.save(smart_paths[1], self.train_pred)
                 print(f"Saved the smart train ats selection and predictions to {smart_paths[0]} and {smart_paths[1]}")
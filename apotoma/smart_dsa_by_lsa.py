@@ -1,4 +1,3 @@
-import os
 from typing import Optional
 
 import numpy as np
@@ -20,44 +19,41 @@ class DSAbyLSA(DSA):
         super().__init__(model, train_data, config, dsa_batch_size, max_workers)
         self.select_share = select_share
         self.precomputed_likelihoods = precomputed_likelihoods
+        # The LSA on all train ats, whose likelihoods the selection is based on (None if they were precomputed)
+        self.inner_lsa: Optional[LSA] = None
 
     def _load_or_calc_train_ats(self, use_cache=False) -> None:
-
-        saved_train_path = self._get_saved_path("train")
-
-        if os.path.exists(saved_train_path[0]) and use_cache:
-            print("Found saved {} ATs, skip serving".format("train"))
-            # In case train_ats is stored in a disk
-            self.train_ats, self.train_pred = np.load(saved_train_path[0]), np.load(saved_train_path[1])
-
-        else:
-            self.train_ats, self.train_pred = self._load_or_calculate_ats(dataset=self.train_data, ds_type="train",
-                                                                          use_cache=use_cache)
-
+        super()._load_or_calc_train_ats(use_cache=use_cache)
         self._select_smart_ats()
 
     def prep(self, use_cache: bool = False) -> None:
         self._load_or_calc_train_ats(use_cache=use_cache)
+        self._compress_train_ats()
 
     def _select_smart_ats(self):
-
-        all_train_ats = self.train_ats
-        all_train_pred = self.train_pred
-
-        # Note: We're not passing model and train_data as ats are already cached
         if self.precomputed_likelihoods is not None:
+            if self.precomputed_likelihoods.shape[0] != self.train_ats.shape[0]:
+                raise ValueError(f"Got {self.precomputed_likelihoods.shape[0]} precomputed likelihoods "
+                                 f"for {self.train_ats.shape[0]} train ats")
             lsa_values = self.precomputed_likelihoods
         else:
-            # TODO make sure it's documented that we expect cached kde
-            inner_lsa = LSA(model=None, train_data=None, config=self.config)
-            inner_lsa.prep(use_cache=True)
-            lsa_values = inner_lsa._calc_lsa(target_ats=all_train_ats, target_pred=all_train_pred)
-
-        new_class_matrix_norms_vec = {}
+            self.inner_lsa = self._prepared_inner_lsa()
+            # Leave-one-out likelihoods of the same train ats (both are kept in extraction order)
+            lsa_values = self.inner_lsa.train_lsa()
+        self._select_by_likelihood(self.train_ats, self.train_pred, lsa_values)
+
+    def _prepared_inner_lsa(self) -> LSA:
+        # Cache files are keyed by model and train data, thus previously cached ats and kdes are re-used if present
+        inner_lsa = LSA(model=self.model, train_data=self.train_data, config=self.config, max_workers=self.max_workers)
+        inner_lsa.prep(use_cache=True)
+        return inner_lsa
+
+    def _select_by_likelihood(self, all_train_ats: np.ndarray, all_train_pred: np.ndarray,
+                              lsa_values: np.ndarray) -> None:
+        """Keeps the share of the train ats of every class with the lowest likelihoods as train ats"""
         new_ats = []  # Will be concatenated to get new self.train_ats
         new_pred = []  # Will be concatenated to get new self.train_pred
-        selected_so_far = 0
-        for label in range(10):
+        for label in range(self.config.num_classes):
             available_indices = np.where(all_train_pred == label)[0]
             for_label_lsa = lsa_values[available_indices]
             for_label_ats = all_train_ats[available_indices]
@@ -69,11 +65,20 @@ class DSAbyLSA(DSA):
 
             new_ats.append(np.copy(chosen_ats))
             new_pred.append(np.full(shape=num_chosen_samples, fill_value=label))
-            index_list = np.arange(selected_so_far, selected_so_far + num_chosen_samples)
-            new_class_matrix_norms_vec[label] = index_list
-            selected_so_far += num_chosen_samples
 
+        # The selected ats are grouped by class, thus the class index is contiguous
         self.train_ats = np.concatenate(new_ats)
         self.train_pred = np.concatenate(new_pred)
-        self.number_of_samples = sum(len(lst) for lst in new_class_matrix_norms_vec.values())
-        self.class_matrix = new_class_matrix_norms_vec
+        self._index_classes()
+        self.number_of_samples = len(self.class_index)
+
+    def _extend_train_ats(self, new_ats: np.ndarray, new_pred: np.ndarray) -> None:
+        """The train ats are selected by the rank of their likelihoods amongst *all* train ats:
+        The new ats are added to the inner LSA (which is prepared first, if the likelihoods were precomputed),
+        and the train ats are selected again from all its train ats, using its updated likelihoods."""
+        if self.inner_lsa is None:
+            self.inner_lsa = self._prepared_inner_lsa()
+        self.inner_lsa._extend_train_ats(new_ats, new_pred)
+        self._select_by_likelihood(self.inner_lsa.train_ats, self.inner_lsa.train_pred, self.inner_lsa.train_lsa())
+        self.train_ats_quantization = None
+        self._compress_train_ats()
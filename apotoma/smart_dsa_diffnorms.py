@@ -1,4 +1,3 @@
-import os
 from typing import List, Optional
 
 import numpy as np
@@ -20,28 +19,19 @@ class DiffOfNormsSelectiveDSA(DSA):
         self.threshold = threshold
 
     def _load_or_calc_train_ats(self, use_cache=False) -> None:
-
-        saved_train_path = self._get_saved_path("train")
-
-        if os.path.exists(saved_train_path[0]) and use_cache:
-            print("Found saved {} ATs, skip serving".format("train"))
-            # In case train_ats is stored in a disk
-            self.train_ats, self.train_pred = np.load(saved_train_path[0]), np.load(saved_train_path[1])
-
-        else:
-            self.train_ats, self.train_pred = self._load_or_calculate_ats(dataset=self.train_data, ds_type="train",
-                                                                          use_cache=use_cache)
+        super()._load_or_calc_train_ats(use_cache=use_cache)
         self._select_smart_ats()
 
     def prep(self, use_cache: bool = False) -> None:
         self._load_or_calc_train_ats(use_cache=use_cache)
+        self._compress_train_ats()
 
     def _select_smart_ats(self):
 
         all_train_ats = self.train_ats
         all_train_pred = self.train_pred
 
-        new_class_matrix_norms_vec = {}
+        selected_rows = []
         for label in range(self.config.num_classes):
 
             available_indices = np.where(all_train_pred == label)
@@ -76,10 +66,25 @@ class DiffOfNormsSelectiveDSA(DSA):
                     break
 
             selected_indexes = np.nonzero(is_available)[0]
-            new_class_matrix_norms_vec[label] = list(available_indices[0][selected_indexes])
-
-        self.class_matrix = new_class_matrix_norms_vec
-        self.number_of_samples = sum(len(lst) for lst in new_class_matrix_norms_vec.values())
+            selected_rows.append(available_indices[0][selected_indexes])
+
+        # Only the selected rows are indexed, all train ats are kept (e.g., to find the closest ats of other classes)
+        self._index_classes(rows=np.concatenate(selected_rows))
+        self.number_of_samples = len(self.class_index)
+
+    def _extend_train_ats(self, new_ats: np.ndarray, new_pred: np.ndarray) -> None:
+        # Continue the selection: A new at is selected only if its norm differs enough from all selected ats' norms
+        selected_indexes = []
+        for label in np.unique(new_pred):
+            chosen_norms = np.linalg.norm(self._train_ats_rows(self.class_index.rows(label)), axis=1)
+            for i in np.flatnonzero(new_pred == label):
+                norm = np.linalg.norm(new_ats[i])
+                if chosen_norms.shape[0] == 0 or np.min(np.abs(chosen_norms - norm)) >= self.threshold:
+                    selected_indexes.append(i)
+                    chosen_norms = np.append(chosen_norms, norm)
+        selected_indexes = np.sort(np.array(selected_indexes, dtype=int))
+        super()._extend_train_ats(new_ats[selected_indexes], new_pred[selected_indexes])
+        self.number_of_samples = len(self.class_index)
 
     def sample_diff_distributions(self, x_subarray: np.ndarray) -> np.ndarray:
         """
@@ -1,4 +1,3 @@
-import os
 from typing import Optional
 
 import numpy as np
@@ -20,33 +19,21 @@ class NormOfDiffsSelectiveDSA(DSA):
         self.threshold = threshold
 
     def _load_or_calc_train_ats(self, use_cache=False) -> None:
-
-        saved_train_path = self._get_saved_path("train")
-
-        if os.path.exists(saved_train_path[0]) and use_cache:
-            print("Found saved {} ATs, skip serving".format("train"))
-            # In case train_ats is stored in a disk
-            self.train_ats, self.train_pred = np.load(saved_train_path[0]), np.load(saved_train_path[1])
-
-        else:
-            self.train_ats, self.train_pred = self._load_or_calculate_ats(dataset=self.train_data, ds_type="train",
-                                                                          use_cache=use_cache)
-
+        super()._load_or_calc_train_ats(use_cache=use_cache)
         self._select_smart_ats()
 
     def prep(self, use_cache: bool = False) -> None:
         self._load_or_calc_train_ats(use_cache=use_cache)
+        self._compress_train_ats()
 
     def _select_smart_ats(self):
 
         all_train_ats = self.train_ats
         all_train_pred = self.train_pred
 
-        new_class_matrix_norms_vec = {}
         new_ats = []  # Will be concatenated to get new self.train_ats
         new_pred = []  # Will be concatenated to get new self.train_pred
-        selected_so_far = 0
-        for label in range(10):
+        for label in range(self.config.num_classes):
 
             # This index used in the loop indicates the latest element selected to be added to chosen items
             ats = all_train_ats[all_train_pred == label]
@@ -81,23 +68,35 @@ class NormOfDiffsSelectiveDSA(DSA):
 
             new_ats.append(ats[chosen_per_label_indexes])
             new_pred.append(np.full(shape=len(chosen_per_label_indexes), fill_value=label))
-            index_list = np.arange(selected_so_far, selected_so_far + len(chosen_per_label_indexes))
-            new_class_matrix_norms_vec[label] = index_list
-            selected_so_far += len(chosen_per_label_indexes)
 
+        # The selected ats are grouped by class, thus the class index is contiguous
         self.train_ats = np.concatenate(new_ats)
         self.train_pred = np.concatenate(new_pred)
-        self.number_of_samples = sum(len(lst) for lst in new_class_matrix_norms_vec.values())
-        self.class_matrix = new_class_matrix_norms_vec
+        self._index_classes()
+        self.number_of_samples = len(self.class_index)
 
         # TODO move to proper unit test
-        for label in range(10):
+        for label in range(self.config.num_classes):
             selected_ats = self.train_ats[self.train_pred == label]
             for i in range(selected_ats.shape[0] - 1):
                 # Note: This completely ignores labels
                 min_dist = np.min(np.linalg.norm(selected_ats[1 + i:] - selected_ats[i], axis=1))
                 assert min_dist >= self.threshold, f"Found difference {min_dist} < {self.threshold}"
 
+    def _extend_train_ats(self, new_ats: np.ndarray, new_pred: np.ndarray) -> None:
+        # Continue the greedy selection: A new at is selected only if no selected at of its label is too close
+        selected_indexes = []
+        for label in np.unique(new_pred):
+            chosen_ats = self._train_ats_rows(self.class_index.rows(label))
+            for i in np.flatnonzero(new_pred == label):
+                if chosen_ats.shape[0] == 0 or \
+                        np.min(np.linalg.norm(chosen_ats - new_ats[i], axis=1)) >= self.threshold:
+                    selected_indexes.append(i)
+                    chosen_ats = np.concatenate([chosen_ats, new_ats[i:i + 1]])
+        selected_indexes = np.sort(np.array(selected_indexes, dtype=int))
+        super()._extend_train_ats(new_ats[selected_indexes], new_pred[selected_indexes])
+        self.number_of_samples = len(self.class_index)
+
     def sample_diff_distributions(self, x_subarray: np.ndarray, num_samples=100) -> np.ndarray:
         """
         Calculates all differences between the samples passed in the subarray.
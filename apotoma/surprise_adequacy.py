@@ -1,17 +1,28 @@
 import abc
+import glob
 import os
-import pickle
 from abc import ABC
 from concurrent.futures.thread import ThreadPoolExecutor
-from typing import Tuple, List, Union, Dict
+from typing import Tuple, List, Union, Dict, Optional, Callable, Iterator, Sequence
 
 import numpy as np
 import tensorflow as tf
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from scipy.stats import gaussian_kde
-from tensorflow.keras.models import Model
 from tqdm import tqdm
 
+from apotoma.activation_extractor import ActivationExtractor
+from apotoma.activation_traces import ATLayout, ATQuantization, AT_PRECISIONS
+from apotoma.at_store import ActivationTraceStore
+from apotoma.class_index import ClassIndex, RowSelector
+from apotoma.class_stats import ClassStatistics, kde_data_covariance
+from apotoma.fingerprint import model_fingerprint, array_fingerprint, combine_fingerprints
+from apotoma.inputs import InputData, is_in_memory_array, iterate_batches, num_samples_of, prefetch
+from apotoma.kde import GaussianKDE, KDE_BACKENDS, CORESET_METHODS, CoresetReport, fit_coreset_kde, \
+    DEFAULT_MAX_TILE_ELEMENTS
+from apotoma.kde_artifacts import save_kdes, load_kdes, has_kdes, load_projections, load_kdes_on_train_ats
+from apotoma.projection import PCAProjection
+
 
 @dataclass
 class SurpriseAdequacyConfig:
@@ -31,6 +42,32 @@ class SurpriseAdequacyConfig:
         num_classes (int): No. of classes in classification. Default is 10.
         min_var_threshold (float): Threshold value to check variance of ATs
         batch_size (int): Batch size to use while predicting.
+        stream_ats (bool): If true, ATs are extracted batch by batch and each batch is reduced and written into
+        a preallocated buffer right away, such that peak memory depends on the batch size, not the dataset size.
+        fuse_dim_reduction (bool): If true, the spatial mean reduction of conv layers (see `_output_dim_reduction`)
+        is built into the extraction graph, such that only the reduced ATs are copied out of tensorflow.
+        at_store (ActivationTraceStore): Optional in-memory store of ATs, shared by all SA instances using this config.
+        prefetch_batches (int): Number of input batches prepared in the background (e.g. read from a memory mapped
+        array or produced by a generator) while the model processes the current batch.
+        mmap_ats (bool): If true, cached ATs are written batch by batch into a memory mapped file (implying streaming
+        extraction) and loaded memory mapped (read-only), such that processes share one page-cached copy of the ATs.
+        ats_precision (str): Precision in which train ATs are kept after preparation (DSA and its variants):
+        One of 'float32' (default), 'float16' or 'int8' (quantized with a per-column scale and offset).
+        DSA dequantizes the train ATs tile by tile while scoring, i.e., they are never held as float32 as a whole.
+        pipeline_calc (bool): If true, `calc` scores the target ATs batch by batch in worker threads while
+        the model extracts the ATs of the following batches, instead of scoring only after the full extraction.
+        Has no effect if the target ATs are found in the at store or the cache, or if `mmap_ats` is set.
+        kde_backend (str): Implementation of the LSA kernel density estimates: 'scipy' (scipy.stats.gaussian_kde)
+        or 'native' (`apotoma.kde.GaussianKDE`: the same estimates, evaluated with tiled matrix products).
+        kde_coreset_size (int): If set, every LSA kde is fitted on a weighted coreset of at most that many points
+        (instead of all train ats of its class), with the bandwidth of the full data (see `kde.fit_coreset_kde`).
+        Coreset kdes are always evaluated with the native backend. Default: None (no coreset).
+        kde_coreset_method (str): Selection of the coreset: 'random', 'kmeans' (default) or 'herding'.
+        pca_components (int, float): If set, the (variance filtered) ats are projected onto their principal components
+        before the LSA kdes are fitted and evaluated: The number of components if an int,
+        or the share of the variance to be retained if a float in (0, 1]. Default: None (no projection).
+        pca_per_class (bool): If true, a projection is fitted per class (classification only),
+        otherwise a single projection is fitted on the ats of all classes.
 
      Raises:
         ValueError: If any of the config parameters takes an illegal value.
@@ -43,6 +80,18 @@ class SurpriseAdequacyConfig:
     num_classes: Union[int, None]
     min_var_threshold: float = 1e-5
     batch_size: int = 128
+    stream_ats: bool = False
+    fuse_dim_reduction: bool = False
+    at_store: Optional[ActivationTraceStore] = field(default=None, compare=False, repr=False)
+    prefetch_batches: int = 2
+    mmap_ats: bool = False
+    ats_precision: str = 'float32'
+    pipeline_calc: bool = False
+    kde_backend: str = 'scipy'
+    kde_coreset_size: Optional[int] = None
+    kde_coreset_method: str = 'kmeans'
+    pca_components: Optional[Union[int, float]] = None
+    pca_per_class: bool = False
 
     def __post_init__(self):
         if self.is_classification and not self.num_classes:
@@ -51,7 +100,7 @@ class SurpriseAdequacyConfig:
         elif not self.is_classification and self.num_classes:
             raise ValueError(f"num_classes must be None (but was {self.num_classes}) "
                              "in SurpriseAdequacyConfig for classification problems")
-        elif self.num_classes < 0 and self.is_classification:
+        elif self.is_classification and self.num_classes < 0:
             raise ValueError(f"num_classes must be positive but was {self.num_classes}) ")
         elif self.min_var_threshold < 0:
             raise ValueError(f"Variance threshold cannot be negative, but was {self.min_var_threshold}")
@@ -63,47 +112,114 @@ class SurpriseAdequacyConfig:
             raise ValueError(f"Layer list cannot be empty")
         elif len(self.layer_names) != len(set(self.layer_names)):
             raise ValueError(f"Layer list cannot contain duplicates")
+        elif self.ats_precision not in AT_PRECISIONS:
+            raise ValueError(f"ats_precision must be one of {AT_PRECISIONS}, but was {self.ats_precision}")
+        elif self.kde_backend not in KDE_BACKENDS:
+            raise ValueError(f"kde_backend must be one of {KDE_BACKENDS}, but was {self.kde_backend}")
+        elif self.kde_coreset_size is not None and self.kde_coreset_size <= 0:
+            raise ValueError(f"kde_coreset_size must be positive, but was {self.kde_coreset_size}")
+        elif self.kde_coreset_method not in CORESET_METHODS:
+            raise ValueError(f"kde_coreset_method must be one of {CORESET_METHODS}, but was {self.kde_coreset_method}")
+        elif isinstance(self.pca_components, float) and not 0 < self.pca_components <= 1:
+            raise ValueError(f"pca_components must be in (0, 1] if a float, but was {self.pca_components}")
+        elif isinstance(self.pca_components, int) and self.pca_components <= 0:
+            raise ValueError(f"pca_components must be positive if an int, but was {self.pca_components}")
+        elif self.pca_per_class and not self.is_classification:
+            raise ValueError(f"pca_per_class is only supported for classification problems")
+
+
+class ATExtraction:
+    """Extraction of the activation traces of a model, cached in the at store and on disk.
+
+    Base of all surprise adequacies, and used on its own to fill the caches (see `_load_or_calculate_ats`),
+    e.g. by `parallel_extraction`.
 
+    Args:
+        model (tf.keras.Model): The model whose ats are extracted.
+        config (SurpriseAdequacyConfig): Layers, cache locations and extraction settings.
+        model_fingerprint (str): The fingerprint of the model (see `fingerprint.model_fingerprint`), if known.
+        Computed on first use if not passed, i.e., the model must not be modified afterwards
+        (which would invalidate the train ats of a surprise adequacy as well).
+    """
 
-class SurpriseAdequacy(ABC):
-
-    def __init__(self, model: tf.keras.Model, train_data: np.ndarray, config: SurpriseAdequacyConfig) -> None:
+    def __init__(self, model: tf.keras.Model, config: SurpriseAdequacyConfig,
+                 model_fingerprint: Optional[str] = None) -> None:
         self.model = model
-        self.train_data = train_data
-        self.train_ats = None
-        self.train_pred = None
-        self.class_matrix = {}
         self.config = config
+        self.model_fingerprint = model_fingerprint
+
+    def _fingerprints(self, dataset: InputData) -> Optional[Tuple[str, str]]:
+        """The fingerprints of the model and of the dataset, which key the cached ats and predictions of the dataset,
+        or None, if model or dataset cannot be fingerprinted.
+
+        Fingerprinting the model copies and hashes all its weights: It is done once per instance.
+        Dataset fingerprints are memoized as well (see `array_fingerprint`).
+        """
+        if self.model is None or not isinstance(dataset, np.ndarray):
+            return None
+        if self.model_fingerprint is None:
+            self.model_fingerprint = model_fingerprint(self.model)
+        return self.model_fingerprint, array_fingerprint(dataset)
 
-    def _get_saved_path(self, ds_type: str) -> Tuple[str, str]:
+    def _get_saved_path(self, ds_type: str, dataset: InputData) -> Optional[Tuple[str, str]]:
         """Determine saved path of ats and pred
 
+        The file names are content-addressed: They contain a fingerprint of the model weights,
+        the dataset and (for the ats) the layers, such that cached files of different models,
+        datasets (e.g. train subsets) or layers never collide.
+
+        Note that ats are cached per layer (see `_get_layer_saved_path`). The ats of multiple layers
+        are cached at the returned ats path only if loaded memory mapped (see `mmap_ats`).
+
         Args:
             ds_type: Type of dataset: Typically one of {Train, Test, Target}.
+            dataset: The dataset whose ats and pred are cached.
 
         Returns:
-            ats_path: File path of ats.
+            ats_path: File path of ats (the path of the layer ats, if a single layer is configured).
             pred_path: File path of pred (independent of layers)
+            or None, if model or dataset cannot be fingerprinted.
         """
 
-        joined_layer_names = "_".join(self.config.layer_names)
+        model_and_data = self._fingerprints(dataset)
+        if model_and_data is None:
+            return None
+
+        pred_key = combine_fingerprints(*model_and_data)
+        pred_path = os.path.join(self.config.saved_path,
+                                 self.config.ds_name + "_" + ds_type + "_" + pred_key + "_pred.npy")
 
+        if len(self.config.layer_names) == 1:
+            return self._get_layer_saved_path(ds_type, dataset, self.config.layer_names[0]), pred_path
+
+        joined_layer_names = "_".join(self.config.layer_names)
+        ats_key = combine_fingerprints(*model_and_data, list(self.config.layer_names))
         return (
             os.path.join(
                 self.config.saved_path,
-                self.config.ds_name + "_" + ds_type + "_" + joined_layer_names + "_ats" + ".npy",
+                self.config.ds_name + "_" + ds_type + "_" + joined_layer_names + "_" + ats_key + "_ats" + ".npy",
             ),
-            os.path.join(self.config.saved_path, self.config.ds_name + "_" + ds_type + "_pred" + ".npy"),
+            pred_path,
         )
 
+    def _get_layer_saved_path(self, ds_type: str, dataset: np.ndarray, layer_name: str) -> str:
+        """Content-addressed path of the cached ats of a single layer (see `_get_saved_path`)"""
+        ats_key = combine_fingerprints(*self._fingerprints(dataset), [layer_name])
+        return os.path.join(self.config.saved_path,
+                            self.config.ds_name + "_" + ds_type + "_" + layer_name + "_" + ats_key + "_ats.npy")
+
     # Returns ats and returns predictions
-    def _load_or_calculate_ats(self, dataset: np.ndarray, ds_type: str, use_cache: bool) -> Tuple[
+    def _load_or_calculate_ats(self, dataset: InputData, ds_type: str, use_cache: bool) -> Tuple[
         np.ndarray, np.ndarray]:
 
         """Determine activation traces train, target, and test datasets
 
+        ATs are cached per layer (in the at store and on disk), and the predictions once per dataset:
+        Only the ATs of layers which are not yet cached are extracted from the model,
+        the ATs of all layers are then assembled from the cached and the newly extracted ATs.
+
         Args:
-            dataset (ndarray): x_train or x_test or x_target.
+            dataset (InputData): x_train or x_test or x_target.
             ds_type (str): Type of dataset: Train, Test, or Target.
             use_cache (bool): Use stored files to load activation traces or not
 
@@ -114,63 +230,338 @@ class SurpriseAdequacy(ABC):
         """
         print(f"Calculating the ats for {ds_type} dataset")
 
-        saved_target_path = self._get_saved_path(ds_type)
-        if saved_target_path is not None and os.path.exists(saved_target_path[0]) and use_cache:
-            print(f"Found saved {ds_type} ATs, skip at collection from model")
-            return self._load_ats(ds_type)
+        stored = self._get_stored_ats(dataset, ds_type)
+        if stored is not None:
+            return stored
+
+        layer_ats, pred = self._find_layer_ats(dataset, ds_type, use_cache)
+        return self._complete_ats(dataset, ds_type, use_cache, layer_ats, pred)
+
+    def _get_stored_ats(self, dataset: InputData, ds_type: str) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        """The ats and predictions from the at store, if all layers are stored together (served as views)"""
+        if self.config.at_store is None:
+            return None
+        stored = self.config.at_store.get(self.model, self.config.layer_names, dataset)
+        if stored is not None:
+            print(f"Found {ds_type} ATs in AT store, skip at collection from model")
+        return stored
+
+    def _find_layer_ats(self,
+                        dataset: InputData,
+                        ds_type: str,
+                        use_cache: bool) -> Tuple[Dict[str, np.ndarray], Optional[np.ndarray]]:
+        """The ats of all layers found in the at store or (if use_cache) the disk cache, keyed by layer name,
+        and the predictions (None if not found)"""
+        layer_ats, pred = dict(), None
+        if self.config.at_store is not None:
+            layer_ats, pred = self.config.at_store.get_layers(self.model, self.config.layer_names, dataset)
+
+        if not use_cache:
+            return layer_ats, pred
+        saved_target_path = self._get_saved_path(ds_type, dataset)
+        if saved_target_path is None:
+            return layer_ats, pred
+
+        loaded = []
+        for layer_name in self.config.layer_names:
+            layer_path = self._get_layer_saved_path(ds_type, dataset, layer_name)
+            if layer_name not in layer_ats and os.path.exists(layer_path):
+                layer_ats[layer_name] = self._load_cached_ats(layer_path)
+                loaded.append(layer_name)
+        if pred is None and os.path.exists(saved_target_path[1]):
+            pred = np.load(saved_target_path[1])
+        if loaded:
+            print(f"Found saved {ds_type} ATs of layers {loaded}, skip their collection from model")
+        return layer_ats, pred
+
+    def _complete_ats(self,
+                      dataset: InputData,
+                      ds_type: str,
+                      use_cache: bool,
+                      layer_ats: Dict[str, np.ndarray],
+                      pred: Optional[np.ndarray]) -> Tuple[np.ndarray, np.ndarray]:
+        """Extracts (and caches) the ats of all layers missing in `layer_ats`,
+        and assembles the ats of all configured layers"""
+        if pred is None:
+            # Predictions are cached along with the ats of any layer: Without them, no layer ats can be re-used
+            missing = list(self.config.layer_names)
         else:
-            ats, pred = self._calculate_ats(dataset)
+            missing = [name for name in self.config.layer_names if name not in layer_ats]
+
+        if missing:
+            print(f"Extracting the {ds_type} ATs of layers {missing}")
+            extractor = self._get_extractor(missing)
+            saved_target_path = self._get_saved_path(ds_type, dataset)
+            if saved_target_path is not None and self.config.mmap_ats:
+                self._calculate_ats_to_files(extractor, dataset, ds_type)
+                new_layer_ats = {name: self._load_cached_ats(self._get_layer_saved_path(ds_type, dataset, name))
+                                 for name in missing}
+                pred = np.load(saved_target_path[1])
+            else:
+                ats, pred = self._calculate_ats(dataset, layer_names=missing)
+                new_layer_ats = {name: extractor.layout.view(ats, [name]) for name in missing}
+                self._save_layer_ats(dataset, ds_type, new_layer_ats, pred)
+                if len(missing) == len(self.config.layer_names):
+                    # No need to assemble (i.e., copy) the ats
+                    self._put_ats_in_store(dataset, extractor.layout, ats, pred)
+                    return ats, pred
+            layer_ats.update(new_layer_ats)
+
+        layout = ATLayout(layer_names=tuple(self.config.layer_names),
+                          widths=tuple(layer_ats[name].shape[1] for name in self.config.layer_names))
+        ats = self._assemble_ats(dataset, ds_type, use_cache, layout, layer_ats)
+        self._put_ats_in_store(dataset, layout, ats, pred)
+        return ats, pred
 
-            if saved_target_path is not None:
-                np.save(saved_target_path[0], ats)
-                np.save(saved_target_path[1], pred)
-                print(f"[{ds_type}] Saved the ats and predictions to {saved_target_path[0]} and {saved_target_path[1]}")
+    def _assemble_ats(self,
+                      dataset: InputData,
+                      ds_type: str,
+                      use_cache: bool,
+                      layout: ATLayout,
+                      layer_ats: Dict[str, np.ndarray]) -> np.ndarray:
+        """The ats matrix of all configured layers (in the column layout `layout`), assembled from the layer ats"""
+        if len(layout.layer_names) == 1:
+            return layer_ats[layout.layer_names[0]]
+        saved_target_path = self._get_saved_path(ds_type, dataset) if self.config.mmap_ats else None
+        if saved_target_path is None:
+            return np.concatenate([layer_ats[name] for name in layout.layer_names], axis=1)
+
+        # The assembled ats are cached as well, such that they can be loaded memory mapped
+        ats_path = saved_target_path[0]
+        if not use_cache or not os.path.exists(ats_path):
+            # Write to a temporary file first, such that no partially written ats are ever found in the cache
+            partial_ats_path = ats_path[:-len(".npy")] + "_partial.npy"
+            ats = np.lib.format.open_memmap(partial_ats_path, mode='w+',
+                                            dtype=np.result_type(*layer_ats.values()),
+                                            shape=(dataset.shape[0], layout.num_nodes))
+            for layer_name, columns in layout.slices.items():
+                ats[:, columns] = layer_ats[layer_name]
+            ats.flush()
+            del ats
+            os.replace(partial_ats_path, ats_path)
+        return self._load_cached_ats(ats_path)
+
+    def _save_layer_ats(self, dataset: InputData, ds_type: str, layer_ats: Dict[str, np.ndarray],
+                        pred: np.ndarray) -> None:
+        saved_target_path = self._get_saved_path(ds_type, dataset)
+        if saved_target_path is None:
+            return
+        for layer_name, ats in layer_ats.items():
+            np.save(self._get_layer_saved_path(ds_type, dataset, layer_name), ats)
+        np.save(saved_target_path[1], pred)
+        print(f"[{ds_type}] Saved the ats of layers {list(layer_ats)} and the predictions to {self.config.saved_path}")
+
+    def _put_ats_in_store(self, dataset: InputData, layout: ATLayout, ats: np.ndarray, pred: np.ndarray) -> None:
+        if self.config.at_store is not None:
+            self.config.at_store.put(self.model, layout, dataset, ats, pred)
+
+    def _calc_pipelined(self,
+                        target_data: InputData,
+                        ds_type: str,
+                        use_cache: bool,
+                        score_batch: Callable[[np.ndarray, np.ndarray], np.ndarray],
+                        max_workers: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """Extracts the target ATs and scores them, overlapping model inference and scoring (see `pipeline_calc`).
+
+        A producer thread runs the model batch by batch, while worker threads score the batches extracted so far.
+        The scores are re-assembled in order. The ATs are cached (on disk and in the at store)
+        just as in `_load_or_calculate_ats`.
 
-            return ats, pred
+        Args:
+            target_data (InputData): x_test or x_target.
+            ds_type (str): Type of dataset: Train, Test, or Target.
+            use_cache (bool): Use stored files to load activation traces or not
+            score_batch: Calculates the surprise of a batch of target ats and their predictions.
+            max_workers (int): Number of scoring threads. Default: see `ThreadPoolExecutor`.
+
+        Returns:
+            A tuple of two one-dimensional arrays: surprises and predictions
+
+        """
+        stored = self._get_stored_ats(target_data, ds_type)
+        if stored is not None:
+            return score_batch(*stored), stored[1]
+        layer_ats, pred = self._find_layer_ats(target_data, ds_type, use_cache)
+        if layer_ats or pred is not None or self.config.mmap_ats:
+            target_ats, target_pred = self._complete_ats(target_data, ds_type, use_cache, layer_ats, pred)
+            return score_batch(target_ats, target_pred), target_pred
+
+        print(f"Calculating the ats for {ds_type} dataset, scoring them while extracting")
+        extractor = self._get_extractor()
+        at_batches = prefetch(self._iterate_at_batches(extractor, target_data), depth=self.config.prefetch_batches)
+        ats_batches, pred_batches, futures = [], [], []
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for batch_ats, batch_pred in at_batches:
+                ats_batches.append(batch_ats)
+                pred_batches.append(batch_pred)
+                futures.append(executor.submit(score_batch, batch_ats, batch_pred))
+            scores = np.concatenate([future.result() for future in futures])
+
+        ats, pred = np.concatenate(ats_batches), np.concatenate(pred_batches)
+        self._save_layer_ats(target_data, ds_type,
+                             {name: extractor.layout.view(ats, [name]) for name in extractor.layer_names}, pred)
+        self._put_ats_in_store(target_data, extractor.layout, ats, pred)
+        return scores, pred
 
     @classmethod
     def _output_dim_reduction(cls, layer_output):
         return np.mean(layer_output, axis=tuple(range(1, layer_output.ndim - 1)))
 
-    def _calculate_ats(self, dataset: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
-        output_layers = [self.model.get_layer(layer_name).output for layer_name in self.config.layer_names]
-        output_layers.append(self.model.output)
-        temp_model = Model(
-            inputs=self.model.input,
-            outputs=output_layers
-        )
+    @classmethod
+    def _reduce_layer_output(cls, layer_output: np.ndarray) -> np.ndarray:
+        if layer_output[0].ndim >= 3:
+            # (primarily for convolutional layers - note that kim et al used ndim==3)
+            return cls._output_dim_reduction(layer_output)
+        else:
+            return np.array(layer_output)
+
+    def _get_extractor(self, layer_names: Optional[Sequence[str]] = None) -> ActivationExtractor:
+        """The extractor of the passed layers. Default: The configured layers."""
+        if layer_names is None:
+            layer_names = self.config.layer_names
+        return ActivationExtractor.get(self.model, layer_names, self.config.fuse_dim_reduction)
+
+    @property
+    def at_layout(self) -> ATLayout:
+        """Column layout of the ATs of this instance, allowing to get per-layer views on train and target ATs"""
+        return self._get_extractor().layout
+
+    def _calculate_ats(self,
+                       dataset: InputData,
+                       layer_names: Optional[Sequence[str]] = None) -> Tuple[np.ndarray, np.ndarray]:
+        extractor = self._get_extractor(layer_names)
 
-        # Get the activation traces of the inner layers and the output of the final layer
-        layer_outputs: List[np.ndarray] = temp_model.predict(dataset, batch_size=self.config.batch_size, verbose=1)
-        # Remove the (output layer) dnn outputs from the list and store them as separate result
-        dnn_output = layer_outputs.pop()
+        # Keras predict would materialize memory mapped arrays, which are thus always processed batch by batch
+        if self.config.stream_ats or not is_in_memory_array(dataset):
+            return self._calculate_ats_streaming(extractor, dataset)
+
+        # Get the activation traces of the inner layers and the output of the final layer (as separate result)
+        layer_outputs, dnn_output = extractor.predict(dataset, batch_size=self.config.batch_size, verbose=1)
 
         if self.config.is_classification:
             pred = np.argmax(dnn_output, axis=1)
 
-            ats = None
-            for layer_name, layer_output in zip(self.config.layer_names, layer_outputs):
+            # Shape of ats will be num_inputs x num_nodes_in_all_layers
+            ats = np.empty(shape=(pred.shape[0], extractor.layout.num_nodes), dtype=np.result_type(*layer_outputs))
+            for (layer_name, columns), layer_output in zip(extractor.layout.slices.items(), layer_outputs):
                 print("Layer: " + layer_name)
-                if layer_output[0].ndim >= 3:
-                    # (primarily for convolutional layers - note that kim et al used ndim==3)
-                    layer_matrix = self._output_dim_reduction(layer_output)
-                else:
-                    layer_matrix = np.array(layer_output)
+                ats[:, columns] = self._reduce_layer_output(layer_output)
 
-                if ats is None:
-                    # Shape of ats will be num_inputs x num_nodes_in_layer
-                    ats = layer_matrix
-                else:
-                    ats = np.append(ats, layer_matrix, axis=1)
+        return ats, pred
 
+    def _calculate_ats_to_files(self, extractor: ActivationExtractor, dataset: np.ndarray, ds_type: str) -> None:
+        """Extract ATs batch by batch directly into memory mapped .npy files (one per layer of the extractor)
+        and save the predictions"""
+        layer_paths = [self._get_layer_saved_path(ds_type, dataset, name)
+                       for name in extractor.layer_names]
+        # Write to temporary files first, such that no partially written ats are ever found in the cache
+        partial_layer_paths = [path[:-len(".npy")] + "_partial.npy" for path in layer_paths]
+        num_samples = dataset.shape[0]
+        layer_files, pred = None, None
+
+        start = 0
+        for batch_ats, batch_pred in self._iterate_at_batches(extractor, dataset):
+            if layer_files is None:
+                layer_files = [np.lib.format.open_memmap(path, mode='w+', dtype=batch_ats.dtype,
+                                                         shape=(num_samples, width))
+                               for path, width in zip(partial_layer_paths, extractor.layout.widths)]
+                pred = np.empty(shape=(num_samples,) + batch_pred.shape[1:], dtype=batch_pred.dtype)
+            end = start + batch_pred.shape[0]
+            for layer_file, columns in zip(layer_files, extractor.layout.slices.values()):
+                layer_file[start:end] = batch_ats[:, columns]
+            pred[start:end] = batch_pred
+            start = end
+
+        for layer_file in layer_files:
+            layer_file.flush()
+        del layer_files
+        np.save(self._get_saved_path(ds_type, dataset)[1], pred)
+        for partial_path, path in zip(partial_layer_paths, layer_paths):
+            os.replace(partial_path, path)
+        print(f"[{ds_type}] Saved the ats of layers {list(extractor.layer_names)} and the predictions "
+              f"to {self.config.saved_path}")
+
+    def _calculate_ats_streaming(self,
+                                 extractor: ActivationExtractor,
+                                 dataset: InputData) -> Tuple[np.ndarray, np.ndarray]:
+        """Extract ATs batch by batch, writing every reduced batch into preallocated buffers.
+
+        Only the full layer outputs of a single batch (and the raw inputs of the prefetched batches)
+        are kept in memory at any time. If the number of samples is not known in advance (tf.data and iterables),
+        the reduced batches are concatenated at the end instead.
+
+        Args:
+            extractor: Extractor of the selected layers.
+            dataset (InputData): x_train or x_test or x_target (array, memmap, tf.data.Dataset or batch iterable).
+
+        Returns:
+            ats (ndarray): Activation traces (Shape of num_examples * num_nodes).
+            pred (ndarray): 1-D Array of predictions
+
+        """
+        num_samples = num_samples_of(dataset)
+        ats, pred = None, None
+        # Used instead of the preallocated buffers if the number of samples is not known in advance
+        ats_batches, pred_batches = [], []
+
+        start = 0
+        for batch_ats, batch_pred in self._iterate_at_batches(extractor, dataset):
+            end = start + batch_pred.shape[0]
+
+            if num_samples is None:
+                ats_batches.append(batch_ats)
+                pred_batches.append(batch_pred)
+                start = end
+                continue
+
+            if ats is None:
+                ats = np.empty(shape=(num_samples, extractor.layout.num_nodes), dtype=batch_ats.dtype)
+                pred = np.empty(shape=(num_samples,) + batch_pred.shape[1:], dtype=batch_pred.dtype)
+
+            ats[start:end] = batch_ats
+            pred[start:end] = batch_pred
+            start = end
+
+        if num_samples is None:
+            ats, pred = np.concatenate(ats_batches), np.concatenate(pred_batches)
         return ats, pred
 
-    def _load_ats(self, ds_type: str) -> Tuple[np.ndarray, np.ndarray]:
+    def _iterate_at_batches(self,
+                            extractor: ActivationExtractor,
+                            dataset: InputData) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+        """Runs the model batch by batch, yielding the (reduced) ats and the predictions of every batch"""
+        num_samples = num_samples_of(dataset)
+        num_batches = None if num_samples is None else int(np.ceil(num_samples / self.config.batch_size))
+        batches = iterate_batches(dataset, self.config.batch_size, self.config.prefetch_batches)
+        for batch in tqdm(batches, desc="ats", total=num_batches):
+            yield self._batch_ats(extractor, batch)
+
+    def _batch_ats(self, extractor: ActivationExtractor, batch: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """The (reduced) ats and the predictions of a single batch, using the compiled forward pass"""
+        layer_outputs, dnn_output = extractor.predict_on_batch(batch)
+        batch_ats = np.concatenate([self._reduce_layer_output(layer_output) for layer_output in layer_outputs], axis=1)
+        if self.config.is_classification:
+            batch_pred = np.argmax(dnn_output, axis=1)
+        else:
+            batch_pred = dnn_output
+        return batch_ats, batch_pred
+
+    def _load_cached_ats(self, ats_path: str) -> np.ndarray:
         # In case train_ats is stored in a disk
-        saved_target_path = self._get_saved_path(ds_type)
-        ats: np.ndarray = np.load(saved_target_path[0])
-        pred: np.ndarray = np.load(saved_target_path[1])
-        return ats, pred
+        return np.load(ats_path, mmap_mode='r' if self.config.mmap_ats else None)
+
+
+class SurpriseAdequacy(ATExtraction, ABC):
+
+    def __init__(self, model: tf.keras.Model, train_data: InputData, config: SurpriseAdequacyConfig) -> None:
+        super().__init__(model=model, config=config)
+        self.train_data = train_data
+        self.train_ats = None
+        self.train_pred = None
+        # Set if train_ats are stored with reduced precision, see `_compress_train_ats`
+        self.train_ats_quantization: Optional[ATQuantization] = None
+        # Rows of the train ats per predicted class (classification only), see `_index_classes`
+        self.class_index: Optional[ClassIndex] = None
 
     def _load_or_calc_train_ats(self, use_cache=False) -> None:
         """Load or get actviation traces of training inputs
@@ -183,21 +574,14 @@ class SurpriseAdequacy(ABC):
 
         """
 
-        saved_train_path = self._get_saved_path("train")
-
-        if os.path.exists(saved_train_path[0]) and use_cache:
-            print("Found saved {} ATs, skip serving".format("train"))
-            # In case train_ats is stored in a disk
-            self.train_ats, self.train_pred = np.load(saved_train_path[0]), np.load(saved_train_path[1])
-
-        else:
-            self.train_ats, self.train_pred = self._load_or_calculate_ats(dataset=self.train_data, ds_type="train",
-                                                                          use_cache=use_cache)
+        self.train_ats, self.train_pred = self._load_or_calculate_ats(dataset=self.train_data, ds_type="train",
+                                                                      use_cache=use_cache)
+        self.train_ats_quantization = None
 
     def prep(self, use_cache: bool = False) -> None:
         """
-        Prepare class matrix from training activation traces. Class matrix is a dictionary
-        with keys as labels and values as lists of positions as predicted by model
+        Prepare class index from training activation traces. The class index holds,
+        for every label, the positions of the train ats predicted as this label by the model.
 
         Args:
             use_cache: bool If true, prepared values (activation traces, ...) will be
@@ -208,17 +592,76 @@ class SurpriseAdequacy(ABC):
 
         """
         self._load_or_calc_train_ats(use_cache=use_cache)
+        self._index_classes()
+
+    def _index_classes(self, rows: Optional[np.ndarray] = None) -> None:
+        """Builds the class index of the train ats (only for classification).
+
+        The train ats and predictions are kept in their (extraction) order, such that all instances
+        on the same train data agree on the rows, and callers may replace them in that order.
+        The rows of every class are accessed through the class index: As zero-copy views if the ats happen
+        to be grouped by class already (see `ClassIndex.is_contiguous`), using its index arrays otherwise.
+
+        Args:
+            rows: The rows to index. Default: All rows.
+
+        Returns:
+            None.
+
+        """
+        if not self.config.is_classification:
+            return
+        self.class_index = ClassIndex.from_labels(self.train_pred, self.config.num_classes, rows=rows)
+
+    def extend(self, train_data: InputData) -> None:
+        """
+        Adds nominal samples to an already prepared surprise adequacy.
+        Only the ATs of the new samples are extracted. They are appended to the train ATs,
+        after which derived structures (class index, kdes, ...) are updated incrementally.
+
+        Note that `train_data` (and thus the on-disk cache) is not modified:
+        A later call to `prep` starts again from the original train data.
+
+        Args:
+            train_data: The new nominal samples.
+
+        Returns:
+            None.
+
+        """
+        assert self.train_ats is not None, "SA has not yet been prepared. Run prep()"
+        new_ats, new_pred = self._calculate_ats(train_data)
+        self._extend_train_ats(new_ats, new_pred)
+
+    def _extend_train_ats(self, new_ats: np.ndarray, new_pred: np.ndarray) -> None:
+        """Appends ats and predictions to the prepared train ats, updating the class index.
+        Subclasses extend this to update their derived structures."""
+        if self.train_ats_quantization is not None:
+            # Note: For int8, new ats outside of the original per-column range are clipped
+            new_ats = self.train_ats_quantization.quantize(new_ats)
+        self.train_ats = np.concatenate([self.train_ats, new_ats])
+        self.train_pred = np.concatenate([self.train_pred, new_pred])
         if self.config.is_classification:
-            # TODO Switch to numpy magic
-            for i, label in enumerate(self.train_pred):
-                if label not in self.class_matrix:
-                    self.class_matrix[label] = []
-                self.class_matrix[label].append(i)
+            self._index_classes(rows=self.class_index.extended(self.train_pred).order)
+
+    def _compress_train_ats(self) -> None:
+        """Converts the (prepared) train ats to the configured `ats_precision`.
+        Use `_train_ats_rows` to access them as float32 afterwards."""
+        if self.config.ats_precision == 'float32' or self.train_ats_quantization is not None:
+            return
+        self.train_ats_quantization = ATQuantization.fit(self.train_ats, self.config.ats_precision)
+        self.train_ats = self.train_ats_quantization.quantize(self.train_ats)
+
+    def _train_ats_rows(self, rows: Union[np.ndarray, List[int], slice]) -> np.ndarray:
+        """The train ats at the passed rows, dequantized if stored with reduced precision"""
+        if self.train_ats_quantization is None:
+            return self.train_ats[rows]
+        return self.train_ats_quantization.dequantize(self.train_ats[rows])
 
     def clear_cache(self, saved_path: str) -> None:
         """
 
-        Delete files of activation traces.
+        Delete files of activation traces (and predictions) cached for the configured dataset name.
 
         Args:
             saved_path(str): Base directory path
@@ -226,19 +669,14 @@ class SurpriseAdequacy(ABC):
         """
         to_remove = ['train', 'test', 'target']
         for f in to_remove:
-            path = self._get_saved_path(f)
-            os.remove(os.path.join(saved_path, path[0]))
-            os.remove(os.path.join(saved_path, path[1]))
-
-        # files = [f for f in os.listdir(saved_path) if f.endswith('.npy')]
-        # for f in files:
-        #     os.remove(os.path.join(saved_path, f))
+            for path in glob.glob(os.path.join(saved_path, self.config.ds_name + "_" + f + "_*.npy")):
+                os.remove(path)
 
     @abc.abstractmethod
-    def calc(self, target_data: np.ndarray, use_cache: bool, ds_type: str) -> Tuple[np.ndarray, np.ndarray]:
+    def calc(self, target_data: InputData, use_cache: bool, ds_type: str) -> Tuple[np.ndarray, np.ndarray]:
         """
         Calculates prediction and novelty scores
-        :param target_data: a numpy array consisting of the data to be tested
+        :param target_data: the data to be tested (numpy array, memmap, batched tf.data.Dataset or iterable of batches)
         :param use_cache: whether or not to use caching, i.e., re-use ats from previous cals to calc on *any* SA
         :param ds_type: string, 'train' or 'test'
         :return: A tuple of two one-dimensional arrays: surprises and predictions
@@ -248,10 +686,24 @@ class SurpriseAdequacy(ABC):
 
 class LSA(SurpriseAdequacy):
 
-    def __init__(self, model: tf.keras.Model, train_data: np.ndarray, config: SurpriseAdequacyConfig) -> None:
+    def __init__(self, model: tf.keras.Model,
+                 train_data: InputData,
+                 config: SurpriseAdequacyConfig,
+                 max_workers=None) -> None:
         super().__init__(model, train_data, config)
+        # Number of threads fitting and evaluating the kdes of different classes concurrently
+        self.max_workers = max_workers
         self.kdes = None
         self.removed_rows = None
+        # Approximation errors of the coreset kdes (by label, 0 for regression), see `kde_coreset_size`
+        self.kde_coreset_reports: Dict[int, CoresetReport] = dict()
+        # Whether the kde of a label (0 for regression) was fitted on all train ats of the class, i.e.,
+        # whether its points are these (refined and projected) train ats in order: Not for coresets or parametric fits
+        self.kdes_on_train_ats: Dict[int, bool] = dict()
+        # Projections of the refined ats by label, or a single one for all labels at key None, see `pca_components`
+        self.projections: Dict[Optional[int], PCAProjection] = dict()
+        # Moments of the train ats per class (of all train ats for regression), set when the kdes are fitted
+        self.train_stats: Optional[ClassStatistics] = None
 
     def prep(self, use_cache: bool = False) -> None:
         super().prep(use_cache=use_cache)
@@ -268,27 +720,92 @@ class LSA(SurpriseAdequacy):
 
         """
 
-        kdes_path = os.path.join(self.config.saved_path, self.config.ds_name + "kdes.npy")
-        rem_row_path = os.path.join(self.config.saved_path, self.config.ds_name + "remrows.npy")
+        kdes_path = self._get_kde_saved_path()
 
-        if os.path.exists(kdes_path) and os.path.exists(rem_row_path) and use_cache:
-            with open(kdes_path, 'rb') as file:
-                self.kdes = pickle.load(file)
-            with open(rem_row_path, 'rb') as file:
-                self.removed_rows = pickle.load(file)
-        else:
-            self.kdes, self.removed_rows = self._calc_kdes()
-            with open(kdes_path, 'wb') as file:
-                pickle.dump(self.kdes, file=file)
-            with open(rem_row_path, 'wb') as file:
-                pickle.dump(self.removed_rows, file=file)
+        if kdes_path is not None and use_cache and self._load_kdes(kdes_path):
+            return
+        self.kdes, self.removed_rows = self._calc_kdes()
+        if kdes_path is not None:
+            save_kdes(kdes_path, self.kdes, self.removed_rows, self.projections, self.kdes_on_train_ats)
 
-    def calc(self, target_data: np.ndarray, ds_type: str, use_cache=False) -> Tuple[np.ndarray, np.ndarray]:
+    def _load_kdes(self, kdes_path: str) -> bool:
+        """Loads the cached kdes, removed rows and projections. Returns False (a cache miss) if they cannot be loaded.
+
+        Cached kdes are loaded memory mapped, as native kdes (see `kde_artifacts`).
+        Loading fails e.g. if the artifacts are replaced by a concurrent writer while they are read.
+        """
+        try:
+            if not has_kdes(kdes_path):
+                return False
+            kdes, removed_rows = load_kdes(kdes_path)
+            projections = load_projections(kdes_path)
+            kdes_on_train_ats = load_kdes_on_train_ats(kdes_path)
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Could not load the cached kdes from {kdes_path} ({e}), re-creating them")
+            return False
+        self.kdes, self.removed_rows, self.projections = kdes, removed_rows, projections
+        self.kdes_on_train_ats = kdes_on_train_ats
+        return True
+
+    def _get_kde_saved_path(self) -> Optional[str]:
+        """Content-addressed directory of the kdes and removed rows, keyed on model, train data and kde-relevant config.
+
+        Returns None if model or train data cannot be fingerprinted.
+        """
+        fingerprints = self._fingerprints(self.train_data)
+        if fingerprints is None:
+            return None
+        key = combine_fingerprints(self.__class__.__name__,
+                                   *fingerprints,
+                                   self.config.layer_names,
+                                   self.config.is_classification,
+                                   self.config.num_classes,
+                                   self.config.min_var_threshold,
+                                   self.config.kde_backend,
+                                   self.config.kde_coreset_size,
+                                   self.config.kde_coreset_method,
+                                   self.config.pca_components,
+                                   self.config.pca_per_class)
+        return os.path.join(self.config.saved_path, self.config.ds_name + "_" + key + "_kdes")
+
+    def _extend_train_ats(self, new_ats: np.ndarray, new_pred: np.ndarray) -> None:
+        super()._extend_train_ats(new_ats, new_pred)
+        if not self.config.is_classification:
+            self.kdes, self.removed_rows = self._regression_kdes()
+            return
+
+        labels = np.unique(new_pred).tolist()
+        # The train ats of the extended classes, gathered once for their statistics and kdes
+        grouped_ats, starts = self.class_index.grouped(self.train_ats, labels)
+        if self.train_stats is None:
+            # The kdes were loaded from the cache
+            self.train_stats = ClassStatistics.from_ats(self.train_ats, self.class_index)
+        else:
+            self.train_stats = self.train_stats.updated(grouped_ats, starts, labels)
+        removed_rows = self._classification_removed_rows()
+        if sorted(removed_rows) != sorted(self.removed_rows):
+            # The set of considered nodes changed, thus the kdes of all classes must be re-created
+            self.kdes, self.removed_rows = self._classification_kdes()
+            return
+        if self.config.pca_components is not None and not self.config.pca_per_class:
+            # The projection shared by all classes is fitted on the ats of all classes, thus it changed as well
+            self.kdes, self.removed_rows = self._classification_kdes()
+            return
+
+        # Only the kdes of the classes which received new samples change
+        class_kdes = self._map_classes(
+            lambda i: self._classification_kde(labels[i], self.removed_rows, grouped_ats[starts[i]:starts[i + 1]]),
+            list(range(len(labels))))
+        for label, kde in zip(labels, class_kdes):
+            if kde is not None:
+                self.kdes[label] = kde
+
+    def calc(self, target_data: InputData, ds_type: str, use_cache=False) -> Tuple[np.ndarray, np.ndarray]:
         """
         Return LSA values for target. Note that target_data here means both test and adversarial data. Separate calls in main.
 
         Args:
-            target_data (ndarray): x_test or x_target.
+            target_data (InputData): x_test or x_target.
             ds_type (str): Type of dataset: Train, Test, or Target.
             use_cache (bool): Use stored files to load activation traces or not
 
@@ -299,12 +816,103 @@ class LSA(SurpriseAdequacy):
         assert self.kdes is not None and self.removed_rows is not None, \
             "LSA has not yet been prepared. Run lsa.prep()"
 
+        if self.config.pipeline_calc:
+            print(f"[{ds_type}] Calculating LSA (pipelined)")
+            return self._calc_pipelined(target_data, ds_type, use_cache, score_batch=self._calc_lsa)
+
         target_ats, target_pred = self._load_or_calculate_ats(dataset=target_data, ds_type=ds_type, use_cache=use_cache)
 
         print(f"[{ds_type}] Calculating LSA")
         lsa_as_list = self._calc_lsa(target_ats, target_pred)
         return np.array(lsa_as_list), target_pred
 
+    def score(self, inputs: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Low latency LSA of a single input or a micro-batch, e.g. for online scoring in an inference service.
+
+        Unlike `calc`, nothing is cached, read from or written to disk, and nothing is logged:
+        The inputs are passed through the (shared, compiled) forward pass of the extractor as a single batch,
+        and scored by `score_ats`. Safe to be called concurrently from multiple threads on a prepared LSA.
+
+        Args:
+            inputs (ndarray): A batch of inputs, or a single input (without batch axis).
+
+        Returns:
+            lsa (ndarray): The LSA of every input.
+            pred (ndarray): The predictions of every input.
+        """
+        inputs = np.asarray(inputs)
+        if inputs.ndim == len(self.model.input.shape) - 1:
+            inputs = inputs[np.newaxis]
+        ats, pred = self._batch_ats(self._get_extractor(), inputs)
+        return self.score_ats(ats, pred), pred
+
+    def score_ats(self, ats: np.ndarray, pred: np.ndarray) -> np.ndarray:
+        """LSA of already extracted ats (Shape of num_inputs * num_nodes) with their predictions.
+
+        The classes are scored sequentially in the calling thread (micro-batches are too small for a thread pool
+        to pay off), and the prepared state (kdes, removed rows, projections) is only read,
+        such that concurrent calls from multiple threads are safe. As in `calc`,
+        inputs predicted as a class without kde (see `_kde_labels`) have no defined LSA (nan).
+        """
+        assert self.kdes is not None and self.removed_rows is not None, \
+            "LSA has not yet been prepared. Run lsa.prep()"
+        ats = np.atleast_2d(ats)
+        if not self.config.is_classification:
+            return self._calc_regression_lsa(ats)
+
+        pred = np.atleast_1d(pred)
+        result = np.full(shape=pred.shape, fill_value=np.nan)
+        refined_ats = np.delete(ats, self.removed_rows, axis=1)
+        for label in self._kde_labels(np.unique(pred)):
+            for_label_indexes, label_result = self._label_lsa(refined_ats, pred, label)
+            result[for_label_indexes] = label_result
+        return result
+
+    def train_lsa(self, leave_one_out: bool = True) -> np.ndarray:
+        """LSA of the train ats themselves, e.g. to be passed as `precomputed_likelihoods` to `DSAbyLSA`.
+
+        Every train at is one of the points of the kde of its class, thus its own kernel biases its likelihood.
+        With leave_one_out, this kernel is excluded exactly, i.e., every at is scored by the kde of the other ats
+        of its class (with the bandwidth of the full kde). The kdes are evaluated on their own (already whitened,
+        class-grouped and projected) data in tiles, without gathering, projecting or whitening the train ats again.
+
+        Kdes whose points are not the train ats (e.g. coreset kdes, see `kdes_on_train_ats`)
+        score them like any other target, and without leave-one-out correction.
+
+        Args:
+            leave_one_out (bool): Whether to exclude the own kernel of every train at.
+
+        Returns:
+            lsa (ndarray): The LSA of every train at, in the order of `train_ats` (and `train_pred`).
+        """
+        assert self.kdes is not None and self.removed_rows is not None, \
+            "LSA has not yet been prepared. Run lsa.prep()"
+        if not self.config.is_classification:
+            return self._kde_train_lsa(0, slice(None), self.train_ats.shape[0], leave_one_out)
+
+        result = np.empty(shape=self.train_pred.shape, dtype=float)
+        labels = self.class_index.labels
+        label_results = self._map_classes(
+            lambda label: self._kde_train_lsa(label, self.class_index.rows(label), self.class_index.count(label),
+                                              leave_one_out), labels)
+        for label, label_result in zip(labels, label_results):
+            result[self.class_index.rows(label)] = label_result
+        return result
+
+    def _kde_train_lsa(self,
+                       label: int,
+                       rows: Union[np.ndarray, slice],
+                       num_rows: int,
+                       leave_one_out: bool) -> np.ndarray:
+        """The LSA of the (num_rows) train ats at rows, i.e., the ats of the label in order, by the kde of the label"""
+        kde = self.kdes[label]
+        if isinstance(kde, gaussian_kde):
+            kde = GaussianKDE.from_scipy(kde)
+        if not self.kdes_on_train_ats[label]:
+            refined_ats = self._project(label, np.delete(self.train_ats[rows], self.removed_rows, axis=1))
+            return -kde.logpdf(np.transpose(refined_ats))
+        return -(kde.self_log_kernel_sums(leave_one_out=leave_one_out) - kde.log_norm)
+
     def _calc_kdes(self) -> Tuple[dict, List[int]]:
         """
         Determine Gaussian KDE for each label and list of removed rows based on variance threshold, if any.
@@ -320,6 +928,9 @@ class LSA(SurpriseAdequacy):
 
         """
 
+        self.kde_coreset_reports = dict()
+        self.kdes_on_train_ats = dict()
+        self.projections = dict()
         if self.config.is_classification:
             kdes, removed_rows = self._classification_kdes()
         else:
@@ -327,18 +938,27 @@ class LSA(SurpriseAdequacy):
 
         print((f"Ignoring the activations of {len(removed_rows)} traces "
                f"as their variance is not high enough."))
+        if self.kde_coreset_reports:
+            max_errors = [report.max_abs_error for report in self.kde_coreset_reports.values()]
+            mean_errors = [report.mean_abs_error for report in self.kde_coreset_reports.values()]
+            print(f"Coreset kdes ({self.config.kde_coreset_method}, {self.config.kde_coreset_size} points): "
+                  f"mean abs. log density error {np.mean(mean_errors):.4f}, max {np.max(max_errors):.4f}")
+        if self.projections:
+            num_components = [projection.num_components for projection in self.projections.values()]
+            ratios = [projection.explained_variance_ratio for projection in self.projections.values()]
+            print(f"Projected ats onto {min(num_components)} to {max(num_components)} principal components, "
+                  f"retaining at least {min(ratios):.1%} of their variance")
 
         return kdes, removed_rows
 
     def _regression_kdes(self) -> Tuple[List[gaussian_kde], List[int]]:
-        removed_rows = []
-        row_vectors = np.transpose(self.train_ats)
-        for activation_node in range(row_vectors.shape[0]):
-            if np.var(row_vectors[activation_node]) < self.config.min_var_threshold:
-                removed_rows.append(activation_node)
+        self.train_stats = ClassStatistics.from_ats(self.train_ats)
+        removed_rows = self.train_stats.low_variance_nodes(self.config.min_var_threshold)
         refined_ats = np.transpose(self.train_ats)
         refined_ats = np.delete(refined_ats, removed_rows, axis=0)
         if refined_ats.shape[0] != 0:
+            if self.config.pca_components is not None:
+                self.projections[None] = PCAProjection.fit(np.transpose(refined_ats), self.config.pca_components)
 
             kdes = [self._create_gaussian_kde(refined_ats)]
             return kdes, removed_rows
@@ -347,32 +967,95 @@ class LSA(SurpriseAdequacy):
             raise ValueError(f"All ats were removed by threshold: ", self.config.min_var_threshold)
 
     def _classification_kdes(self) -> Tuple[Dict[int, gaussian_kde], List[int]]:
-        removed_rows = []
-        for label in range(self.config.num_classes):
-            # Shape of (num_activation nodes x num_examples_by_label)
-            row_vectors: np.ndarray = np.transpose(self.train_ats[self.class_matrix[label]])
-            positions: np.ndarray = np.where(np.var(row_vectors) < self.config.min_var_threshold)[0]
-
-            for p in positions:
-                removed_rows.append(p)
-        removed_rows = list(set(removed_rows))
+        # The train ats grouped by class, gathered once for the statistics, the projection and the kdes of all classes
+        grouped_ats, starts = self.class_index.grouped(self.train_ats)
+        self.train_stats = ClassStatistics.from_grouped_ats(grouped_ats, starts)
+        removed_rows = self._classification_removed_rows()
+
+        if self.config.pca_components is not None and not self.config.pca_per_class:
+            refined_ats = np.delete(grouped_ats, removed_rows, axis=1)
+            if refined_ats.shape[1] != 0:
+                self.projections[None] = PCAProjection.fit(refined_ats, self.config.pca_components)
+
+        # Classes without train ats have no kde (their targets are not scored, see `_kde_labels`)
+        labels = [label for label in range(self.config.num_classes) if starts[label + 1] > starts[label]]
+        class_kdes = self._map_classes(
+            lambda label: self._classification_kde(label, removed_rows, grouped_ats[starts[label]:starts[label + 1]]),
+            labels, desc="kde")
 
         kdes = {}
-        for label in tqdm(range(self.config.num_classes), desc="kde"):
+        for label, kde in zip(labels, class_kdes):
+            if kde is None:
+                break
+            kdes[label] = kde
 
-            refined_ats = np.transpose(self.train_ats[self.class_matrix[label]])
-            refined_ats = np.delete(refined_ats, removed_rows, axis=0)
+        return kdes, removed_rows
 
-            if refined_ats.shape[0] == 0:
-                print(f"Ats for label {label} were removed by threshold {self.config.min_var_threshold}")
-                break
+    def _map_classes(self, func: Callable, labels: Sequence[int], desc: Optional[str] = None) -> List:
+        """Applies func to every label in `max_workers` threads, returning the results in the order of the labels.
+        The classes are independent, and the heavy lifting (numpy / BLAS) releases the GIL."""
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            results = executor.map(func, labels)
+            if desc is not None:
+                results = tqdm(results, total=len(labels), desc=desc)
+            return list(results)
+
+    def _classification_removed_rows(self) -> List[int]:
+        # Nodes (i.e., rows of the transposed ats) whose variance is too low in any class
+        return self.train_stats.low_variance_nodes(self.config.min_var_threshold)
+
+    def _classification_kde(self, label: int, removed_rows: List[int],
+                            class_ats: np.ndarray) -> Optional[gaussian_kde]:
+        """The kde of the train ats of the class (Shape of num_examples * num_nodes), without the removed rows"""
+        refined_ats = np.transpose(class_ats)
+        refined_ats = np.delete(refined_ats, removed_rows, axis=0)
 
-            kdes[label] = self._create_gaussian_kde(refined_ats)
+        if refined_ats.shape[0] == 0:
+            print(f"Ats for label {label} were removed by threshold {self.config.min_var_threshold}")
+            return None
 
-        return kdes, removed_rows
+        if self.config.pca_components is not None and self.config.pca_per_class:
+            self.projections[label] = PCAProjection.fit(np.transpose(refined_ats), self.config.pca_components)
 
-    @staticmethod
-    def _create_gaussian_kde(refined_ats):
+        return self._create_gaussian_kde(refined_ats, label=label)
+
+    def _project(self, label: int, refined_ats: np.ndarray) -> np.ndarray:
+        """Applies the projection of the label (if any) to refined ats (Shape of num_examples * num_nodes)"""
+        projection = self.projections.get(label, self.projections.get(None))
+        if projection is None:
+            return refined_ats
+        return projection.transform(refined_ats)
+
+    def _create_gaussian_kde(self, refined_ats: np.ndarray, label: int = 0):
+        """Creates the kde of the configured backend.
+
+        Args:
+            refined_ats (ndarray): The ats of shape (num_nodes x num_examples), as expected by scipy.
+            label (int): The label of the ats (0 for regression).
+        """
+        projection = self.projections.get(label, self.projections.get(None))
+        if projection is not None:
+            refined_ats = np.transpose(projection.transform(np.transpose(refined_ats)))
+        return self._fit_density(refined_ats, label)
+
+    def _fit_density(self, refined_ats: np.ndarray, label: int):
+        """Fits the density estimate of the (projected) refined ats, see `_create_gaussian_kde`,
+        and records whether its points are these ats (see `kdes_on_train_ats`).
+        The data covariance is calculated once here (on the filtered and projected ats), as by scipy."""
+        # The full kde is fitted if the ats are not more than the coreset (see `fit_coreset_kde`)
+        self.kdes_on_train_ats[label] = (self.config.kde_coreset_size is None
+                                         or refined_ats.shape[1] <= self.config.kde_coreset_size)
+        if self.config.kde_coreset_size is not None:
+            kde, report = fit_coreset_kde(refined_ats,
+                                          coreset_size=self.config.kde_coreset_size,
+                                          method=self.config.kde_coreset_method)
+            if report is not None:
+                self.kde_coreset_reports[label] = report
+            else:
+                self.kde_coreset_reports.pop(label, None)
+            return kde
+        if self.config.kde_backend == 'native':
+            return GaussianKDE.from_data_covariance(refined_ats, kde_data_covariance(refined_ats))
         return gaussian_kde(refined_ats)
 
     def _calc_lsa(self,
@@ -401,26 +1084,44 @@ class LSA(SurpriseAdequacy):
 
     def _calc_regression_lsa(self, target_ats: np.ndarray) -> np.ndarray:
         kde = self.kdes[0]
-        refined_at: np.ndarray = np.delete(target_ats, self.removed_rows, axis=1)
+        refined_at: np.ndarray = self._project(0, np.delete(target_ats, self.removed_rows, axis=1))
         return -kde.logpdf(np.transpose(refined_at))
 
     def _calc_classification_lsa(self,
                                  target_ats: np.ndarray,
                                  target_pred: np.ndarray) -> np.ndarray:
-        result = np.empty(shape=target_pred.shape, dtype=float)
+        # Targets predicted as a class without kde are not scored (see `_kde_labels`)
+        result = np.full(shape=target_pred.shape, fill_value=np.nan)
         refined_ats = np.delete(target_ats, self.removed_rows, axis=1)
-        for label in self.class_matrix.keys():
-            for_label_indexes = target_pred == label
-            kde = self.kdes[label]
-            selected_ats = refined_ats[for_label_indexes]
-            result[for_label_indexes] = -kde.logpdf(np.transpose(selected_ats))
+
+        def label_lsa(label):
+            return self._label_lsa(refined_ats, target_pred, label)
+
+        for for_label_indexes, label_result in self._map_classes(label_lsa, self._kde_labels(self.class_index.labels)):
+            result[for_label_indexes] = label_result
         return result
 
+    def _kde_labels(self, labels: Sequence[int]) -> List[int]:
+        """The passed labels which have a kde, i.e., not the classes without train ats
+        or whose ats were all removed by the variance threshold (see `_classification_kdes`).
+        As in the exported scorer (see `export.SurpriseScorer`), the LSA of targets of other classes is nan."""
+        return [label for label in labels if label in self.kdes]
+
+    def _label_lsa(self,
+                   refined_ats: np.ndarray,
+                   target_pred: np.ndarray,
+                   label: int) -> Tuple[np.ndarray, np.ndarray]:
+        """The mask of the targets predicted as label, and their LSA"""
+        for_label_indexes = target_pred == label
+        kde = self.kdes[label]
+        selected_ats = self._project(label, refined_ats[for_label_indexes])
+        return for_label_indexes, -kde.logpdf(np.transpose(selected_ats))
+
 
 class DSA(SurpriseAdequacy):
 
     def __init__(self, model: tf.keras.Model,
-                 train_data: np.ndarray,
+                 train_data: InputData,
                  config: SurpriseAdequacyConfig,
                  dsa_batch_size=500,
                  max_workers=None) -> None:
@@ -428,12 +1129,16 @@ class DSA(SurpriseAdequacy):
         self.dsa_batch_size = dsa_batch_size
         self.max_workers = max_workers
 
-    def calc(self, target_data: np.ndarray, ds_type: str, use_cache=False) -> Tuple[np.ndarray, np.ndarray]:
+    def prep(self, use_cache: bool = False) -> None:
+        super().prep(use_cache=use_cache)
+        self._compress_train_ats()
+
+    def calc(self, target_data: InputData, ds_type: str, use_cache=False) -> Tuple[np.ndarray, np.ndarray]:
         """
         Return DSA values for target. Note that target_data here means both test and adversarial data. Separate calls in main.
 
         Args:
-            target_data (ndarray): x_test or x_target.
+            target_data (InputData): x_test or x_target.
             ds_type (str): Type of dataset: Train, Test, or Target.
             use_cache (bool): Use stored files to load activation traces or not
 
@@ -441,6 +1146,11 @@ class DSA(SurpriseAdequacy):
             dsa (float): List of scalar DSA values
 
         """
+        if self.config.pipeline_calc:
+            print(f"[{ds_type}] Calculating DSA (pipelined)")
+            return self._calc_pipelined(target_data, ds_type, use_cache,
+                                        score_batch=self._calc_dsa_batch, max_workers=self.max_workers)
+
         target_ats, target_pred = self._load_or_calculate_ats(dataset=target_data, ds_type=ds_type, use_cache=use_cache)
         return self._calc_dsa(target_ats, target_pred, ds_type), target_pred
 
@@ -501,21 +1211,52 @@ class DSA(SurpriseAdequacy):
 
         return dsa
 
+    def _calc_dsa_batch(self, target_ats: np.ndarray, target_pred: np.ndarray) -> np.ndarray:
+        """DSA values of a single batch of targets, calculated sequentially (scoring step of `pipeline_calc`)"""
+        dsa = np.empty(shape=target_pred.shape[0])
+        for label in np.unique(target_pred):
+            matches = np.where(target_pred == label)
+            a_min_dist, b_min_dist = self._dsa_distances(label, matches, 0, target_ats)
+            dsa[matches[0]] = a_min_dist / b_min_dist
+        return dsa
+
     def _dsa_distances(self, label: int, matches: np.ndarray, start: int, target_ats: np.ndarray) -> \
             Tuple[np.ndarray, np.ndarray]:
 
         target_matches = target_ats[matches[0] + start]
-        train_matches_same_class = self.train_ats[self.class_matrix[label]]
-        a_dist = target_matches[:, None] - train_matches_same_class
-        a_dist_norms = np.linalg.norm(a_dist, axis=2)
-        a_min_dist = np.min(a_dist_norms, axis=1)
-        closest_position = np.argmin(a_dist_norms, axis=1)
-        closest_ats = train_matches_same_class[closest_position]
-        other_classes_indexes = np.ones(shape=self.train_ats.shape[0], dtype=bool)
-        other_classes_indexes[self.class_matrix[label]] = 0
-        train_matches_other_classes = self.train_ats[other_classes_indexes]
-        b_dist = closest_ats[:, None] - train_matches_other_classes
-        b_dist_norms = np.linalg.norm(b_dist, axis=2)
-        b_min_dist = np.min(b_dist_norms, axis=1)
+        # The train ats are dequantized (if stored with reduced precision) and compared tile by tile,
+        # bounding the size of the differences to the targets (num targets * tile rows * num nodes)
+        tile_rows = max(1, DEFAULT_MAX_TILE_ELEMENTS // max(1, target_matches.size))
+        dtype = np.result_type(target_matches.dtype, np.float32)
+
+        a_min_dist = np.full(shape=target_matches.shape[0], fill_value=np.inf, dtype=dtype)
+        # Targets predicted as a class without train ats get a dsa of nan
+        closest_ats = np.full(shape=target_matches.shape, fill_value=np.nan, dtype=dtype)
+        for train_tile in self._train_ats_tiles(self.class_index.rows(label), tile_rows):
+            a_dist_norms = np.linalg.norm(target_matches[:, None] - train_tile, axis=2)
+            tile_min_dist = np.min(a_dist_norms, axis=1)
+            # Strictly closer only: Ties are resolved by the first train at of the class (as by argmin)
+            closer = tile_min_dist < a_min_dist
+            a_min_dist[closer] = tile_min_dist[closer]
+            closest_ats[closer] = train_tile[np.argmin(a_dist_norms[closer], axis=1)]
+
+        b_min_dist = np.full(shape=closest_ats.shape[0], fill_value=np.inf, dtype=dtype)
+        # For train ats grouped by class, the other classes are the (zero-copy) blocks before and after the class
+        for other_rows in self.class_index.other_rows(label):
+            for train_tile in self._train_ats_tiles(other_rows, tile_rows):
+                b_dist_norms = np.linalg.norm(closest_ats[:, None] - train_tile, axis=2)
+                b_min_dist = np.minimum(b_min_dist, np.min(b_dist_norms, axis=1))
 
         return a_min_dist, b_min_dist
+
+    def _train_ats_tiles(self, rows: RowSelector, tile_rows: int) -> Iterator[np.ndarray]:
+        """The train ats at the passed rows (see `ClassIndex`) in tiles of at most `tile_rows` rows,
+        dequantized tile by tile (see `_train_ats_rows`)"""
+        if isinstance(rows, slice):
+            for tile_start in range(rows.start, rows.stop, tile_rows):
+                yield self._train_ats_rows(slice(tile_start, min(tile_start + tile_rows, rows.stop)))
+            return
+        if rows.dtype == bool:
+            rows = np.flatnonzero(rows)
+        for tile_start in range(0, rows.shape[0], tile_rows):
+            yield self._train_ats_rows(rows[tile_start:tile_start + tile_rows])
@@ -2,5 +2,6 @@ BASE_FOLDER = "/Users/rwiddhichakraborty/PycharmProjects/Thesis/apotoma/mnist_19
 MODELS_BASE_FOLDER = BASE_FOLDER + "models/"
 RESULTS_BASE_FOLDER = BASE_FOLDER + "results/"
 DATASETS_BASE_FOLDER = BASE_FOLDER + "datasets/"
+ATS_BASE_FOLDER = BASE_FOLDER + "ats/"
 
 DSA_BATCH_SIZE = 1000
@@ -8,6 +8,7 @@ import numpy as np
 import tensorflow as tf
 import uncertainty_wizard as uwiz
 
+from apotoma import parallel_extraction
 from apotoma.surprise_adequacy import SurpriseAdequacyConfig
 from case_studies import config, utils
 
@@ -93,14 +94,39 @@ def run_experiments(model_id, model):
     os.mkdir(temp_folder)
     sa_config = SurpriseAdequacyConfig(saved_path=temp_folder, is_classification=True, layer_names=["last_dense"],
                                        ds_name=f"mnist_{model_id}", num_classes=10)
+    # ATs extracted beforehand by `extract_ats` (if any) are read from the AT cache folder
     results = utils.run_experiments(model=model,
                                     train_x=x_train,
                                     test_data=test_data,
-                                    sa_config=sa_config)
+                                    sa_config=sa_config,
+                                    ats_cache_path=_ats_config(model_id).saved_path)
     utils.save_results_to_fs(results=results, case_study="mnist", model_id=model_id)
     shutil.rmtree(temp_folder)
 
 
+def _load_model(model_id):
+    return tf.keras.models.load_model(f"{config.MODELS_BASE_FOLDER}mnist/{model_id}")
+
+
+def _ats_config(model_id):
+    return SurpriseAdequacyConfig(saved_path=config.ATS_BASE_FOLDER, is_classification=True,
+                                  layer_names=["last_dense"], ds_name=f"mnist_{model_id}", num_classes=10)
+
+
+def extract_ats(num_processes):
+    """Extracts the train, test and corrupted ATs of all models in parallel into the AT cache folder,
+    from which `run_experiments` reads them (SAs created with `_ats_config(model_id)` find them there as well,
+    when used with use_cache=True). num_processes=0 extracts them sequentially in this process."""
+    os.makedirs(config.ATS_BASE_FOLDER, exist_ok=True)
+    x_train, _, x_test, _ = _get_dataset()
+    corrupted = np.load(f"{config.DATASETS_BASE_FOLDER}mnist_corrupted.npy") / 255.
+    parallel_extraction.extract_ats_in_parallel(model_loader=_load_model,
+                                                model_ids=list(range(NUM_MODELS)),
+                                                config_factory=_ats_config,
+                                                datasets=[("train", x_train), ("test", x_test), ("test", corrupted)],
+                                                num_processes=num_processes)
+
+
 def train_model(model_id):
     """
     Trains an mnist model. According to https://keras.io/examples/vision/mnist_convnet/, but with an additional layer.
@@ -152,6 +178,7 @@ if __name__ == '__main__':
     #     train_model, num_processes=8, context=TrainContext
     # )
     #
+    # extract_ats(num_processes=4)
     # model_collection.consume(
     #     run_experiments, num_processes=0,
     # )
@@ -1,16 +1,19 @@
+import dataclasses
 import os
 import pickle
 import time
-from typing import Dict, Tuple, List
+from typing import Dict, Tuple, List, Optional
 
 import numpy as np
 from dataclasses import dataclass
 from sklearn import metrics
 
+from apotoma.at_store import ActivationTraceStore
+from apotoma.fingerprint import model_fingerprint
 from apotoma.smart_dsa_by_lsa import DSAbyLSA
 from apotoma.smart_dsa_diffnorms import DiffOfNormsSelectiveDSA
 from apotoma.smart_dsa_normdiffs import NormOfDiffsSelectiveDSA
-from apotoma.surprise_adequacy import DSA, SurpriseAdequacyConfig, SurpriseAdequacy, LSA
+from apotoma.surprise_adequacy import ATExtraction, DSA, SurpriseAdequacyConfig, SurpriseAdequacy, LSA
 from case_studies import config
 
 # Note
@@ -89,19 +92,39 @@ def _time_result(sa_name, sa, x_test):
     return f"{sa_name} : {total_time}"
 
 
+def _load_ats_into_store(model,
+                         sa_config: SurpriseAdequacyConfig,
+                         ats_cache_path: str,
+                         datasets: List[Tuple[str, np.ndarray]]) -> None:
+    """Loads the ATs of the datasets from the AT cache folder (e.g. as filled by `mnist.extract_ats`)
+    into the at store of `sa_config`. ATs not found in the cache are extracted (and cached) as usual."""
+    cache_config = dataclasses.replace(sa_config, saved_path=ats_cache_path)
+    loader = ATExtraction(model=model, config=cache_config, model_fingerprint=model_fingerprint(model))
+    for ds_type, dataset in datasets:
+        loader._load_or_calculate_ats(dataset=dataset, ds_type=ds_type, use_cache=True)
+
+
 def run_experiments(model,
                     sa_config: SurpriseAdequacyConfig,
                     train_x: np.ndarray,
-                    test_data: Dict[str, Tuple[np.ndarray, np.ndarray]]) -> List[Result]:
+                    test_data: Dict[str, Tuple[np.ndarray, np.ndarray]],
+                    ats_cache_path: Optional[str] = None) -> List[Result]:
     results = []
 
     nominal_data = test_data.pop("nominal")
 
+    # All SA instances share the ATs of the train set (train subsets are served as views) and of the test sets
+    sa_config = dataclasses.replace(sa_config, at_store=ActivationTraceStore())
+    if ats_cache_path is not None:
+        # ATs extracted beforehand are read once from the AT cache, afterwards they are served by the at store
+        test_sets = [("test", nominal_data[0])] + [("test", x) for x, _ in test_data.values()]
+        _load_ats_into_store(model, sa_config, ats_cache_path, [("train", train_x)] + test_sets)
+
     # Make sure inner lsa is cached for the smart dsa approach afterwards
     inner_lsa = LSA(model=model, train_data=train_x, config=sa_config)
     inner_lsa.prep(use_cache=False)
-    lsa_values = inner_lsa._calc_lsa(target_ats=np.copy(inner_lsa.train_ats),
-                                     target_pred=np.copy(inner_lsa.train_pred))
+    # Leave-one-out likelihoods of the train ats, in extraction order (as the train ats of the dsa_by_lsa instances)
+    lsa_values = inner_lsa.train_lsa()
     for thresh_count, select_share in enumerate(range(10, 101, 10)):
         select_share /= 100
         dsa_by_lsa = DSAbyLSA(model=model, train_data=train_x, config=sa_config,
@@ -0,0 +1,332 @@
+import os
+import shutil
+import unittest
+from unittest import mock
+from concurrent.futures.thread import ThreadPoolExecutor
+
+import numpy as np
+import tensorflow as tf
+
+from apotoma import surprise_adequacy
+from apotoma.activation_traces import ATLayout, ATQuantization
+from apotoma.at_store import ActivationTraceStore
+from apotoma.inputs import array_dataset
+from apotoma.smart_dsa_by_lsa import DSAbyLSA
+from apotoma.surprise_adequacy import DSA, LSA
+from apotoma.surprise_adequacy import SurpriseAdequacyConfig
+
+
+def _small_conv_model() -> tf.keras.Model:
+    inputs = tf.keras.Input(shape=(8, 8, 1))
+    x = tf.keras.layers.Conv2D(4, kernel_size=(3, 3), activation="relu", name="conv")(inputs)
+    x = tf.keras.layers.Flatten()(x)
+    x = tf.keras.layers.Dense(6, activation="relu", name="dense")(x)
+    outputs = tf.keras.layers.Dense(3, activation="softmax", name="output")(x)
+    return tf.keras.Model(inputs=inputs, outputs=outputs)
+
+
+class TestActivationExtraction(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.path = '/tmp/data_extraction/'
+        if os.path.exists(self.path):
+            shutil.rmtree(self.path)
+        os.mkdir(self.path)
+        tf.random.set_seed(0)
+        np.random.seed(0)
+        self.model = _small_conv_model()
+        self.data = np.random.rand(50, 8, 8, 1).astype("float32")
+
+    def _config(self, **kwargs) -> SurpriseAdequacyConfig:
+        kwargs.setdefault("layer_names", ['conv', 'dense'])
+        return SurpriseAdequacyConfig(saved_path=self.path, is_classification=True, ds_name='small', num_classes=3,
+                                      batch_size=16, **kwargs)
+
+    def test_streaming_ats_match_full_predict(self):
+        expected_ats, expected_pred = DSA(self.model, self.data, config=self._config())._calculate_ats(self.data)
+        ats, pred = DSA(self.model, self.data, config=self._config(stream_ats=True))._calculate_ats(self.data)
+
+        self.assertEqual(ats.shape, (50, 4 + 6))
+        self.assertEqual(ats.dtype, np.float32)
+        np.testing.assert_almost_equal(ats, expected_ats, decimal=5)
+        np.testing.assert_equal(pred, expected_pred)
+
+    def test_fused_dim_reduction_matches_output_dim_reduction(self):
+        expected_ats, expected_pred = DSA(self.model, self.data, config=self._config())._calculate_ats(self.data)
+        for stream in (False, True):
+            config = self._config(stream_ats=stream, fuse_dim_reduction=True)
+            sa = DSA(self.model, self.data, config=config)
+            self.assertEqual(tuple(sa._get_extractor().temp_model.outputs[0].shape[1:]), (4,))
+            ats, pred = sa._calculate_ats(self.data)
+            np.testing.assert_almost_equal(ats, expected_ats, decimal=5)
+            np.testing.assert_equal(pred, expected_pred)
+
+    def test_extractor_is_shared_per_model_and_layers(self):
+        first = DSA(self.model, self.data, config=self._config())._get_extractor()
+        second = DSA(self.model, self.data, config=self._config(stream_ats=True))._get_extractor()
+        self.assertIs(first, second)
+        fused = DSA(self.model, self.data, config=self._config(fuse_dim_reduction=True))._get_extractor()
+        self.assertIsNot(first, fused)
+
+    def test_at_store_serves_row_ranges_as_views(self):
+        config = self._config(at_store=ActivationTraceStore())
+        full_ats, full_pred = DSA(self.model, self.data, config=config)._load_or_calculate_ats(self.data, "train",
+                                                                                               use_cache=False)
+        subset_sa = DSA(self.model, self.data[:20], config=config)
+        subset_sa._calculate_ats = None  # Must not be called
+        for start in (0, 10):
+            ats, pred = subset_sa._load_or_calculate_ats(self.data[start:start + 20], "train", use_cache=False)
+            self.assertTrue(np.shares_memory(ats, full_ats))
+            self.assertFalse(ats.flags.writeable)
+            np.testing.assert_equal(ats, full_ats[start:start + 20])
+            np.testing.assert_equal(pred, full_pred[start:start + 20])
+
+        self.assertIsNone(config.at_store.get(self.model, config.layer_names, np.copy(self.data)))
+        self.assertIsNone(config.at_store.get(self.model, config.layer_names, self.data[::2]))
+
+    def test_at_layout_views_per_layer(self):
+        config = self._config(at_store=ActivationTraceStore())
+        sa = DSA(self.model, self.data, config=config)
+        self.assertEqual(sa.at_layout, ATLayout(layer_names=('conv', 'dense'), widths=(4, 6)))
+        ats, pred = sa._load_or_calculate_ats(self.data, "train", use_cache=False)
+
+        dense_ats = sa.at_layout.view(ats, ['dense'])
+        self.assertTrue(np.shares_memory(dense_ats, ats))
+        np.testing.assert_equal(dense_ats, ats[:, 4:])
+        np.testing.assert_equal(sa.at_layout.view(ats, ['dense', 'conv']), np.concatenate([ats[:, 4:], ats[:, :4]], 1))
+
+        # Layer subsets are served from the store
+        dense_sa = DSA(self.model, self.data, config=self._config(at_store=config.at_store, layer_names=['dense']))
+        dense_sa._calculate_ats = None  # Must not be called
+        stored_ats, _ = dense_sa._load_or_calculate_ats(self.data[:10], "train", use_cache=False)
+        self.assertTrue(np.shares_memory(stored_ats, ats))
+        np.testing.assert_equal(stored_ats, ats[:10, 4:])
+
+    def test_saved_paths_are_content_addressed(self):
+        sa = DSA(self.model, self.data, config=self._config())
+        self.assertEqual(sa._get_saved_path("train", self.data), sa._get_saved_path("train", np.copy(self.data)))
+        self.assertNotEqual(sa._get_saved_path("train", self.data)[0], sa._get_saved_path("train", self.data[:20])[0])
+        other_layers = DSA(self.model, self.data, config=self._config(layer_names=['dense']))
+        ats_path, pred_path = sa._get_saved_path("train", self.data)
+        other_ats_path, other_pred_path = other_layers._get_saved_path("train", self.data)
+        self.assertNotEqual(ats_path, other_ats_path)
+        self.assertEqual(pred_path, other_pred_path)
+        other_model = DSA(_small_conv_model(), self.data, config=self._config())
+        self.assertNotEqual(ats_path, other_model._get_saved_path("train", self.data)[0])
+
+        ats, pred = sa._load_or_calculate_ats(self.data, "train", use_cache=True)
+        for layer_name in ['conv', 'dense']:
+            self.assertTrue(os.path.exists(sa._get_layer_saved_path("train", self.data, layer_name)))
+        self.assertEqual(other_ats_path, sa._get_layer_saved_path("train", self.data, 'dense'))
+        sa._calculate_ats = None  # Must not be called
+        cached_ats, cached_pred = sa._load_or_calculate_ats(np.copy(self.data), "train", use_cache=True)
+        np.testing.assert_equal(cached_ats, ats)
+        np.testing.assert_equal(cached_pred, pred)
+
+    def test_model_is_fingerprinted_once(self):
+        for mmap_ats in (False, True):
+            shutil.rmtree(self.path)
+            os.mkdir(self.path)
+            with mock.patch.object(surprise_adequacy, 'model_fingerprint',
+                                   wraps=surprise_adequacy.model_fingerprint) as fingerprint:
+                lsa = LSA(self.model, self.data, config=self._config(mmap_ats=mmap_ats))
+                # Extracted and cached, then loaded from the cache, and the kdes keyed on the same fingerprint
+                for use_cache in (False, True, True):
+                    lsa._load_or_calculate_ats(self.data, "train", use_cache=use_cache)
+                lsa._get_kde_saved_path()
+                self.assertEqual(fingerprint.call_count, 1)
+
+    def test_ats_served_by_the_at_store_are_not_fingerprinted(self):
+        at_store = ActivationTraceStore()
+        for layer_name in ('dense', 'conv'):
+            DSA(self.model, self.data, config=self._config(layer_names=[layer_name], at_store=at_store)) \
+                ._load_or_calculate_ats(self.data, "train", use_cache=False)
+        with mock.patch.object(surprise_adequacy, 'model_fingerprint', side_effect=AssertionError("fingerprinted")):
+            # Assembled from the stored ats of the individual layers
+            sa = DSA(self.model, self.data, config=self._config(at_store=at_store))
+            ats, _ = sa._load_or_calculate_ats(self.data, "train", use_cache=False)
+        self.assertEqual(ats.shape, (50, 10))
+
+    def test_architecture_is_fingerprinted(self):
+        def dense_model(activation):
+            inputs = tf.keras.Input(shape=(8, 8, 1), name="inputs")
+            x = tf.keras.layers.Flatten(name="flatten")(inputs)
+            x = tf.keras.layers.Dense(6, activation=activation, name="dense")(x)
+            outputs = tf.keras.layers.Dense(3, activation="softmax", name="output")(x)
+            return tf.keras.Model(inputs=inputs, outputs=outputs, name="dense_model")
+
+        relu_model, tanh_model = dense_model("relu"), dense_model("tanh")
+        tanh_model.set_weights(relu_model.get_weights())
+        paths = [DSA(model, self.data, config=self._config(layer_names=['dense']))._get_saved_path("train", self.data)
+                 for model in (relu_model, tanh_model)]
+        self.assertNotEqual(paths[0][0], paths[1][0])
+        self.assertNotEqual(paths[0][1], paths[1][1])
+
+    def test_ats_are_cached_per_layer(self):
+        expected_ats, expected_pred = DSA(self.model, self.data, config=self._config())._calculate_ats(self.data)
+        for at_store in (None, ActivationTraceStore()):
+            shutil.rmtree(self.path)
+            os.mkdir(self.path)
+            extracted_layers = []
+
+            def sa(layer_names):
+                instance = DSA(self.model, self.data, config=self._config(layer_names=layer_names, at_store=at_store))
+                calculate_ats = instance._calculate_ats
+
+                def recording_calculate_ats(dataset, layer_names=None):
+                    extracted_layers.append(layer_names)
+                    return calculate_ats(dataset, layer_names)
+
+                instance._calculate_ats = recording_calculate_ats
+                return instance
+
+            sa(['dense'])._load_or_calculate_ats(self.data, "train", use_cache=True)
+            ats, pred = sa(['conv', 'dense'])._load_or_calculate_ats(self.data, "train", use_cache=True)
+            np.testing.assert_almost_equal(ats, expected_ats, decimal=5)
+            np.testing.assert_equal(pred, expected_pred)
+            ats, _ = sa(['dense', 'conv'])._load_or_calculate_ats(self.data, "train", use_cache=True)
+            np.testing.assert_almost_equal(ats, expected_ats[:, [4, 5, 6, 7, 8, 9, 0, 1, 2, 3]], decimal=5)
+            self.assertEqual(extracted_layers, [['dense'], ['conv']])
+
+    def test_mmap_ats_are_written_and_loaded_memory_mapped(self):
+        expected_ats, expected_pred = DSA(self.model, self.data, config=self._config())._calculate_ats(self.data)
+        sa = DSA(self.model, self.data, config=self._config(mmap_ats=True))
+        for _ in range(2):
+            ats, pred = sa._load_or_calculate_ats(self.data, "train", use_cache=True)
+            self.assertIsInstance(ats, np.memmap)
+            self.assertFalse(ats.flags.writeable)
+            np.testing.assert_almost_equal(ats, expected_ats, decimal=5)
+            np.testing.assert_equal(pred, expected_pred)
+        self.assertEqual([f for f in os.listdir(self.path) if "partial" in f], [])
+
+    def test_reduced_precision_train_ats(self):
+        ats, _ = DSA(self.model, self.data, config=self._config())._calculate_ats(self.data)
+        column_range = np.max(ats, axis=0) - np.min(ats, axis=0)
+        for precision, dtype in (('float16', np.float16), ('int8', np.int8)):
+            quantization = ATQuantization.fit(ats, precision)
+            quantized = quantization.quantize(ats)
+            self.assertEqual(quantized.dtype, dtype)
+            dequantized = quantization.dequantize(quantized)
+            self.assertEqual(dequantized.dtype, np.float32)
+            self.assertTrue(np.all(np.abs(dequantized - ats) <= column_range / 255 + 1e-3 * np.abs(ats) + 1e-6))
+
+        train_ats = np.random.rand(300, 10).astype(np.float32)
+        train_pred = np.arange(300) % 3
+        target_ats = np.random.rand(50, 10).astype(np.float32)
+        target_pred = np.arange(50) % 3
+        expected = None
+        for precision in ('float32', 'float16', 'int8'):
+            dsa = DSA(self.model, self.data, config=self._config(ats_precision=precision))
+            dsa.train_ats, dsa.train_pred = train_ats, train_pred
+            dsa._index_classes()
+            dsa._compress_train_ats()
+            self.assertEqual(dsa.train_ats.dtype, np.dtype(precision))
+            actual = dsa._calc_dsa(target_ats, target_pred, "test")
+            if expected is None:
+                expected = actual
+            # DSA is a ratio of (possibly small) distances, hence int8 quantization is only accurate on average
+            self.assertLess(np.mean(np.abs(actual - expected) / expected), 0.05)
+
+    def test_pipelined_calc_matches_sequential_calc(self):
+        target_data = np.random.rand(40, 8, 8, 1).astype("float32")
+        # Weights for which all classes are predicted on train and target data
+        rng = np.random.RandomState(6)
+        for layer in self.model.layers:
+            layer.set_weights([rng.normal(size=w.shape).astype("float32") for w in layer.get_weights()])
+        dsa = DSA(self.model, self.data, config=self._config())
+        dsa.prep()
+        expected_dsa, expected_pred = dsa.calc(target_data, ds_type='test', use_cache=False)
+
+        store = ActivationTraceStore()
+        pipelined = DSA(self.model, self.data, config=self._config(pipeline_calc=True, at_store=store))
+        pipelined.prep()
+        for _ in range(2):
+            # The second calc finds the target ats in the store
+            actual_dsa, actual_pred = pipelined.calc(target_data, ds_type='test', use_cache=False)
+            np.testing.assert_almost_equal(actual_dsa, expected_dsa, decimal=5)
+            np.testing.assert_equal(actual_pred, expected_pred)
+        self.assertIsNotNone(store.get(self.model, ['conv', 'dense'], target_data))
+
+    def test_online_lsa_score_matches_calc(self):
+        target_data = np.random.rand(40, 8, 8, 1).astype("float32")
+        rng = np.random.RandomState(6)
+        for layer in self.model.layers:
+            layer.set_weights([rng.normal(size=w.shape).astype("float32") for w in layer.get_weights()])
+        lsa = LSA(self.model, self.data, config=self._config(layer_names=['dense'], min_var_threshold=1e-8))
+        lsa.prep()
+        expected_lsa, expected_pred = lsa.calc(target_data, ds_type='test', use_cache=False)
+
+        actual_lsa, actual_pred = lsa.score(target_data)
+        np.testing.assert_almost_equal(actual_lsa, expected_lsa, decimal=4)
+        np.testing.assert_equal(actual_pred, expected_pred)
+
+        single_lsa, single_pred = lsa.score(target_data[3])
+        self.assertEqual(single_lsa.shape, (1,))
+        np.testing.assert_almost_equal(single_lsa[0], expected_lsa[3], decimal=4)
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            results = list(executor.map(lambda i: lsa.score(target_data[i:i + 2])[0], range(0, 40, 2)))
+        np.testing.assert_almost_equal(np.concatenate(results), expected_lsa, decimal=4)
+
+    def test_dsa_by_lsa_with_precomputed_train_lsa(self):
+        rng = np.random.RandomState(6)
+        for layer in self.model.layers:
+            layer.set_weights([rng.normal(size=w.shape).astype("float32") for w in layer.get_weights()])
+        # Store views are not sorted by class, while privately extracted ats would have been
+        config = self._config(layer_names=['dense'], min_var_threshold=1e-8, at_store=ActivationTraceStore())
+        lsa = LSA(self.model, self.data, config=config)
+        lsa.prep()
+        likelihoods = lsa.train_lsa()
+
+        precomputed = DSAbyLSA(self.model, self.data, config=config, select_share=0.5,
+                               precomputed_likelihoods=likelihoods)
+        precomputed.prep()
+        inner = DSAbyLSA(self.model, self.data, config=config, select_share=0.5)
+        inner.prep()
+        np.testing.assert_equal(precomputed.train_ats, inner.train_ats)
+
+        # Every class keeps its ats of the lowest likelihoods (in the order of the extracted train ats)
+        all_ats, all_pred = DSA(self.model, self.data, config=config)._calculate_ats(self.data)
+        for label in range(3):
+            rows = np.flatnonzero(all_pred == label)
+            expected_rows = rows[np.argsort(likelihoods[rows])[:int(rows.shape[0] * 0.5)]]
+            np.testing.assert_equal(precomputed.train_ats[precomputed.train_pred == label], all_ats[expected_rows])
+
+    def test_dsa_by_lsa_extend_matches_full_preparation(self):
+        rng = np.random.RandomState(6)
+        for layer in self.model.layers:
+            layer.set_weights([rng.normal(size=w.shape).astype("float32") for w in layer.get_weights()])
+        config = self._config(layer_names=['dense'], min_var_threshold=1e-8)
+        full = DSAbyLSA(self.model, self.data, config=config, select_share=0.5)
+        full.prep()
+        likelihoods = full.inner_lsa.train_lsa()
+
+        for precomputed in (None, likelihoods[:30]):
+            extended = DSAbyLSA(self.model, self.data[:30], config=config, select_share=0.5,
+                                precomputed_likelihoods=precomputed)
+            extended.prep()
+            extended.extend(self.data[30:])
+
+            # The selection is made again amongst all train ats, by the likelihoods of the extended inner lsa
+            np.testing.assert_allclose(extended.inner_lsa.train_lsa(), likelihoods, rtol=1e-6)
+            np.testing.assert_allclose(extended.train_ats, full.train_ats, rtol=1e-6)
+            np.testing.assert_equal(extended.train_pred, full.train_pred)
+            self.assertEqual(extended.number_of_samples, full.number_of_samples)
+
+    def test_non_array_inputs(self):
+        expected_ats, expected_pred = DSA(self.model, self.data, config=self._config())._calculate_ats(self.data)
+        memmap_path = os.path.join(self.path, "inputs.npy")
+        np.save(memmap_path, self.data)
+        memmap = np.load(memmap_path, mmap_mode='r')
+
+        inputs = {
+            "memmap": memmap,
+            "tf.data": tf.data.Dataset.from_tensor_slices((self.data, np.zeros(50))).batch(16),
+            "generator": (self.data[i:i + 7] for i in range(0, 50, 7)),
+            "array_dataset": array_dataset(memmap, batch_size=16, preprocess=lambda x: x * 1),
+        }
+        for name, data in inputs.items():
+            ats, pred = DSA(self.model, data, config=self._config())._calculate_ats(data)
+            self.assertEqual(ats.shape, expected_ats.shape, msg=name)
+            np.testing.assert_almost_equal(ats, expected_ats, decimal=5, err_msg=name)
+            np.testing.assert_equal(pred, expected_pred, err_msg=name)
@@ -0,0 +1,54 @@
+import unittest
+
+import numpy as np
+
+from apotoma.class_index import ClassIndex
+
+
+class TestClassIndex(unittest.TestCase):
+
+    def test_unsorted_labels(self):
+        labels = np.array([2, 0, 1, 0, 2, 0])
+        index = ClassIndex.from_labels(labels, num_classes=4)
+        self.assertFalse(index.is_contiguous)
+        self.assertEqual(len(index), 6)
+        np.testing.assert_equal(index.rows(0), [1, 3, 5])
+        np.testing.assert_equal(index.rows(2), [0, 4])
+        np.testing.assert_equal(index.rows(3), [])
+        np.testing.assert_equal(index.labels, [0, 1, 2])
+        np.testing.assert_equal(np.flatnonzero(index.other_rows(0)[0]), [0, 2, 4])
+
+    def test_sorted_labels_are_sliced(self):
+        ats = np.arange(12).reshape(6, 2)
+        index = ClassIndex.from_labels(np.array([0, 0, 1, 2, 2, 2]), num_classes=3)
+        self.assertTrue(index.is_contiguous)
+        self.assertEqual(index.rows(1), slice(2, 3))
+        self.assertTrue(np.shares_memory(ats[index.rows(2)], ats))
+        self.assertEqual(index.other_rows(1), [slice(0, 2), slice(3, 6)])
+
+    def test_subset_and_extension(self):
+        labels = np.array([0, 1, 0, 1])
+        index = ClassIndex.from_labels(labels, num_classes=2, rows=np.array([0, 3]))
+        self.assertEqual(len(index), 2)
+        self.assertEqual(index.count(0), 1)
+        np.testing.assert_equal(np.flatnonzero(index.other_rows(0)[0]), [1, 2, 3])
+
+        extended = index.extended(np.array([0, 1, 0, 1, 1, 0]))
+        self.assertEqual(extended.num_rows, 6)
+        np.testing.assert_equal(extended.rows(0), [0, 5])
+        np.testing.assert_equal(extended.rows(1), [3, 4])
+
+    def test_grouped(self):
+        ats = np.arange(12).reshape(6, 2)
+        index = ClassIndex.from_labels(np.array([2, 0, 1, 0, 2, 0]), num_classes=4)
+        grouped, starts = index.grouped(ats)
+        np.testing.assert_equal(starts, [0, 3, 4, 6, 6])
+        for label in range(4):
+            np.testing.assert_equal(grouped[starts[label]:starts[label + 1]], ats[index.rows(label)])
+
+        grouped, starts = index.grouped(ats, labels=[2, 0])
+        np.testing.assert_equal(starts, [0, 2, 5])
+        np.testing.assert_equal(grouped, ats[[0, 4, 1, 3, 5]])
+
+        sorted_index = ClassIndex.from_labels(np.array([0, 0, 1, 2, 2, 2]), num_classes=3)
+        self.assertTrue(np.shares_memory(sorted_index.grouped(ats)[0], ats))
@@ -0,0 +1,59 @@
+import unittest
+from unittest import mock
+
+import numpy as np
+from scipy.stats import gaussian_kde
+
+from apotoma import class_stats
+from apotoma.class_index import ClassIndex
+from apotoma.class_stats import ClassStatistics, kde_data_covariance
+
+
+class TestClassStatistics(unittest.TestCase):
+
+    def setUp(self) -> None:
+        rng = np.random.RandomState(0)
+        self.labels = rng.randint(0, 3, size=300)
+        self.ats = (rng.normal(size=(300, 4)) * [1, 2, 3, 4] + self.labels[:, None]).astype(np.float32)
+        self.ats[self.labels == 2, 1] = 7
+
+    def test_statistics_per_class(self):
+        index = ClassIndex.from_labels(self.labels, num_classes=4)
+        stats = ClassStatistics.from_ats(self.ats, index)
+        for label in range(3):
+            class_ats = self.ats[self.labels == label]
+            self.assertEqual(stats.counts[label], class_ats.shape[0])
+            np.testing.assert_allclose(stats.means[label], np.mean(class_ats, axis=0, dtype=np.float64))
+            np.testing.assert_allclose(stats.variances[label], np.var(class_ats, axis=0, dtype=np.float64),
+                                       atol=1e-12)
+        self.assertEqual(stats.counts[3], 0)
+        self.assertEqual(stats.low_variance_nodes(1e-5), [1])
+
+    def test_chunked_statistics(self):
+        index = ClassIndex.from_labels(self.labels, num_classes=4)
+        expected = ClassStatistics.from_ats(self.ats, index)
+        # Chunks of 7 rows, such that classes span several chunks and chunks span several classes
+        with mock.patch.object(class_stats, '_MAX_CHUNK_ELEMENTS', 7 * 4):
+            chunked = ClassStatistics.from_ats(self.ats, index)
+        np.testing.assert_array_equal(chunked.counts, expected.counts)
+        np.testing.assert_allclose(chunked.means, expected.means, rtol=1e-12)
+        np.testing.assert_allclose(chunked.variances, expected.variances, rtol=1e-12)
+
+    def test_kde_data_covariance_is_scipys(self):
+        for label in range(3):
+            dataset = np.delete(np.transpose(self.ats[self.labels == label]), [1], axis=0)
+            np.testing.assert_array_equal(kde_data_covariance(dataset), gaussian_kde(dataset)._data_covariance)
+
+    def test_single_class_and_update(self):
+        stats = ClassStatistics.from_ats(self.ats)
+        self.assertEqual(stats.counts.tolist(), [300])
+        np.testing.assert_allclose(stats.variances[0], np.var(self.ats, axis=0, dtype=np.float64))
+
+        index = ClassIndex.from_labels(self.labels[:200], num_classes=3)
+        extended_index = index.extended(self.labels)
+        updated = ClassStatistics.from_ats(self.ats[:200], index).updated(*extended_index.grouped(self.ats, [0, 1, 2]),
+                                                                          labels=[0, 1, 2])
+        expected = ClassStatistics.from_ats(self.ats, ClassIndex.from_labels(self.labels, num_classes=3))
+        np.testing.assert_allclose(updated.means, expected.means)
+        np.testing.assert_allclose(updated.variances, expected.variances, atol=1e-12)
+        np.testing.assert_array_equal(updated.counts, expected.counts)
@@ -0,0 +1,54 @@
+import os
+import shutil
+import unittest
+
+import numpy as np
+import tensorflow as tf
+
+from apotoma.export import export_scorer
+from apotoma.surprise_adequacy import DSA, LSA
+from apotoma.surprise_adequacy import SurpriseAdequacyConfig
+
+
+def _small_dense_model() -> tf.keras.Model:
+    inputs = tf.keras.Input(shape=(4, 4, 1))
+    x = tf.keras.layers.Conv2D(3, kernel_size=(2, 2), activation="tanh", name="conv")(inputs)
+    x = tf.keras.layers.Flatten()(x)
+    x = tf.keras.layers.Dense(4, activation="tanh", name="dense")(x)
+    outputs = tf.keras.layers.Dense(3, activation="softmax", name="output")(x)
+    return tf.keras.Model(inputs=inputs, outputs=outputs)
+
+
+class TestExport(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.path = '/tmp/export/'
+        shutil.rmtree(self.path, ignore_errors=True)
+        os.mkdir(self.path)
+        tf.random.set_seed(0)
+        rng = np.random.RandomState(0)
+        self.model = _small_dense_model()
+        self.train_data = rng.normal(size=(300, 4, 4, 1)).astype("float32")
+        self.target_data = rng.normal(size=(40, 4, 4, 1)).astype("float32") * 1.5
+
+    def _config(self, **kwargs) -> SurpriseAdequacyConfig:
+        return SurpriseAdequacyConfig(saved_path=self.path, is_classification=True, layer_names=['conv', 'dense'],
+                                      ds_name='small', num_classes=3, batch_size=64, **kwargs)
+
+    def _assert_exported_scores_match(self, sa, rtol):
+        sa.prep()
+        expected, expected_pred = sa.calc(self.target_data, "test")
+        export_scorer(sa, os.path.join(self.path, "scorer"))
+
+        serve = tf.saved_model.load(os.path.join(self.path, "scorer")).signatures["serving_default"]
+        result = serve(inputs=tf.constant(self.target_data))
+        np.testing.assert_equal(result["prediction"].numpy(), expected_pred)
+        np.testing.assert_allclose(result["surprise"].numpy(), expected, rtol=rtol)
+
+    def test_lsa(self):
+        for kwargs in (dict(), dict(kde_backend='native', pca_components=5, pca_per_class=True)):
+            self._assert_exported_scores_match(LSA(self.model, self.train_data, config=self._config(**kwargs)),
+                                               rtol=1e-6)
+
+    def test_dsa(self):
+        self._assert_exported_scores_match(DSA(self.model, self.train_data, config=self._config()), rtol=1e-4)
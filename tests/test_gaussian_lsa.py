@@ -0,0 +1,76 @@
+import unittest
+
+import numpy as np
+from scipy.stats import multivariate_normal
+
+from apotoma.gaussian_lsa import GaussianLSA
+from apotoma.surprise_adequacy import LSA
+from apotoma.surprise_adequacy import SurpriseAdequacyConfig
+
+
+class TestGaussianLSA(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.config = SurpriseAdequacyConfig(saved_path='/tmp/', is_classification=True, layer_names=['activation_3'],
+                                             ds_name='mnist', num_classes=10)
+        self.train_ats = np.load("./tests/assets/original_mnist_train_activation_3_ats.npy")
+        self.train_pred = np.load("./tests/assets/original_mnist_train_pred.npy")
+        self.target_ats = np.load("./tests/assets/mnist_test_activation_3_ats.npy")
+        self.target_pred = np.load("./tests/assets/mnist_test_pred.npy")
+
+    def _prepared(self, sa_class, config):
+        sa = sa_class(model=None, train_data=None, config=config)
+        sa.train_ats = self.train_ats
+        sa.train_pred = self.train_pred
+        sa._index_classes()
+        sa._load_or_create_likelyhood_estimator(use_cache=False)
+        return sa
+
+    def _prepared_on_synthetic_ats(self) -> GaussianLSA:
+        # Synthetic, well conditioned ats (the mnist ats are softmax outputs, with a near-singular covariance)
+        rng = np.random.RandomState(0)
+        train_pred = rng.randint(0, 3, size=900)
+        train_ats = rng.normal(size=(900, 4)) * [1, 2, 3, 4] + train_pred[:, None]
+        config = SurpriseAdequacyConfig(saved_path='/tmp/', is_classification=True, layer_names=['synthetic'],
+                                        ds_name='synthetic', num_classes=3)
+        sa = GaussianLSA(model=None, train_data=None, config=config)
+        sa.train_ats, sa.train_pred = train_ats, train_pred
+        sa._index_classes()
+        sa._load_or_create_likelyhood_estimator(use_cache=False)
+        return sa
+
+    def test_scores_are_negative_gaussian_log_likelihoods(self):
+        sa = self._prepared_on_synthetic_ats()
+        train_ats, train_pred = sa.train_ats, sa.train_pred
+        rng = np.random.RandomState(1)
+        target_pred = rng.randint(0, 3, size=50)
+        target_ats = rng.normal(size=(50, 4)) * 3 + target_pred[:, None]
+        scores = sa.score_ats(target_ats, target_pred)
+
+        for label in range(3):
+            class_ats = train_ats[train_pred == label]
+            gaussian = multivariate_normal(mean=np.mean(class_ats, axis=0), cov=np.cov(class_ats, rowvar=False))
+            mask = target_pred == label
+            np.testing.assert_allclose(scores[mask], -gaussian.logpdf(target_ats[mask]), rtol=1e-8)
+
+    def test_scoring_cost_is_independent_of_train_size(self):
+        gaussian_lsa = self._prepared(GaussianLSA, self.config)
+        # A single kernel per class, whatever the number of train ats
+        self.assertTrue(all(kde.n == 1 for kde in gaussian_lsa.kdes.values()))
+
+        scores = gaussian_lsa._calc_lsa(self.target_ats, self.target_pred)
+        self.assertTrue(np.all(np.isfinite(scores)))
+
+        # The parametric and the kde surprise rank the targets similarly
+        kde_scores = self._prepared(LSA, self.config)._calc_lsa(self.target_ats, self.target_pred)
+        self.assertGreater(np.corrcoef(scores, kde_scores)[0, 1], 0.5)
+
+    def test_train_ats_are_scored_as_targets(self):
+        sa = self._prepared_on_synthetic_ats()
+        self.assertFalse(any(sa.kdes_on_train_ats.values()))
+        np.testing.assert_allclose(sa.train_lsa(), sa._calc_lsa(sa.train_ats, sa.train_pred), rtol=1e-8)
+
+        # Also for a class with a single train at, although its gaussian has a single point as well
+        rows = sa.class_index.rows(0)[:1]
+        np.testing.assert_allclose(sa._kde_train_lsa(0, rows, num_rows=1, leave_one_out=True),
+                                   sa._calc_lsa(sa.train_ats[rows], sa.train_pred[rows]), rtol=1e-8)
@@ -0,0 +1,145 @@
+import unittest
+from unittest import mock
+
+import numpy as np
+from scipy.stats import gaussian_kde
+
+from apotoma import kde as kde_module
+from apotoma.kde import GaussianKDE, CORESET_METHODS, fit_coreset_kde
+from apotoma.surprise_adequacy import LSA
+from apotoma.surprise_adequacy import SurpriseAdequacyConfig
+
+
+class TestGaussianKDE(unittest.TestCase):
+
+    def setUp(self) -> None:
+        rng = np.random.RandomState(0)
+        self.dataset = rng.normal(size=(5, 400)) + np.arange(5)[:, None]
+        self.points = rng.normal(size=(5, 150)) * 2
+
+    def test_logpdf_matches_scipy(self):
+        scipy_kde = gaussian_kde(self.dataset)
+        expected = scipy_kde.logpdf(self.points)
+        # Tiny tiles exercise the streaming over train and target tiles
+        for max_tile_elements in (2 ** 22, 100):
+            kde = GaussianKDE.from_scipy(scipy_kde, max_tile_elements=max_tile_elements)
+            np.testing.assert_allclose(kde.logpdf(self.points), expected, rtol=1e-10)
+        np.testing.assert_allclose(kde.logpdf(self.points[:, 0]), expected[:1], rtol=1e-10)
+        kde = GaussianKDE.from_scipy(scipy_kde, dtype=np.float32)
+        np.testing.assert_allclose(kde.logpdf(self.points), expected, rtol=1e-4)
+
+    def test_weights_and_covariance(self):
+        weights = np.random.RandomState(1).rand(400)
+        scipy_kde = gaussian_kde(self.dataset, weights=weights)
+        kde = GaussianKDE(self.dataset, covariance=scipy_kde.covariance, weights=weights)
+        np.testing.assert_allclose(kde.logpdf(self.points), scipy_kde.logpdf(self.points), rtol=1e-8)
+
+    def test_self_log_kernel_sums(self):
+        scipy_kde = gaussian_kde(self.dataset)
+        for max_tile_elements in (2 ** 22, 100):
+            kde = GaussianKDE.from_scipy(scipy_kde, max_tile_elements=max_tile_elements)
+            np.testing.assert_allclose(kde.self_log_kernel_sums(leave_one_out=False) - kde.log_norm,
+                                       scipy_kde.logpdf(self.dataset), rtol=1e-10)
+            # Every point evaluated by the estimate of the other points, with the same kernel
+            expected = [GaussianKDE(np.delete(self.dataset, i, axis=1), kde.covariance).logpdf(self.dataset[:, i])[0]
+                        for i in range(0, self.dataset.shape[1], 7)]
+            actual = kde.self_log_kernel_sums() - kde.log_norm
+            np.testing.assert_allclose(actual[::7], expected, rtol=1e-10)
+
+        with self.assertRaises(ValueError):
+            GaussianKDE(self.dataset[:, :1], covariance=np.eye(5)).self_log_kernel_sums()
+
+
+class TestCoresetKDE(unittest.TestCase):
+
+    def setUp(self) -> None:
+        rng = np.random.RandomState(0)
+        self.dataset = np.concatenate([rng.normal(size=(3, 1500)), rng.normal(size=(3, 1500)) + 4], axis=1)
+
+    def test_coreset_approximates_full_kde(self):
+        full_kde = gaussian_kde(self.dataset)
+        # Fresh samples of the same distribution
+        points = np.random.RandomState(1).normal(size=(3, 200)) + np.repeat([0, 4], 100)
+        errors = dict()
+        for method in CORESET_METHODS:
+            kde, report = fit_coreset_kde(self.dataset, coreset_size=300, method=method)
+            self.assertLessEqual(kde.n, 300)
+            np.testing.assert_allclose(kde.covariance, full_kde.covariance)
+            self.assertEqual(report.method, method)
+            self.assertEqual(report.holdout_size, 200)
+            self.assertLess(report.mean_abs_error, 0.5)
+            errors[method] = np.mean(np.abs(kde.logpdf(points) - full_kde.logpdf(points)))
+            self.assertLess(errors[method], 0.5)
+        self.assertLess(errors['kmeans'], errors['random'])
+
+    def test_scipy_kde_without_cholesky_factor(self):
+        # Before scipy 1.10, the kdes of scipy do not expose the cholesky factor of their covariance
+        class LegacyGaussianKDE(gaussian_kde):
+            def _compute_covariance(self):
+                super()._compute_covariance()
+                del self.cho_cov
+
+        expected, _ = fit_coreset_kde(self.dataset, coreset_size=300, method='random')
+        with mock.patch.object(kde_module, 'gaussian_kde', LegacyGaussianKDE):
+            kde, report = fit_coreset_kde(self.dataset, coreset_size=300, method='random')
+        self.assertIsNotNone(report)
+        np.testing.assert_allclose(kde.cho_cov, expected.cho_cov, rtol=1e-10)
+        np.testing.assert_allclose(kde.logpdf(self.dataset[:, :5]), expected.logpdf(self.dataset[:, :5]), rtol=1e-10)
+
+    def test_small_dataset_is_not_reduced(self):
+        kde, report = fit_coreset_kde(self.dataset[:, :100], coreset_size=300)
+        self.assertIsNone(report)
+        np.testing.assert_allclose(kde.logpdf(self.dataset[:, :5]), gaussian_kde(self.dataset[:, :100]).logpdf(
+            self.dataset[:, :5]), rtol=1e-8)
+
+
+class TestNativeKdeBackend(unittest.TestCase):
+
+    def test_lsa_is_consistent_with_original_implementation(self):
+        scores = dict()
+        for kde_backend in ('scipy', 'native'):
+            config = SurpriseAdequacyConfig(saved_path='/tmp/', is_classification=True, layer_names=['activation_3'],
+                                            ds_name='mnist', num_classes=10, kde_backend=kde_backend)
+            lsa = LSA(model=None, train_data=None, config=config)
+            lsa.train_ats = np.load("./tests/assets/original_mnist_train_activation_3_ats.npy")
+            lsa.train_pred = np.load("./tests/assets/original_mnist_train_pred.npy")
+            lsa._index_classes()
+            lsa._load_or_create_likelyhood_estimator(use_cache=False)
+            scores[kde_backend] = lsa._calc_lsa(np.load("./tests/assets/mnist_test_activation_3_ats.npy"),
+                                                np.load("./tests/assets/mnist_test_pred.npy"))
+
+        self.assertIsInstance(lsa.kdes[0], GaussianKDE)
+        np.testing.assert_allclose(scores['native'], scores['scipy'], rtol=1e-7)
+        np.testing.assert_allclose(scores['native'], np.load("./tests/assets/original_lsa_scores.npy"), rtol=1e-3)
+
+    def test_parallel_classes(self):
+        config = SurpriseAdequacyConfig(saved_path='/tmp/', is_classification=True, layer_names=['activation_3'],
+                                        ds_name='mnist', num_classes=10, kde_backend='native')
+        target_ats = np.load("./tests/assets/mnist_test_activation_3_ats.npy")
+        target_pred = np.load("./tests/assets/mnist_test_pred.npy")
+        scores = dict()
+        for max_workers in (1, 4):
+            lsa = LSA(model=None, train_data=None, config=config, max_workers=max_workers)
+            lsa.train_ats = np.load("./tests/assets/original_mnist_train_activation_3_ats.npy")
+            lsa.train_pred = np.load("./tests/assets/original_mnist_train_pred.npy")
+            lsa._index_classes()
+            lsa._load_or_create_likelyhood_estimator(use_cache=False)
+            self.assertEqual(list(lsa.kdes.keys()), list(range(10)))
+            scores[max_workers] = lsa._calc_lsa(target_ats, target_pred)
+        np.testing.assert_array_equal(scores[4], scores[1])
+
+    def test_coreset_lsa(self):
+        config = SurpriseAdequacyConfig(saved_path='/tmp/', is_classification=True, layer_names=['activation_3'],
+                                        ds_name='mnist', num_classes=10, kde_coreset_size=500)
+        lsa = LSA(model=None, train_data=None, config=config)
+        lsa.train_ats = np.load("./tests/assets/original_mnist_train_activation_3_ats.npy")
+        lsa.train_pred = np.load("./tests/assets/original_mnist_train_pred.npy")
+        lsa._index_classes()
+        lsa._load_or_create_likelyhood_estimator(use_cache=False)
+        self.assertEqual(sorted(lsa.kde_coreset_reports.keys()), list(range(10)))
+        self.assertTrue(all(kde.n <= 500 for kde in lsa.kdes.values()))
+
+        scores = lsa._calc_lsa(np.load("./tests/assets/mnist_test_activation_3_ats.npy"),
+                               np.load("./tests/assets/mnist_test_pred.npy"))
+        original_scores = np.load("./tests/assets/original_lsa_scores.npy")
+        self.assertGreater(np.corrcoef(scores, original_scores)[0, 1], 0.95)
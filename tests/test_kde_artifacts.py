@@ -0,0 +1,90 @@
+import json
+import os
+import shutil
+import unittest
+from concurrent.futures.thread import ThreadPoolExecutor
+
+import numpy as np
+from scipy.stats import gaussian_kde
+
+from apotoma.kde import GaussianKDE
+from apotoma.kde_artifacts import save_kdes, load_kdes, has_kdes, load_projections, load_kdes_on_train_ats, \
+    MANIFEST_FILE
+from apotoma.projection import PCAProjection
+
+
+class TestKdeArtifacts(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.path = '/tmp/kde_artifacts/'
+        shutil.rmtree(self.path, ignore_errors=True)
+        rng = np.random.RandomState(0)
+        self.datasets = [rng.normal(size=(3, 200)) + label for label in range(3)]
+        self.points = rng.normal(size=(3, 50))
+
+    def test_round_trip(self):
+        kdes = {
+            0: gaussian_kde(self.datasets[0]),
+            1: GaussianKDE.from_scipy(gaussian_kde(self.datasets[1]), max_tile_elements=1000),
+            2: GaussianKDE.from_scipy(gaussian_kde(self.datasets[2])),
+        }
+        save_kdes(self.path, kdes, removed_rows=[4, 7], kdes_on_train_ats={0: True, 1: False})
+        self.assertTrue(has_kdes(self.path))
+        self.assertEqual(load_kdes_on_train_ats(self.path), {0: True, 1: False, 2: False})
+
+        loaded, removed_rows = load_kdes(self.path)
+        self.assertEqual(removed_rows, [4, 7])
+        self.assertEqual(sorted(loaded.keys()), [0, 1, 2])
+        self.assertIsInstance(loaded[0], GaussianKDE)
+        self.assertEqual(loaded[1].max_tile_elements, 1000)
+        self.assertIsInstance(loaded[1].whitened_data, np.memmap)
+        for label, kde in kdes.items():
+            np.testing.assert_allclose(loaded[label].logpdf(self.points), kde.logpdf(self.points), rtol=1e-7)
+
+    def test_list_of_kdes(self):
+        kde = GaussianKDE.from_scipy(gaussian_kde(self.datasets[0]))
+        save_kdes(self.path, [kde], removed_rows=[])
+        loaded, removed_rows = load_kdes(self.path, mmap=False)
+        self.assertEqual(removed_rows, [])
+        self.assertEqual(len(loaded), 1)
+        np.testing.assert_array_equal(loaded[0].logpdf(self.points), kde.logpdf(self.points))
+
+    def test_projections(self):
+        kde = GaussianKDE.from_scipy(gaussian_kde(self.datasets[0]))
+        projections = {None: PCAProjection.fit(self.datasets[0].T, num_components=2),
+                       1: PCAProjection.fit(self.datasets[1].T, num_components=0.5)}
+        save_kdes(self.path, {0: kde}, removed_rows=[], projections=projections)
+        loaded = load_projections(self.path)
+        self.assertEqual(sorted(loaded.keys(), key=str), [1, None])
+        for key, projection in projections.items():
+            np.testing.assert_array_equal(loaded[key].transform(self.points.T), projection.transform(self.points.T))
+            self.assertEqual(loaded[key].explained_variance_ratio, projection.explained_variance_ratio)
+
+        save_kdes(self.path, {0: kde}, removed_rows=[])
+        self.assertEqual(load_projections(self.path), dict())
+
+    def test_other_format_versions_are_not_loaded(self):
+        save_kdes(self.path, [gaussian_kde(self.datasets[0])], removed_rows=[])
+        manifest_path = os.path.join(self.path, MANIFEST_FILE)
+        with open(manifest_path) as file:
+            manifest = json.load(file)
+        manifest["format_version"] = 0
+        with open(manifest_path, "w") as file:
+            json.dump(manifest, file)
+
+        self.assertFalse(has_kdes(self.path))
+        self.assertFalse(has_kdes('/tmp/kde_artifacts_missing/'))
+        with self.assertRaises(ValueError):
+            load_kdes(self.path)
+
+    def test_concurrent_saves(self):
+        kdes = [{0: GaussianKDE.from_scipy(gaussian_kde(dataset))} for dataset in self.datasets]
+        save_kdes(self.path, kdes[0], removed_rows=[0])
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            list(executor.map(lambda label: save_kdes(self.path, kdes[label], removed_rows=[label]), [0, 1, 2] * 3))
+
+        # The artifacts of one of the writers are in place, and no temporary directories are left
+        loaded, (label,) = load_kdes(self.path)
+        np.testing.assert_array_equal(loaded[0].logpdf(self.points), kdes[label][0].logpdf(self.points))
+        parent = os.path.dirname(os.path.normpath(self.path))
+        self.assertEqual([name for name in os.listdir(parent) if name.startswith("kde_artifacts.")], [])
@@ -0,0 +1,108 @@
+import os
+import shutil
+import unittest
+from unittest import mock
+
+import numpy as np
+import tensorflow as tf
+
+from apotoma import parallel_extraction, surprise_adequacy
+from apotoma.surprise_adequacy import DSA, LSA, SurpriseAdequacy
+from apotoma.surprise_adequacy import SurpriseAdequacyConfig
+
+_PATH = '/tmp/parallel_extraction/'
+_MODELS_PATH = os.path.join(_PATH, 'models')
+_ATS_PATH = os.path.join(_PATH, 'ats')
+
+
+def _small_dense_model(model_id: int) -> tf.keras.Model:
+    tf.keras.utils.set_random_seed(model_id)
+    inputs = tf.keras.Input(shape=(4, 4, 1))
+    x = tf.keras.layers.Flatten()(inputs)
+    x = tf.keras.layers.Dense(5, activation="tanh", name="dense")(x)
+    outputs = tf.keras.layers.Dense(3, activation="softmax", name="output")(x)
+    return tf.keras.Model(inputs=inputs, outputs=outputs)
+
+
+# Module-level (i.e., picklable) functions, called in the worker processes
+
+def _load_model(model_id: int) -> tf.keras.Model:
+    return tf.keras.models.load_model(os.path.join(_MODELS_PATH, f"{model_id}.keras"))
+
+
+def _config(model_id: int) -> SurpriseAdequacyConfig:
+    return SurpriseAdequacyConfig(saved_path=_ATS_PATH, is_classification=True, layer_names=['dense'],
+                                  ds_name=f"small_{model_id}", num_classes=3, batch_size=16)
+
+
+class TestParallelExtraction(unittest.TestCase):
+
+    def setUp(self) -> None:
+        shutil.rmtree(_PATH, ignore_errors=True)
+        os.makedirs(_MODELS_PATH)
+        os.makedirs(_ATS_PATH)
+        self.model_ids = [0, 1]
+        for model_id in self.model_ids:
+            _small_dense_model(model_id).save(os.path.join(_MODELS_PATH, f"{model_id}.keras"))
+        rng = np.random.RandomState(0)
+        self.train_data = rng.normal(size=(60, 4, 4, 1)).astype("float32")
+        self.test_data = rng.normal(size=(20, 4, 4, 1)).astype("float32")
+
+    def _extract(self, num_processes: int):
+        return parallel_extraction.extract_ats_in_parallel(model_loader=_load_model,
+                                                           model_ids=self.model_ids,
+                                                           config_factory=_config,
+                                                           datasets=[("train", self.train_data),
+                                                                     ("test", self.test_data)],
+                                                           num_processes=num_processes)
+
+    def _assert_found_in_cache(self):
+        """SAs used with use_cache=True find all ats in the cache and never run the model"""
+        for model_id in self.model_ids:
+            model = _load_model(model_id)
+            with mock.patch.object(SurpriseAdequacy, '_calculate_ats', side_effect=AssertionError("extracted")), \
+                    mock.patch.object(SurpriseAdequacy, '_iterate_at_batches', side_effect=AssertionError("streamed")):
+                for sa_class in (LSA, DSA):
+                    sa = sa_class(model, self.train_data, config=_config(model_id))
+                    sa.prep(use_cache=True)
+                    surprise, _ = sa.calc(self.test_data, "test", use_cache=True)
+                    self.assertEqual(surprise.shape, (20,))
+
+            expected_ats, expected_pred = DSA(model, self.train_data, config=_config(model_id))._calculate_ats(
+                self.train_data)
+            sa = DSA(model, self.train_data, config=_config(model_id))
+            sa.prep(use_cache=True)
+            np.testing.assert_allclose(sa.train_ats, expected_ats, rtol=1e-5)
+            np.testing.assert_equal(sa.train_pred, expected_pred)
+
+    def test_extract_in_worker_processes(self):
+        saved_paths = self._extract(num_processes=2)
+
+        self.assertEqual(sorted(saved_paths), self.model_ids)
+        for model_id in self.model_ids:
+            # One entry per dataset: The ats paths (one per layer) and the predictions path
+            self.assertEqual(len(saved_paths[model_id]), 2)
+            for layer_paths, pred_path in saved_paths[model_id]:
+                self.assertTrue(all(os.path.exists(path) for path in layer_paths + [pred_path]))
+        self._assert_found_in_cache()
+
+    def test_extract_sequentially(self):
+        self._extract(num_processes=0)
+        self.assertEqual(parallel_extraction._worker_state, dict())
+        self._assert_found_in_cache()
+
+    def test_models_are_fingerprinted_once(self):
+        with mock.patch.object(parallel_extraction, 'model_fingerprint',
+                               wraps=parallel_extraction.model_fingerprint) as fingerprint, \
+                mock.patch.object(surprise_adequacy, 'model_fingerprint', side_effect=AssertionError("re-hashed")):
+            self._extract(num_processes=0)
+        self.assertEqual(fingerprint.call_count, len(self.model_ids))
+        self._assert_found_in_cache()
+
+    def test_negative_num_processes(self):
+        with self.assertRaises(ValueError):
+            self._extract(num_processes=-1)
+
+
+if __name__ == '__main__':
+    unittest.main()
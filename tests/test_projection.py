@@ -0,0 +1,70 @@
+import unittest
+
+import numpy as np
+
+from apotoma.projection import PCAProjection
+from apotoma.surprise_adequacy import LSA
+from apotoma.surprise_adequacy import SurpriseAdequacyConfig
+
+
+class TestPCAProjection(unittest.TestCase):
+
+    def setUp(self) -> None:
+        rng = np.random.RandomState(0)
+        # Variance of 25, 4, 1 and 0.01 along the axes
+        self.ats = rng.normal(size=(2000, 4)) * [5, 2, 1, 0.1] + 3
+
+    def test_num_components(self):
+        projection = PCAProjection.fit(self.ats, num_components=2)
+        self.assertEqual(projection.num_components, 2)
+        self.assertAlmostEqual(projection.explained_variance_ratio, 29 / 30.01, places=2)
+        np.testing.assert_allclose(np.abs(projection.components), [[1, 0, 0, 0], [0, 1, 0, 0]], atol=0.05)
+
+        projected = projection.transform(self.ats)
+        self.assertEqual(projected.shape, (2000, 2))
+        np.testing.assert_allclose(np.mean(projected, axis=0), 0, atol=1e-10)
+        self.assertEqual(PCAProjection.fit(self.ats, num_components=10).num_components, 4)
+
+    def test_share_of_variance(self):
+        self.assertEqual(PCAProjection.fit(self.ats, num_components=0.8).num_components, 1)
+        self.assertEqual(PCAProjection.fit(self.ats, num_components=0.9).num_components, 2)
+        self.assertEqual(PCAProjection.fit(self.ats, num_components=0.99).num_components, 3)
+        self.assertEqual(PCAProjection.fit(self.ats, num_components=1.).num_components, 4)
+
+
+class TestProjectedLSA(unittest.TestCase):
+
+    def _lsa_scores(self, **kwargs):
+        config = SurpriseAdequacyConfig(saved_path='/tmp/', is_classification=True, layer_names=['activation_3'],
+                                        ds_name='mnist', num_classes=10, kde_backend='native', **kwargs)
+        lsa = LSA(model=None, train_data=None, config=config)
+        lsa.train_ats = np.load("./tests/assets/original_mnist_train_activation_3_ats.npy")
+        lsa.train_pred = np.load("./tests/assets/original_mnist_train_pred.npy")
+        lsa._index_classes()
+        lsa._load_or_create_likelyhood_estimator(use_cache=False)
+        scores = lsa._calc_lsa(np.load("./tests/assets/mnist_test_activation_3_ats.npy"),
+                               np.load("./tests/assets/mnist_test_pred.npy"))
+        return lsa, scores
+
+    def test_full_rank_projection_does_not_change_lsa(self):
+        # KDEs with scott's bandwidth are invariant under rotations and translations of the data
+        _, expected = self._lsa_scores()
+        for per_class in (False, True):
+            lsa, scores = self._lsa_scores(pca_components=10, pca_per_class=per_class)
+            self.assertEqual(len(lsa.projections), 10 if per_class else 1)
+            # Up to the round-off of the ill-conditioned covariances of these ats
+            np.testing.assert_allclose(scores, expected, rtol=1e-3)
+
+    def test_reduced_projection(self):
+        lsa, scores = self._lsa_scores(pca_components=0.9)
+        projection = lsa.projections[None]
+        self.assertLess(projection.num_components, 10)
+        self.assertGreaterEqual(projection.explained_variance_ratio, 0.9)
+        self.assertEqual(lsa.kdes[0].d, projection.num_components)
+        self.assertTrue(np.all(np.isfinite(scores)))
+
+    def test_invalid_config(self):
+        for kwargs in ({"pca_components": 0}, {"pca_components": 1.5}, {"pca_per_class": True}):
+            with self.assertRaises(ValueError):
+                SurpriseAdequacyConfig(saved_path='/tmp/', is_classification=False, layer_names=['activation_3'],
+                                       ds_name='mnist', num_classes=None, **kwargs)
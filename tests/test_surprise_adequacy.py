@@ -0,0 +1,145 @@
+import shutil
+import unittest
+from unittest import mock
+
+import numpy as np
+
+from apotoma import surprise_adequacy
+from apotoma.kde import GaussianKDE
+from apotoma.surprise_adequacy import DSA
+from apotoma.surprise_adequacy import LSA
+from apotoma.surprise_adequacy import SurpriseAdequacyConfig
+
+
+class TestSurpriseAdequacyOnSyntheticAts(unittest.TestCase):
+    """Tests operating directly on (synthetic) activation traces, i.e., without a model"""
+
+    def setUp(self) -> None:
+        self.config = SurpriseAdequacyConfig(saved_path='/tmp/', is_classification=True, layer_names=['synthetic'],
+                                             ds_name='synthetic', num_classes=3, min_var_threshold=1e-5)
+        rng = np.random.RandomState(0)
+        self.train_pred = rng.randint(0, 3, size=600)
+        self.train_ats = (rng.normal(size=(600, 4)) + self.train_pred[:, None]).astype(np.float32)
+        self.target_pred = rng.randint(0, 3, size=100)
+        self.target_ats = (rng.normal(size=(100, 4)) + self.target_pred[:, None]).astype(np.float32)
+
+    def _prepared(self, sa_class, num_train_samples=600, **kwargs):
+        sa = sa_class(model=None, train_data=None, config=self.config, **kwargs)
+        sa._calculate_ats = lambda dataset: (self.train_ats[dataset], self.train_pred[dataset])
+        sa._load_or_calculate_ats = lambda dataset, ds_type, use_cache: sa._calculate_ats(dataset)
+        sa.train_data = slice(0, num_train_samples)
+        sa.prep()
+        return sa
+
+    def test_extend_matches_full_preparation(self):
+        for sa_class in (LSA, DSA):
+            full = self._prepared(sa_class)
+            extended = self._prepared(sa_class, num_train_samples=400)
+            extended.extend(slice(400, 600))
+
+            np.testing.assert_equal(extended.train_ats, full.train_ats)
+            if sa_class is LSA:
+                expected = full._calc_lsa(self.target_ats, self.target_pred)
+                actual = extended._calc_lsa(self.target_ats, self.target_pred)
+            else:
+                expected = full._calc_dsa(self.target_ats, self.target_pred, "test")
+                actual = extended._calc_dsa(self.target_ats, self.target_pred, "test")
+            np.testing.assert_almost_equal(actual, expected)
+
+    def test_extend_with_projection_matches_full_preparation(self):
+        for pca_per_class in (False, True):
+            self.config.pca_components = 2
+            self.config.pca_per_class = pca_per_class
+            full = self._prepared(LSA)
+            extended = self._prepared(LSA, num_train_samples=400)
+            extended.extend(slice(400, 600))
+
+            np.testing.assert_allclose(extended._calc_lsa(self.target_ats, self.target_pred),
+                                       full._calc_lsa(self.target_ats, self.target_pred), rtol=1e-8)
+
+    def test_classes_without_kde_are_not_scored(self):
+        # No train ats of class 2
+        self.train_pred[self.train_pred == 2] = 1
+        lsa = self._prepared(LSA)
+        self.assertEqual(sorted(lsa.kdes.keys()), [0, 1])
+        expected = lsa._calc_lsa(self.target_ats, self.target_pred)
+        np.testing.assert_array_equal(np.isnan(expected), self.target_pred == 2)
+        np.testing.assert_allclose(lsa.score_ats(self.target_ats, self.target_pred), expected)
+
+    def test_failed_kde_load_is_a_cache_miss(self):
+        kdes_path = '/tmp/synthetic_kdes/'
+        shutil.rmtree(kdes_path, ignore_errors=True)
+        with mock.patch.object(LSA, '_get_kde_saved_path', return_value=kdes_path):
+            expected = self._prepared(LSA)._calc_lsa(self.target_ats, self.target_pred)
+            self.assertTrue(surprise_adequacy.has_kdes(kdes_path))
+            lsa = self._prepared(LSA)
+            lsa.kdes = None
+            # E.g., if the artifacts are replaced by a concurrent writer while they are read
+            with mock.patch.object(surprise_adequacy, 'load_kdes', side_effect=FileNotFoundError("replaced")):
+                lsa._load_or_create_likelyhood_estimator(use_cache=True)
+            np.testing.assert_allclose(lsa._calc_lsa(self.target_ats, self.target_pred), expected)
+            self.assertTrue(surprise_adequacy.has_kdes(kdes_path))
+
+    def test_dsa_compares_train_ats_tile_by_tile(self):
+        self.config.ats_precision = 'int8'
+        # Train ats in extraction order (index arrays per class) and grouped by class (slices per class)
+        for order in (np.arange(600), np.argsort(self.train_pred, kind='stable')):
+            self.train_ats, self.train_pred = self.train_ats[order], self.train_pred[order]
+            dsa = self._prepared(DSA)
+            expected = dsa._calc_dsa(self.target_ats, self.target_pred, "test")
+
+            dequantized_rows = []
+            train_ats_rows = dsa._train_ats_rows
+
+            def recording_train_ats_rows(rows):
+                dequantized = train_ats_rows(rows)
+                dequantized_rows.append(dequantized.shape[0])
+                return dequantized
+
+            dsa._train_ats_rows = recording_train_ats_rows
+            with mock.patch.object(surprise_adequacy, 'DEFAULT_MAX_TILE_ELEMENTS', 1000):
+                actual = dsa._calc_dsa(self.target_ats, self.target_pred, "test")
+            np.testing.assert_equal(actual, expected)
+            # Never more train ats dequantized at once than fit into a tile
+            self.assertLessEqual(max(dequantized_rows), 1000 // 4)
+
+    def test_train_ats_assigned_after_prep(self):
+        lsa = self._prepared(LSA)
+        # The train ats are kept in their original order
+        np.testing.assert_equal(lsa.train_pred, self.train_pred)
+
+        # As in the consistency test against the original implementation: Replaced ats (in the same order)
+        lsa.train_ats = self.train_ats * 2
+        lsa.train_pred = np.copy(self.train_pred)
+        lsa._load_or_create_likelyhood_estimator(use_cache=False)
+
+        self.train_ats = self.train_ats * 2
+        expected = self._prepared(LSA)._calc_lsa(self.target_ats, self.target_pred)
+        np.testing.assert_allclose(lsa._calc_lsa(self.target_ats, self.target_pred), expected)
+
+    def test_low_variance_nodes_are_removed_per_node(self):
+        # Node 2 is constant amongst the train ats of class 1 only
+        self.train_ats[self.train_pred == 1, 2] = 0.5
+        lsa = self._prepared(LSA)
+        self.assertEqual(lsa.removed_rows, [2])
+        self.assertEqual(lsa.kdes[0].d, 3)
+        self.assertTrue(np.all(np.isfinite(lsa._calc_lsa(self.target_ats, self.target_pred))))
+
+    def test_train_lsa(self):
+        for backend in ('scipy', 'native'):
+            self.config.kde_backend = backend
+            lsa = self._prepared(LSA)
+            np.testing.assert_allclose(lsa.train_lsa(leave_one_out=False),
+                                       lsa._calc_lsa(lsa.train_ats, lsa.train_pred), rtol=1e-8)
+
+            # The leave-one-out lsa of a train at is its lsa by the kde of the other ats of its class
+            loo = lsa.train_lsa()
+            row = int(np.flatnonzero(lsa.train_pred == 1)[5])
+            others = np.delete(lsa.train_ats, row, axis=0)[np.delete(lsa.train_pred, row) == 1]
+            kde = GaussianKDE(np.transpose(others), covariance=lsa.kdes[1].covariance)
+            self.assertAlmostEqual(loo[row], -kde.logpdf(lsa.train_ats[row])[0], places=8)
+
+        # Coreset kdes do not contain the train ats: They are scored as any other target
+        self.config.kde_coreset_size = 50
+        lsa = self._prepared(LSA)
+        np.testing.assert_allclose(lsa.train_lsa(), lsa._calc_lsa(lsa.train_ats, lsa.train_pred))